@@ -70,28 +70,35 @@ list of output formats. For now, the following formats are supported:
 The prefix is the filename prefix for all the rendered files. This is usually a
 path to the destination's directory, eventually followed by some unique, yet
 common prefix for the files rendered for a job.
+
+Before accepting a job, a rough estimate of its cost (number of pages, index
+size, number of pixels, time and memory) can be obtained without rendering
+anything with:
+
+    estimate = renderer.estimate(rendering_configuration, layout_name)
 """
 
 __author__ = 'The MapOSMatic developers'
 __version__ = '0.2'
 
-import cairo
 import ConfigParser
-import gzip
 import logging
 import os
-import psycopg2
 import re
 import tempfile
-import shapely
-import shapely.wkt
-import shapely.geometry
+import threading
 
+# The rendering dependencies are only imported when actually rendering
+from lazy_modules import cairo, mapnik, psycopg2, shapely
+import compression
 import coords
 import i18n
-from indexlib.indexer import StreetIndex
+from cancellation import CancellationToken, RenderingCancelledError
+from indexlib.indexer import StreetIndex, ENDPOINTS_SQL
+from indexlib.cache import StreetIndexCache
 from indexlib.commons import IndexDoesNotFitError, IndexEmptyError
 from layoutlib import PAPER_SIZES, renderers
+from maplib.base_map_cache import BaseMapCache
 import layoutlib.commons
 
 LOG = logging.getLogger('ocitysmap')
@@ -121,6 +128,37 @@ class RenderingConfiguration:
         # Setup by OCitySMap::render() from language field:
         self.i18n            = None # i18n object
 
+        # Setup by OCitySMap::render() from the configuration file:
+        self.index_cache     = None # StreetIndexCache object or None
+        self.index_db_pool   = None # psycopg2 connection pool or None
+        self.index_endpoints = None # str, see StreetIndex
+        self.multi_page_single_render = False # bool
+        self.base_map_cache  = None # BaseMapCache object or None
+
+        # Setup by OCitySMap::render() from its arguments:
+        self.cancellation    = None # CancellationToken object or None
+        self.preview         = False # bool
+
+
+class RenderingEstimate:
+    """
+    The RenderingEstimate class holds a rough estimate of the cost of a
+    rendering request, as returned by OCitySMap.estimate().
+    """
+
+    def __init__(self):
+        self.page_count   = None # int, upper bound
+        self.index_size   = None # int, number of index items
+        self.pixel_count  = None # int, PNG pixels of the whole document
+        self.duration_s   = None # float, rendering time in seconds
+        self.memory_bytes = None # int, peak memory
+
+    def __str__(self):
+        return ('<RenderingEstimate: %d page(s), %d index items, %d pixels, '
+                '%ds, %dMB>' % (self.page_count, self.index_size,
+                                self.pixel_count, self.duration_s,
+                                self.memory_bytes / (1024 * 1024)))
+
 
 class Stylesheet:
     """
@@ -130,11 +168,22 @@ class Stylesheet:
     """
     DEFAULT_ZOOM_LEVEL = 16
 
+    # Size of the pools of persistent connections of the PostGIS layers,
+    # and extent given to the layers without one (the whole world, in the
+    # map projection), when their datasources are overridden
+    DEFAULT_DATASOURCE_POOL_SIZE = 10
+    DEFAULT_DATASOURCE_EXTENT = ('-20037508.34,-20037508.34,'
+                                 '20037508.34,20037508.34')
+
     def __init__(self):
         self.name        = None # str
         self.path        = None # str
         self.description = '' # str
 
+        # Parameters overriding the ones of the PostGIS layers of the
+        # stylesheet, see load_map()
+        self.datasource_overrides = {}
+
         self.grid_line_color = 'black'
         self.grid_line_alpha = 0.5
         self.grid_line_width = 1
@@ -187,8 +236,66 @@ class Stylesheet:
             raise ValueError, \
                     'OCitySMap configuration does not contain any stylesheet!'
 
-        return [Stylesheet.create_from_config_section(parser, name.strip())
-                for name in styles.split(',')]
+        stylesheets = [Stylesheet.create_from_config_section(parser,
+                                                             name.strip())
+                       for name in styles.split(',')]
+        overrides = Stylesheet._get_datasource_overrides(parser)
+        for s in stylesheets:
+            s.datasource_overrides = overrides
+        return stylesheets
+
+    @staticmethod
+    def _get_datasource_overrides(parser):
+        """Return the parameters overriding the ones of the PostGIS layers
+        of the stylesheets, from the [datasource] section of the
+        configuration: its connection parameters, persistent connections
+        and a fixed extent. Empty unless the override_stylesheets option
+        is set."""
+        if (not parser.has_option('datasource', 'override_stylesheets') or
+            not parser.getboolean('datasource', 'override_stylesheets')):
+            return {}
+
+        overrides = {'persist_connections': 'true',
+                     'estimate_extent': 'false'}
+        for key in ('host', 'port', 'user', 'password', 'dbname'):
+            if parser.has_option('datasource', key):
+                overrides[key] = parser.get('datasource', key)
+        try:
+            pool_size = parser.getint('datasource', 'stylesheet_pool_size')
+        except ConfigParser.NoOptionError:
+            pool_size = Stylesheet.DEFAULT_DATASOURCE_POOL_SIZE
+        overrides['max_size'] = str(pool_size)
+        try:
+            overrides['extent'] = parser.get('datasource', 'stylesheet_extent')
+        except ConfigParser.NoOptionError:
+            overrides['extent'] = Stylesheet.DEFAULT_DATASOURCE_EXTENT
+        return overrides
+
+    def load_map(self, mapnik_map):
+        """Load the layers and styles of this stylesheet in the given
+        mapnik.Map, replacing the datasources of its PostGIS layers by
+        ones using the datasource_overrides parameters. The extent of the
+        layers defining one is kept.
+
+        Args:
+            mapnik_map (mapnik.Map): the map to load the stylesheet into.
+        """
+        mapnik.load_map(mapnik_map, self.path)
+        if not self.datasource_overrides:
+            return
+
+        for layer in mapnik_map.layers:
+            params = layer.datasource.params().as_dict()
+            if params.get('type') != 'postgis':
+                continue
+            # The values are kept as they are, the names of the parameters
+            # are plain ASCII keyword arguments
+            params = dict((str(key), value) for key, value in params.items())
+            extent = params.get('extent')
+            params.update(self.datasource_overrides)
+            if extent:
+                params['extent'] = extent
+            layer.datasource = mapnik.Datasource(**params)
 
 class OCitySMap:
     """
@@ -200,6 +307,25 @@ class OCitySMap:
 
     DEFAULT_RENDERING_PNG_DPI = 72
 
+    DEFAULT_PREVIEW_WIDTH_PX = 800
+
+    DEFAULT_INDEX_CONNECTIONS = 1
+
+    DEFAULT_MULTI_PAGE_SINGLE_RENDER = False
+
+    DEFAULT_BASE_MAP_CACHE_SIZE = 0
+
+    DEFAULT_GZIP_THREADS = 0
+
+    # Coefficients of the rendering cost model used by estimate(). They
+    # are rough orders of magnitude, to be tuned for the actual servers.
+    ESTIMATE_BASE_DURATION_S       = 5.
+    ESTIMATE_DURATION_PER_PAGE_S   = 15.
+    ESTIMATE_DURATION_PER_ITEM_S   = 0.005
+    ESTIMATE_BASE_MEMORY_BYTES     = 100 * 1024 * 1024
+    ESTIMATE_MEMORY_PER_PIXEL      = 4
+    ESTIMATE_MEMORY_PER_ITEM       = 2048
+
     STYLESHEET_REGISTRY = []
 
     def __init__(self, config_files=None):
@@ -226,22 +352,34 @@ class OCitySMap:
 
         self._locale_path = os.path.join(os.path.dirname(__file__), '..', 'locale')
         self.__db = None
+        self.__index_db_pool = None
+        self._base_map_cache = self._create_base_map_cache()
 
         # Read stylesheet configuration
         self.STYLESHEET_REGISTRY = Stylesheet.create_all_from_config(self._parser)
         LOG.debug('Found %d Mapnik stylesheets.' % len(self.STYLESHEET_REGISTRY))
 
+    def _get_datasource(self):
+        datasource = dict(self._parser.items('datasource'))
+        # The port is not a mandatory configuration option, so make
+        # sure we define a default value.
+        if not datasource.has_key('port'):
+            datasource['port'] = 5432
+        return datasource
+
+    def _get_request_timeout(self):
+        try:
+            return int(self._parser.get('datasource', 'request_timeout'))
+        except (ConfigParser.NoOptionError, ValueError):
+            return OCitySMap.DEFAULT_REQUEST_TIMEOUT_MIN
+
     @property
     def _db(self):
         if self.__db:
             return self.__db
 
         # Database connection
-        datasource = dict(self._parser.items('datasource'))
-        # The port is not a mandatory configuration option, so make
-        # sure we define a default value.
-        if not datasource.has_key('port'):
-            datasource['port'] = 5432
+        datasource = self._get_datasource()
         LOG.info('Connecting to database %s on %s:%s as %s...' %
                  (datasource['dbname'], datasource['host'], datasource['port'],
                   datasource['user']))
@@ -259,15 +397,45 @@ class OCitySMap:
         # Make sure the DB is correctly installed
         self._verify_db(db)
 
-        try:
-            timeout = int(self._parser.get('datasource', 'request_timeout'))
-        except (ConfigParser.NoOptionError, ValueError):
-            timeout = OCitySMap.DEFAULT_REQUEST_TIMEOUT_MIN
-        self._set_request_timeout(db, timeout)
+        self._set_request_timeout(db, self._get_request_timeout())
 
         self.__db = db
         return self.__db
 
+    @property
+    def _index_db_pool(self):
+        """Pool of database connections used to run the index queries
+        concurrently, or None when they run on the main connection (the
+        default, see the index_connections option)."""
+        if self.__index_db_pool:
+            return self.__index_db_pool
+
+        try:
+            connections = int(self._parser.get('datasource',
+                                               'index_connections'))
+        except (ConfigParser.NoOptionError, ValueError):
+            connections = OCitySMap.DEFAULT_INDEX_CONNECTIONS
+        if connections <= 1:
+            return None
+
+        datasource = self._get_datasource()
+        LOG.info('Creating a pool of %d connections to database %s for '
+                 'the index queries...' % (connections, datasource['dbname']))
+
+        # The pool opens the connections itself: the client encoding and
+        # the request timeout are given as connection parameters.
+        self.__index_db_pool = psycopg2.pool.ThreadedConnectionPool(
+            1, connections,
+            user=datasource['user'],
+            password=datasource['password'],
+            host=datasource['host'],
+            database=datasource['dbname'],
+            port=datasource['port'],
+            client_encoding='utf8',
+            options='-c statement_timeout=%d'
+                    % (self._get_request_timeout() * 60 * 1000))
+        return self.__index_db_pool
+
     def _verify_db(self, db):
         """Make sure the PostGIS DB is compatible with us."""
         cursor = db.cursor()
@@ -399,30 +567,20 @@ SELECT ST_AsText(ST_LongestLine(
     def get_all_paper_sizes(self):
         return PAPER_SIZES
 
-    def render(self, config, renderer_name, output_formats, file_prefix):
-        """Renders a job with the given rendering configuration, using the
-        provided renderer, to the given output formats.
+    def _setup_area_of_interest(self, config):
+        """Setup the i18n object, the bounding box and the polygon WKT of
+        interest of the given rendering configuration.
 
         Args:
             config (RenderingConfiguration): the rendering configuration
                 object.
-            renderer_name (string): the layout renderer to use for this rendering.
-            output_formats (list): a list of output formats to render to, from
-                the list of supported output formats (pdf, svgz, etc.).
-            file_prefix (string): filename prefix for all output files.
         """
-
         assert config.osmid or config.bounding_box, \
                 'At least an OSM ID or a bounding box must be provided!'
 
-        output_formats = map(lambda x: x.lower(), output_formats)
         config.i18n = i18n.install_translation(config.language,
                                                self._locale_path)
 
-        LOG.info('Rendering with renderer %s in language: %s (rtl: %s).' %
-                 (renderer_name, config.i18n.language_code(),
-                  config.i18n.isrtl()))
-
         # Determine bounding box and WKT of interest
         if config.osmid:
             osmid_bbox, osmid_area \
@@ -443,18 +601,233 @@ SELECT ST_AsText(ST_LongestLine(
         assert config.bounding_box is not None
         assert config.polygon_wkt is not None
 
-        osm_date = self.get_osm_database_last_update()
+    def _create_base_map_cache(self):
+        """Return the BaseMapCache shared by the renderings of this
+        instance, or None if it is disabled."""
+        try:
+            size = int(self._parser.get('rendering', 'base_map_cache_size'))
+        except ConfigParser.NoOptionError:
+            size = OCitySMap.DEFAULT_BASE_MAP_CACHE_SIZE
+        if size <= 0:
+            return None
+        if not BaseMapCache.is_available():
+            LOG.warning('Cairo recording surfaces not available, '
+                        'base map cache disabled.')
+            return None
+        return BaseMapCache(size)
+
+    def _get_index_endpoints(self):
+        """Return the strategy used to compute the endpoints of the index
+        items (see indexlib.indexer.ENDPOINTS_SQL)."""
+        try:
+            endpoints = self._parser.get('rendering', 'index_endpoints')
+        except ConfigParser.NoOptionError:
+            return StreetIndex.DEFAULT_ENDPOINTS
+        if endpoints not in ENDPOINTS_SQL:
+            raise ValueError, \
+                'Invalid index_endpoints option: %s' % endpoints
+        return endpoints
+
+    def _get_multi_page_single_render(self):
+        try:
+            return self._parser.getboolean('rendering',
+                                           'multi_page_single_render')
+        except ConfigParser.NoOptionError:
+            return OCitySMap.DEFAULT_MULTI_PAGE_SINGLE_RENDER
+
+    def _get_png_dpi(self):
+        try:
+            return int(self._parser.get('rendering', 'png_dpi'))
+        except ConfigParser.NoOptionError:
+            return OCitySMap.DEFAULT_RENDERING_PNG_DPI
+
+    def _get_preview_dpi(self, config):
+        """Return the resolution of the previews of the given rendering
+        configuration, so that they are preview_width_px pixels wide, but
+        never more detailed than the vector outputs."""
+        try:
+            width_px = int(self._parser.get('rendering', 'preview_width_px'))
+        except ConfigParser.NoOptionError:
+            width_px = OCitySMap.DEFAULT_PREVIEW_WIDTH_PX
+        return min(layoutlib.commons.PT_PER_INCH,
+                   width_px * layoutlib.commons.PT_PER_INCH
+                   / layoutlib.commons.convert_mm_to_pt(config.paper_width_mm))
+
+    def estimate(self, config, renderer_name):
+        """Returns a rough estimate of the cost of rendering the given
+        configuration with the given renderer, without rendering anything.
+        Only cheap database queries are performed, so this can be used to
+        route or reject requests before accepting them.
+
+        Args:
+            config (RenderingConfiguration): the rendering configuration
+                object.
+            renderer_name (string): the layout renderer to use for this
+                rendering.
+
+        Returns a RenderingEstimate object.
+        """
+        self._setup_area_of_interest(config)
+        renderer_cls = renderers.get_renderer_class_by_name(renderer_name)
+
+        estimate = RenderingEstimate()
+        estimate.index_size = StreetIndex.estimate_size(self._db,
+                                                        config.bounding_box)
+        estimate.page_count = renderer_cls.get_estimated_page_count(
+            config.bounding_box, config.paper_width_mm,
+            config.paper_height_mm, estimate.index_size)
+
+        dpi = self._get_png_dpi()
+        estimate.pixel_count = estimate.page_count * int(
+            layoutlib.commons.convert_pt_to_dots(
+                layoutlib.commons.convert_mm_to_pt(config.paper_width_mm),
+                dpi)
+            * layoutlib.commons.convert_pt_to_dots(
+                layoutlib.commons.convert_mm_to_pt(config.paper_height_mm),
+                dpi))
+
+        estimate.duration_s = (
+            OCitySMap.ESTIMATE_BASE_DURATION_S
+            + OCitySMap.ESTIMATE_DURATION_PER_PAGE_S * estimate.page_count
+            + OCitySMap.ESTIMATE_DURATION_PER_ITEM_S * estimate.index_size)
+        estimate.memory_bytes = (
+            OCitySMap.ESTIMATE_BASE_MEMORY_BYTES
+            + OCitySMap.ESTIMATE_MEMORY_PER_PIXEL * estimate.pixel_count
+              / estimate.page_count
+            + OCitySMap.ESTIMATE_MEMORY_PER_ITEM * estimate.index_size)
+
+        LOG.debug('Estimated cost of rendering with %s: %s'
+                  % (renderer_name, estimate))
+        return estimate
+
+    def render(self, config, renderer_name, output_formats, file_prefix,
+               cancellation=None, preview=False):
+        """Renders a job with the given rendering configuration, using the
+        provided renderer, to the given output formats.
+
+        Args:
+            config (RenderingConfiguration): the rendering configuration
+                object.
+            renderer_name (string): the layout renderer to use for this rendering.
+            output_formats (list): a list of output formats to render to, from
+                the list of supported output formats (pdf, svgz, etc.).
+            file_prefix (string): filename prefix for all output files.
+            cancellation (CancellationToken): None or a token to cancel the
+                rendering, or to bound its duration.
+            preview (bool): only render a small PNG of the layout of the
+                page (see [rendering] preview_width_px), with a low detail
+                map (see Renderer.PREVIEW_MIN_SCALE) and an estimated index
+                area instead of the actual index. The output_formats are
+                ignored.
+
+        Raises RenderingCancelledError when the rendering is cancelled. In
+        that case, the output files created by the rendering are removed.
+        """
 
-        # Create a temporary directory for all our shape files
-        tmpdir = tempfile.mkdtemp(prefix='ocitysmap')
+        output_formats = map(lambda x: x.lower(), output_formats)
+        config.cancellation = cancellation
+        config.preview = preview
+        if preview:
+            output_formats = ['png']
+
+        # Output files created by this rendering, removed if it is
+        # cancelled (the CSV index is written by the single-page renderers
+        # whatever the output formats)
+        created_filenames = []
+        for output_format in set(output_formats + ['csv']):
+            output_filename = '%s.%s' % (file_prefix, output_format)
+            if not os.path.exists(output_filename):
+                created_filenames.append(output_filename)
+
+        if cancellation is not None:
+            # Interrupt the running database query as soon as the
+            # rendering is cancelled, or its deadline is reached.
+            db = self._db
+            cancellation.check()
+            cancellation.add_callback(db.cancel)
+            if cancellation.deadline is not None:
+                watchdog = threading.Timer(cancellation.remaining(),
+                                           cancellation.cancel)
+                watchdog.daemon = True
+                watchdog.start()
+            else:
+                watchdog = None
+
+        tmpdir = None
         try:
+            self._setup_area_of_interest(config)
+
+            LOG.info('Rendering with renderer %s in language: %s (rtl: %s).' %
+                     (renderer_name, config.i18n.language_code(),
+                      config.i18n.isrtl()))
+
+            osm_date = self.get_osm_database_last_update()
+
+            # Indexes only depend on the area, the language and the OSM
+            # data, so they can be reused across renderings
+            config.index_endpoints = self._get_index_endpoints()
+            try:
+                config.index_cache = StreetIndexCache(
+                    self._parser.get('rendering', 'index_cache_dir'),
+                    osm_date, config.index_endpoints)
+            except ConfigParser.NoOptionError:
+                config.index_cache = None
+            config.index_db_pool = self._index_db_pool
+            config.multi_page_single_render = \
+                self._get_multi_page_single_render()
+
+            # Base maps only depend on the stylesheet, the area and the
+            # OSM data
+            if self._base_map_cache is not None:
+                self._base_map_cache.set_data_version(osm_date)
+            config.base_map_cache = self._base_map_cache
+
+            # Create a temporary directory for all our shape files
+            tmpdir = tempfile.mkdtemp(prefix='ocitysmap')
             LOG.debug('Rendering in temporary directory %s' % tmpdir)
 
             # Prepare the generic renderer
             renderer_cls = renderers.get_renderer_class_by_name(renderer_name)
+            if (preview and 'png' not in
+                renderer_cls.get_compatible_output_formats()):
+                raise ValueError, \
+                    'Renderer %s does not support previews!' % renderer_name
+
+            # Single-page layouts are rendered once for all the output
+            # formats laid out at the same resolution, and replayed into
+            # them (see _render_recorded())
+            recorded_formats = {}
+            if (hasattr(cairo, 'RecordingSurface')
+                and not getattr(renderer_cls, 'multipages', False)):
+                for output_format in output_formats:
+                    if output_format == 'csv':
+                        continue
+                    dpi = self._get_output_dpi(config, output_format)
+                    recorded_formats.setdefault(dpi, []).append(output_format)
+                for dpi, formats in recorded_formats.items():
+                    if len(formats) < 2:
+                        del recorded_formats[dpi]
 
             # Perform the actual rendering to the Cairo devices
+            for dpi, formats in sorted(recorded_formats.items()):
+                if cancellation is not None:
+                    cancellation.check()
+
+                try:
+                    self._render_recorded(config, tmpdir, renderer_cls,
+                                          formats, dpi, osm_date, file_prefix)
+                except IndexDoesNotFitError:
+                    LOG.exception("The actual font metrics probably don't "
+                                  "match those pre-computed by the renderer's"
+                                  "constructor. Backtrace follows...")
+
             for output_format in output_formats:
+                if any(output_format in formats
+                       for formats in recorded_formats.values()):
+                    continue
+                if cancellation is not None:
+                    cancellation.check()
+
                 output_filename = '%s.%s' % (file_prefix, output_format)
                 try:
                     self._render_one(config, tmpdir, renderer_cls,
@@ -464,67 +837,189 @@ SELECT ST_AsText(ST_LongestLine(
                     LOG.exception("The actual font metrics probably don't "
                                   "match those pre-computed by the renderer's"
                                   "constructor. Backtrace follows...")
+        except RenderingCancelledError:
+            self._abort_rendering(created_filenames)
+            raise
+        except psycopg2.extensions.QueryCanceledError:
+            # The running query was interrupted by the db.cancel() callback
+            # of the token: report the cancellation itself. Queries
+            # cancelled for another reason are left as they are.
+            if cancellation is None or not cancellation.is_cancelled():
+                raise
+            self._abort_rendering(created_filenames)
+            cancellation.check()
+            raise
         finally:
-            self._cleanup_tempdir(tmpdir)
+            if cancellation is not None:
+                if watchdog is not None:
+                    watchdog.cancel()
+                cancellation.remove_callback(db.cancel)
+            if tmpdir is not None:
+                self._cleanup_tempdir(tmpdir)
+
+    def _abort_rendering(self, output_filenames):
+        """Clean up after a cancelled rendering: rollback the current
+        database transaction and remove the given partial output files,
+        created by the rendering."""
+        LOG.warning('Rendering cancelled, removing output files %s...'
+                    % ', '.join(output_filenames))
+        try:
+            self._db.rollback()
+        except psycopg2.Error:
+            LOG.exception('Could not rollback the database transaction')
 
-    def _render_one(self, config, tmpdir, renderer_cls,
-                    output_format, output_filename, osm_date, file_prefix):
+        for output_filename in output_filenames:
+            if os.path.exists(output_filename):
+                os.remove(output_filename)
 
-        LOG.info('Rendering to %s format...' % output_format.upper())
+    def _get_output_dpi(self, config, output_format):
+        """Return the resolution at which the pages are laid out for the
+        given output format."""
+        if output_format == 'png':
+            if config.preview:
+                return self._get_preview_dpi(config)
+            return self._get_png_dpi()
+        return layoutlib.commons.PT_PER_INCH
 
-        factory = None
-        dpi = layoutlib.commons.PT_PER_INCH
+    def _get_gzip_level(self):
+        try:
+            return int(self._parser.get('rendering', 'gzip_level'))
+        except ConfigParser.NoOptionError:
+            return compression.DEFAULT_LEVEL
 
+    def _get_gzip_threads(self):
+        try:
+            return int(self._parser.get('rendering', 'gzip_threads'))
+        except ConfigParser.NoOptionError:
+            return OCitySMap.DEFAULT_GZIP_THREADS
+
+    def _open_compressed_output(self, output_filename):
+        return compression.CompressedOutputFile(output_filename,
+                                                self._get_gzip_level(),
+                                                self._get_gzip_threads())
+
+    def _create_output_surface(self, output_format, output_filename,
+                               dpi, w, h):
+        """Return the Cairo surface writing a page of w x h points into
+        the given file, in the given output format (None for CSV), and the
+        compressed file it writes to (None for uncompressed formats)."""
         if output_format == 'png':
-            try:
-                dpi = int(self._parser.get('rendering', 'png_dpi'))
-            except ConfigParser.NoOptionError:
-                dpi = OCitySMap.DEFAULT_RENDERING_PNG_DPI
-
             # As strange as it may seem, we HAVE to use a vector
             # device here and not a raster device such as
             # ImageSurface. Because, for some reason, with
             # ImageSurface, the font metrics would NOT match those
             # pre-computed by renderer_cls.__init__() and used to
             # layout the whole page
-            def factory(w,h):
-                w_px = int(layoutlib.commons.convert_pt_to_dots(w, dpi))
-                h_px = int(layoutlib.commons.convert_pt_to_dots(h, dpi))
-                LOG.debug("Rendering PNG into %dpx x %dpx area..."
-                          % (w_px, h_px))
-                return cairo.PDFSurface(None, w_px, h_px)
-
+            w_px = int(layoutlib.commons.convert_pt_to_dots(w, dpi))
+            h_px = int(layoutlib.commons.convert_pt_to_dots(h, dpi))
+            LOG.debug("Rendering PNG into %dpx x %dpx area..."
+                      % (w_px, h_px))
+            return cairo.PDFSurface(None, w_px, h_px), None
         elif output_format == 'svg':
-            factory = lambda w,h: cairo.SVGSurface(output_filename, w, h)
+            return cairo.SVGSurface(output_filename, w, h), None
         elif output_format == 'svgz':
-            factory = lambda w,h: cairo.SVGSurface(
-                    gzip.GzipFile(output_filename, 'wb'), w, h)
+            output_file = self._open_compressed_output(output_filename)
+            return cairo.SVGSurface(output_file, w, h), output_file
         elif output_format == 'pdf':
-            factory = lambda w,h: cairo.PDFSurface(output_filename, w, h)
+            return cairo.PDFSurface(output_filename, w, h), None
         elif output_format == 'ps':
-            factory = lambda w,h: cairo.PSSurface(output_filename, w, h)
+            return cairo.PSSurface(output_filename, w, h), None
         elif output_format == 'ps.gz':
-            factory = lambda w,h: cairo.PSSurface(
-                gzip.GzipFile(output_filename, 'wb'), w, h)
+            output_file = self._open_compressed_output(output_filename)
+            return cairo.PSSurface(output_file, w, h), output_file
         elif output_format == 'csv':
             # We don't render maps into CSV.
-            return
-
+            return None, None
         else:
             raise ValueError, \
                 'Unsupported output format: %s!' % output_format.upper()
 
-        renderer = renderer_cls(self._db, config, tmpdir, dpi, file_prefix)
-
-        surface = factory(renderer.paper_width_pt, renderer.paper_height_pt)
-
-        renderer.render(surface, dpi, osm_date)
-
+    @staticmethod
+    def _write_output_surface(surface, output_file, output_format,
+                              output_filename):
         LOG.debug('Writing %s...' % output_filename)
         if output_format == 'png':
             surface.write_to_png(output_filename)
 
         surface.finish()
+        if output_file is not None:
+            output_file.close()
+
+    def _render_one(self, config, tmpdir, renderer_cls,
+                    output_format, output_filename, osm_date, file_prefix):
+
+        LOG.info('Rendering to %s format...' % output_format.upper())
+
+        dpi = self._get_output_dpi(config, output_format)
+        if output_format == 'csv':
+            # We don't render maps into CSV.
+            return
+
+        renderer = renderer_cls(self._db, config, tmpdir, dpi, file_prefix)
+
+        surface, output_file = self._create_output_surface(
+            output_format, output_filename, dpi,
+            renderer.paper_width_pt, renderer.paper_height_pt)
+
+        try:
+            renderer.render(surface, dpi, osm_date)
+
+            if config.cancellation is not None:
+                config.cancellation.check()
+
+            self._write_output_surface(surface, output_file, output_format,
+                                       output_filename)
+        finally:
+            # Stop the compression threads even if the drawing failed
+            if output_file is not None:
+                output_file.close()
+
+    def _render_recorded(self, config, tmpdir, renderer_cls,
+                         output_formats, dpi, osm_date, file_prefix):
+        """Render the page once into a Cairo recording surface, and replay
+        the recording into each of the given output formats, laid out at
+        the same resolution, one after the other.
+
+        The output surfaces read the shared recording when it is painted,
+        and again when they are finished (PDF, PS, SVG) or written (PNG),
+        which is most of the work of the replay: the formats are not
+        replayed concurrently. Only the compression of the SVGZ and PS.GZ
+        files (see compression.CompressedOutputFile) runs in the
+        background."""
+
+        LOG.info('Rendering to %s formats...'
+                 % ', '.join(f.upper() for f in output_formats))
+
+        renderer = renderer_cls(self._db, config, tmpdir, dpi, file_prefix)
+        w_pt, h_pt = renderer.paper_width_pt, renderer.paper_height_pt
+
+        recording = cairo.RecordingSurface(
+            cairo.CONTENT_COLOR_ALPHA,
+            (0, 0, layoutlib.commons.convert_pt_to_dots(w_pt, dpi),
+             layoutlib.commons.convert_pt_to_dots(h_pt, dpi)))
+        renderer.render(recording, dpi, osm_date)
+
+        if config.cancellation is not None:
+            config.cancellation.check()
+
+        for output_format in output_formats:
+            output_filename = '%s.%s' % (file_prefix, output_format)
+            surface, output_file = self._create_output_surface(
+                output_format, output_filename, dpi, w_pt, h_pt)
+            try:
+                ctx = cairo.Context(surface)
+                ctx.set_source_surface(recording)
+                ctx.paint()
+                del ctx
+                self._write_output_surface(surface, output_file,
+                                           output_format, output_filename)
+            finally:
+                # Stop the compression threads even if the replay failed
+                if output_file is not None:
+                    output_file.close()
+
+            if config.cancellation is not None:
+                config.cancellation.check()
 
 if __name__ == '__main__':
     logging.basicConfig(level=logging.DEBUG)
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+
+# ocitysmap, city map and street index generator from OpenStreetMap data
+# Copyright (C) 2010  David Decotigny
+# Copyright (C) 2010  Frédéric Lehobey
+# Copyright (C) 2010  Pierre Mauduit
+# Copyright (C) 2010  David Mentré
+# Copyright (C) 2010  Maxime Petazzoni
+# Copyright (C) 2010  Thomas Petazzoni
+# Copyright (C) 2010  Gaël Utard
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+import threading
+import time
+
+LOG = logging.getLogger('ocitysmap')
+
+
+class RenderingCancelledError(Exception):
+    """This exception is raised when a rendering is cancelled, or when its
+    deadline is exceeded."""
+    pass
+
+
+class CancellationToken:
+    """
+    A CancellationToken is given to OCitySMap.render() to stop a rendering
+    before its end. It is cancelled explicitly with cancel(), possibly from
+    another thread, or when its deadline is exceeded.
+
+    The rendering pipeline checks the token between its stages and between
+    the pages of multi-page documents. Callbacks can be registered to
+    interrupt long-running operations, such as database queries, as soon
+    as the token is cancelled.
+    """
+
+    def __init__(self, deadline=None):
+        """
+        Args:
+           deadline (float): None or the time (as returned by time.time())
+               after which the rendering is cancelled.
+        """
+        self._deadline  = deadline
+        self._cancelled = False
+        self._callbacks = []
+        self._lock      = threading.Lock()
+
+    @staticmethod
+    def with_timeout(timeout_s):
+        """Return a new CancellationToken expiring in timeout_s seconds."""
+        return CancellationToken(time.time() + timeout_s)
+
+    @property
+    def deadline(self):
+        return self._deadline
+
+    def remaining(self):
+        """Return the number of seconds before the deadline, or None if
+        there is no deadline."""
+        if self._deadline is None:
+            return None
+        return max(0, self._deadline - time.time())
+
+    def cancel(self):
+        """Cancel the rendering and run the registered callbacks."""
+        with self._lock:
+            if self._cancelled:
+                return
+            self._cancelled = True
+            callbacks = list(self._callbacks)
+
+        LOG.info('Cancelling rendering...')
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception:
+                LOG.exception('Error in cancellation callback')
+
+    def is_cancelled(self):
+        return self._cancelled or (self._deadline is not None
+                                   and time.time() >= self._deadline)
+
+    def check(self):
+        """Raise RenderingCancelledError if the rendering was cancelled or
+        its deadline is exceeded."""
+        if self._cancelled:
+            raise RenderingCancelledError, 'Rendering cancelled'
+        if self._deadline is not None and time.time() >= self._deadline:
+            raise RenderingCancelledError, 'Rendering deadline exceeded'
+
+    def add_callback(self, callback):
+        """Register a function called, without argument, when the token is
+        cancelled."""
+        with self._lock:
+            self._callbacks.append(callback)
+
+    def remove_callback(self, callback):
+        with self._lock:
+            if callback in self._callbacks:
+                self._callbacks.remove(callback)
@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+
+# ocitysmap, city map and street index generator from OpenStreetMap data
+# Copyright (C) 2010  David Decotigny
+# Copyright (C) 2010  Frédéric Lehobey
+# Copyright (C) 2010  Pierre Mauduit
+# Copyright (C) 2010  David Mentré
+# Copyright (C) 2010  Maxime Petazzoni
+# Copyright (C) 2010  Thomas Petazzoni
+# Copyright (C) 2010  Gaël Utard
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import gzip
+import logging
+import Queue
+import struct
+import threading
+import time
+import zlib
+from multiprocessing.pool import ThreadPool
+
+LOG = logging.getLogger('ocitysmap')
+
+DEFAULT_LEVEL = 9
+
+
+class CompressedOutputFile:
+    """
+    A CompressedOutputFile is a write-only file object writing gzip data,
+    given to the Cairo surfaces of the compressed output formats (SVGZ,
+    PS.GZ).
+
+    Without threads, the data is compressed by gzip.GzipFile on the
+    writing thread. With threads, it is cut into blocks compressed
+    concurrently by a pool of threads while the caller keeps drawing, and
+    written in order by a background thread as a single gzip member (the
+    blocks are independent deflate streams ended by a sync flush, the way
+    pigz does). The number of pending blocks is bounded, so a fast writer
+    eventually waits for the compressors.
+
+    close() must be called once the surface is finished, or when the
+    drawing fails: it flushes the last block, stops the background
+    threads and re-raises their errors.
+    """
+
+    BLOCK_SIZE = 1024 * 1024
+
+    def __init__(self, filename, level=DEFAULT_LEVEL, threads=0):
+        """
+        Args:
+           filename (str): path of the file to write.
+           level (int): compression level, from 1 (fastest) to 9 (smallest).
+           threads (int): number of compression threads, 0 to compress on
+               the writing thread.
+        """
+        if not 1 <= level <= 9:
+            raise ValueError, 'Invalid compression level: %d' % level
+        if threads < 0:
+            raise ValueError, \
+                'Invalid number of compression threads: %d' % threads
+
+        self._level   = level
+        self._threads = threads
+
+        if not threads:
+            self._gzip = gzip.GzipFile(filename, 'wb', level)
+            return
+
+        self._gzip    = None
+        self._file    = open(filename, 'wb')
+        self._buffer  = []
+        self._pending = 0
+        self._error   = None
+        self._pool    = ThreadPool(threads)
+        self._blocks  = Queue.Queue(2 * threads)
+        self._writer  = threading.Thread(target=self._write_blocks,
+                                         name='gzip-writer')
+        self._writer.daemon = True
+
+        self._file.write(struct.pack('<BBBBIBB', 0x1f, 0x8b, 8, 0,
+                                     int(time.time()), 0, 255))
+        self._writer.start()
+
+    @staticmethod
+    def _deflate(data, level, last):
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+        return compressor.compress(data) + compressor.flush(
+            zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+    def _queue_block(self, last):
+        data = ''.join(self._buffer)
+        self._buffer  = []
+        self._pending = 0
+        self._blocks.put((data, self._pool.apply_async(
+                    self._deflate, (data, self._level, last))))
+
+    def _write_blocks(self):
+        crc, size = 0, 0
+        try:
+            while True:
+                item = self._blocks.get()
+                if item is None:
+                    break
+                data, result = item
+                self._file.write(result.get())
+                crc = zlib.crc32(data, crc)
+                size += len(data)
+            self._file.write(struct.pack('<II', crc & 0xffffffffL,
+                                         size & 0xffffffffL))
+        except Exception, ex:
+            self._error = ex
+            # Keep consuming the blocks so that write() never blocks
+            while item is not None:
+                item = self._blocks.get()
+
+    def write(self, data):
+        if self._gzip is not None:
+            self._gzip.write(data)
+            return
+
+        if self._file.closed:
+            raise ValueError, 'I/O operation on closed file'
+        if self._error is not None:
+            raise self._error
+        self._buffer.append(data)
+        self._pending += len(data)
+        if self._pending >= self.BLOCK_SIZE:
+            self._queue_block(False)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self._gzip is not None:
+            self._gzip.close()
+            return
+
+        if self._file.closed:
+            return
+        try:
+            self._queue_block(True)
+            self._blocks.put(None)
+            self._writer.join()
+        finally:
+            self._pool.close()
+            self._file.close()
+        if self._error is not None:
+            raise self._error
@@ -22,19 +22,10 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import collections
 import math
 
-import shapely.wkt
-
-# Importing mapnik2 raises a DeprecationWarning as of mapnik
-# commit 14700dba. As mapnik 2.1 (or git version with support for
-# placement-type="simple") is required for OCitySMap (see INSTALL),
-# instead of importing mapnik2, we import mapnik and assert it isn't
-# an old version.
-import mapnik
-assert mapnik.mapnik_version >= 200100, \
-    "Mapnik module version %s is too old, see ocitysmap's INSTALL " \
-    "for more details." % mapnik.mapnik_version_string()
+from ocitysmap.lazy_modules import shapely
 
 _MAPNIK_PROJECTION = "+proj=merc +a=6378137 +b=6378137 +lat_ts=0.0 " \
                      "+lon_0=0.0 +x_0=0.0 +y_0=0 +k=1.0 +units=m   " \
@@ -43,6 +34,64 @@ _MAPNIK_PROJECTION = "+proj=merc +a=6378137 +b=6378137 +lat_ts=0.0 " \
 
 EARTH_RADIUS = 6370986 # meters
 
+# Radius of the sphere of the spherical Mercator projection above
+MERCATOR_RADIUS = 6378137. # meters
+
+# Point of the spherical Mercator projection, in meters
+MercatorCoord = collections.namedtuple('MercatorCoord', ['x', 'y'])
+
+
+# The spherical Mercator projection (_MAPNIK_PROJECTION) computed directly,
+# without Mapnik. Each function converts a whole sequence of coordinates,
+# the longitudes only depending on the X coordinates and the latitudes on
+# the Y coordinates.
+
+def longitudes_to_mercator(longitudes):
+    """Return the list of the Mercator X coordinates of the given
+    longitudes."""
+    return [MERCATOR_RADIUS * math.radians(long_) for long_ in longitudes]
+
+def latitudes_to_mercator(latitudes):
+    """Return the list of the Mercator Y coordinates of the given
+    latitudes."""
+    return [MERCATOR_RADIUS
+            * math.log(math.tan(math.pi / 4 + math.radians(lat) / 2))
+            for lat in latitudes]
+
+def mercator_to_longitudes(xs):
+    """Return the list of the longitudes of the given Mercator X
+    coordinates."""
+    return [math.degrees(x / MERCATOR_RADIUS) for x in xs]
+
+def mercator_to_latitudes(ys):
+    """Return the list of the latitudes of the given Mercator Y
+    coordinates."""
+    return [math.degrees(2 * math.atan(math.exp(y / MERCATOR_RADIUS))
+                         - math.pi / 2)
+            for y in ys]
+
+def bboxes_to_mercator(bboxes):
+    """Return the list of the Mercator envelopes (minx, miny, maxx, maxy
+    tuples) of the given BoundingBox objects."""
+    minxs = longitudes_to_mercator([bbox._long1 for bbox in bboxes])
+    maxxs = longitudes_to_mercator([bbox._long2 for bbox in bboxes])
+    minys = latitudes_to_mercator([bbox._lat2 for bbox in bboxes])
+    maxys = latitudes_to_mercator([bbox._lat1 for bbox in bboxes])
+    return zip(minxs, minys, maxxs, maxys)
+
+def mercator_to_bboxes(envelopes):
+    """Return the list of the BoundingBox objects of the given Mercator
+    envelopes (minx, miny, maxx, maxy tuples)."""
+    if not envelopes:
+        return []
+    minxs, minys, maxxs, maxys = zip(*envelopes)
+    return [BoundingBox(lat1, long1, lat2, long2)
+            for long1, lat1, long2, lat2
+            in zip(mercator_to_longitudes(minxs),
+                   mercator_to_latitudes(minys),
+                   mercator_to_longitudes(maxxs),
+                   mercator_to_latitudes(maxys))]
+
 
 class Point:
     def __init__(self, lat, long_):
@@ -171,17 +220,24 @@ class BoundingBox:
         return (int(math.ceil(pix_y)), int(math.ceil(pix_x)))
 
     def to_mercator(self):
-        envelope = mapnik.Box2d(self.get_top_left()[1],
-                                self.get_top_left()[0],
-                                self.get_bottom_right()[1],
-                                self.get_bottom_right()[0])
-        _proj = mapnik.Projection(_MAPNIK_PROJECTION)
-        bottom_left = _proj.forward(mapnik.Coord(envelope.minx, envelope.miny))
-        top_right = _proj.forward(mapnik.Coord(envelope.maxx, envelope.maxy))
-        top_left = mapnik.Coord(bottom_left.x, top_right.y)
-        bottom_right = mapnik.Coord(top_right.x, bottom_left.y)
+        minx, miny, maxx, maxy = self.to_mercator_envelope()
+        bottom_left = MercatorCoord(minx, miny)
+        top_right = MercatorCoord(maxx, maxy)
+        top_left = MercatorCoord(minx, maxy)
+        bottom_right = MercatorCoord(maxx, miny)
         return (bottom_right, bottom_left, top_left, top_right)
 
+    def to_mercator_envelope(self):
+        """Return the Mercator envelope of the bounding box, as a (minx,
+        miny, maxx, maxy) tuple in meters."""
+        return bboxes_to_mercator([self])[0]
+
+    @staticmethod
+    def from_mercator_envelope(minx, miny, maxx, maxy):
+        """Returns a BoundingBox object from a Mercator envelope given in
+        meters."""
+        return mercator_to_bboxes([(minx, miny, maxx, maxy)])[0]
+
     def as_javascript(self, name=None, color=None):
         if name:
             name_str = ", \"%s\"" % name
@@ -23,10 +23,9 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import cairo
-import pango
-import pangocairo
+import threading
 
+from ocitysmap.lazy_modules import cairo, pango, pangocairo
 import ocitysmap.layoutlib.commons as commons
 
 def draw_text(ctx, pc, layout, fascent, fheight,
@@ -144,16 +143,68 @@ def draw_simpletext_center(ctx, text, x, y):
     ctx.restore()
 
 def draw_dotted_line(ctx, line_width, baseline_x, baseline_y, length):
-    ctx.set_line_width(line_width)
-    ctx.set_dash([line_width, line_width*2])
-    ctx.move_to(baseline_x, baseline_y)
-    ctx.rel_line_to(length, 0)
-    ctx.stroke()
+    draw_dotted_lines(ctx, [(line_width, baseline_x, baseline_y, length)])
+
+def draw_dotted_lines(ctx, lines):
+    """Draw the given horizontal dotted lines, with a single path and
+    stroke for all the lines of the same width.
+
+    Args:
+       ctx (cairo.Context): The cairo context to use to draw.
+       lines (list): (line_width, baseline_x, baseline_y, length) tuples.
+    """
+    lines_by_width = {}
+    for line_width, baseline_x, baseline_y, length in lines:
+        lines_by_width.setdefault(line_width, []).append(
+            (baseline_x, baseline_y, length))
+
+    for line_width, width_lines in sorted(lines_by_width.items()):
+        ctx.set_line_width(line_width)
+        ctx.set_dash([line_width, line_width*2])
+        for baseline_x, baseline_y, length in width_lines:
+            ctx.move_to(baseline_x, baseline_y)
+            ctx.rel_line_to(length, 0)
+        ctx.stroke()
+
+# Font sizes found by adjust_font_size(), by (text, layout width, font,
+# constraint_x, constraint_y, context resolution and font options), dropped
+# when FONT_SIZE_CACHE_SIZE is exceeded
+FONT_SIZE_CACHE_SIZE = 1000
+_font_size_cache = {}
+_font_size_cache_lock = threading.Lock()
+
+# Number of bisection steps refining the font size computed from a first
+# measurement of the text in adjust_font_size()
+FONT_SIZE_BISECTION_STEPS = 3
+
+def _get_context_key(layout):
+    """Return the properties of the Pango context of the given layout the
+    text metrics depend on: its resolution (the dpi of the output) and its
+    font options."""
+    context = layout.get_context()
+    options = pangocairo.context_get_font_options(context)
+    if options is not None:
+        options = (options.get_antialias(), options.get_hint_metrics(),
+                   options.get_hint_style(), options.get_subpixel_order())
+    return (pangocairo.context_get_resolution(context), options)
+
+def _text_fits(layout, fd, size, constraint_x, constraint_y):
+    fd.set_size(max(int(size), 1))
+    layout.set_font_description(fd)
+    width, height = layout.get_size()
+    return (width / pango.SCALE < constraint_x and
+            height / pango.SCALE < constraint_y)
 
 def adjust_font_size(layout, fd, constraint_x, constraint_y):
     """
-    Grow the given font description (20% by 20%) until it fits in
-    designated area and then draw it.
+    Set the given font description to the largest size for which the text
+    of the layout fits in the designated area.
+
+    The text is measured at the current font size, the size is scaled
+    according to this measurement and then refined by a few bisection
+    steps, the text size being almost, but not exactly, proportional to
+    the font size. The results are cached, so that the same text in the
+    same area is not measured again.
 
     Args:
        layout (pango.Layout): The text block parameters.
@@ -161,15 +212,46 @@ def adjust_font_size(layout, fd, constraint_x, constraint_y):
        constraint_x/constraint_y (numbers): The area we want to
            write into (cairo units).
     """
-    while (layout.get_size()[0] / pango.SCALE < constraint_x and
-           layout.get_size()[1] / pango.SCALE < constraint_y):
-        fd.set_size(int(fd.get_size()*1.2))
+    start_fd = fd.copy()
+    start_fd.set_size(pango.SCALE)
+    key = (layout.get_text(), layout.get_width(), start_fd.to_string(),
+           constraint_x, constraint_y, _get_context_key(layout))
+    with _font_size_cache_lock:
+        size = _font_size_cache.get(key)
+
+    if size is None:
         layout.set_font_description(fd)
-    fd.set_size(int(fd.get_size()/1.2))
+        width, height = [max(x / float(pango.SCALE), 1e-3)
+                         for x in layout.get_size()]
+        size = fd.get_size() * min(constraint_x / width,
+                                   constraint_y / height)
+
+        # Find a fitting lower bound and a non-fitting upper bound around
+        # the estimate, then bisect between them
+        low = high = size
+        while _text_fits(layout, fd, high, constraint_x, constraint_y):
+            low, high = high, high * 1.2
+        while (low >= 1 and
+               not _text_fits(layout, fd, low, constraint_x, constraint_y)):
+            low, high = low / 1.2, low
+        for i in xrange(FONT_SIZE_BISECTION_STEPS):
+            middle = (low + high) / 2.
+            if _text_fits(layout, fd, middle, constraint_x, constraint_y):
+                low = middle
+            else:
+                high = middle
+        size = max(int(low), 1)
+
+        with _font_size_cache_lock:
+            if len(_font_size_cache) >= FONT_SIZE_CACHE_SIZE:
+                _font_size_cache.clear()
+            _font_size_cache[key] = size
+
+    fd.set_size(size)
     layout.set_font_description(fd)
 
 def draw_text_adjusted(ctx, text, x, y, width, height, max_char_number=None,
-                       text_color=(0, 0, 0, 1), align=pango.ALIGN_CENTER,
+                       text_color=(0, 0, 0, 1), align=None,
                        width_adjust=0.7, height_adjust=0.8):
     """
     Draw a text adjusted to a maximum character number
@@ -181,7 +263,11 @@ def draw_text_adjusted(ctx, text, x, y, width, height, max_char_number=None,
        width/height (numbers): The area we want to
            write into (cairo units).
        max_char_number (number): If set a maximum character number.
+       align (pango.Alignment): alignment of the text, defaults to
+           pango.ALIGN_CENTER.
     """
+    if align is None:
+        align = pango.ALIGN_CENTER
     pc = pangocairo.CairoContext(ctx)
     layout = pc.create_layout()
     layout.set_width(int(width_adjust * width * pango.SCALE))
@@ -24,17 +24,68 @@
 
 import re
 import gettext
-
-def _install_language(language, locale_path):
-    t = gettext.translation(domain='ocitysmap',
-                            localedir=locale_path,
-                            languages=[language],
-                            fallback=True)
-    t.install(unicode=True)
+import locale
+import threading
+
+# Translation objects, by (language, locale_path), shared by all the
+# i18n instances of the process
+_translations = {}
+_translations_lock = threading.Lock()
+
+def _get_translation(language, locale_path):
+    """Return the gettext translation object of the given language, loading
+    its catalog only the first time."""
+    key = (language, locale_path)
+    with _translations_lock:
+        t = _translations.get(key)
+        if t is None:
+            t = gettext.translation(domain='ocitysmap',
+                                    localedir=locale_path,
+                                    languages=[language],
+                                    fallback=True)
+            _translations[key] = t
+    return t
+
+# Results of i18n.normalize_street_names(), by (i18n class, language
+# code, LC_COLLATE locale), each cache being dropped when it exceeds
+# NORMALIZED_NAMES_CACHE_SIZE street names
+NORMALIZED_NAMES_CACHE_SIZE = 100000
+_normalized_names = {}
+_normalized_names_lock = threading.Lock()
+
+def _unaccent_table(letters):
+    """Return a unicode.translate() table mapping each accented letter of
+    the given {accented letters: letter} dict, in lower and upper case, to
+    its unaccented letter."""
+    table = {}
+    for accented, letter in letters.iteritems():
+        for c in accented:
+            table[ord(c)] = letter
+            table[ord(c.upper())] = letter
+    return table
 
 class i18n:
     """Functions needed to be implemented for a new language.
        See i18n_fr_FR_UTF8 below for an example. """
+
+    # Set by the constructors of the actual languages
+    _translation = gettext.NullTranslations()
+
+    # Accented letters replaced by upper_unaccent_string(), see
+    # _unaccent_table()
+    UNACCENT_TABLE = {}
+
+    def gettext(self, message):
+        """Return the unicode translation of message in this language.
+           Used instead of a global _() function, so that concurrent
+           renderings may use different languages."""
+        return self._translation.ugettext(message)
+
+    def ungettext(self, singular, plural, n):
+        """Return the unicode translation of the singular or plural
+           message, depending on n, in this language."""
+        return self._translation.ungettext(singular, plural, n)
+
     def language_code(self):
         pass
 
@@ -48,19 +99,58 @@ class i18n:
         return False
 
     def upper_unaccent_string(self, s):
-        return s.upper()
+        return s.translate(self.UNACCENT_TABLE).upper()
+
+    def normalize_street_names(self, names):
+        """Return, for each of the given street names, a tuple
+           (display_name, category_key, collation_key): the name as shown
+           in the index (see user_readable_street()), the name of its index
+           category (see upper_unaccent_string(), the names are grouped
+           with first_letter_equal()) and its sort key in the current
+           LC_COLLATE locale (see locale.strxfrm()).
+
+           The results are kept in a bounded cache shared by the instances
+           of the same language and the same LC_COLLATE locale, the caller
+           being responsible for setting LC_COLLATE to the locale of this
+           language."""
+        key = (self.__class__, self.language_code(),
+               locale.getlocale(locale.LC_COLLATE))
+        with _normalized_names_lock:
+            cache = _normalized_names.setdefault(key, {})
+
+        result = []
+        missing = {}
+        for name in names:
+            normalized = cache.get(name)
+            if normalized is None:
+                normalized = missing.get(name)
+            if normalized is None:
+                display_name = self.user_readable_street(name)
+                normalized = (display_name,
+                              self.upper_unaccent_string(display_name[:1]),
+                              locale.strxfrm(
+                                  display_name.lower().encode('utf-8')))
+                missing[name] = normalized
+            result.append(normalized)
+
+        if missing:
+            with _normalized_names_lock:
+                if len(cache) + len(missing) > NORMALIZED_NAMES_CACHE_SIZE:
+                    cache.clear()
+                cache.update(missing)
+        return result
 
 class i18n_template_code_CODE(i18n):
     def __init__(self, language, locale_path):
-        """Install the _() function for the chosen locale other
-           object initialisation"""
+        """Load the translations of the chosen locale (see gettext())
+           and other object initialisation"""
 
         # It's important to convert to str() here because the map_language
         # value coming from the database is Unicode, but setlocale() needs a
         # non-unicode string as the locale name, otherwise it thinks it's a
         # locale tuple.
         self.language = str(language)
-        _install_language(language, locale_path)
+        self._translation = _get_translation(language, locale_path)
 
     def language_code(self):
         """returns the language code of the specific language
@@ -113,25 +203,18 @@ class i18n_fr_generic(i18n):
                                                                  | re.UNICODE)
 
     # for IndexPageGenerator.upper_unaccent_string
-    E_ACCENT = re.compile(ur"[éèêëẽ]", re.IGNORECASE | re.UNICODE)
-    I_ACCENT = re.compile(ur"[íìîïĩ]", re.IGNORECASE | re.UNICODE)
-    A_ACCENT = re.compile(ur"[áàâäãæ]", re.IGNORECASE | re.UNICODE)
-    O_ACCENT = re.compile(ur"[óòôöõœ]", re.IGNORECASE | re.UNICODE)
-    U_ACCENT = re.compile(ur"[úùûüũ]", re.IGNORECASE | re.UNICODE)
-    Y_ACCENT = re.compile(ur"[ÿ]", re.IGNORECASE | re.UNICODE)
+    UNACCENT_TABLE = _unaccent_table({
+        u"éèêëẽ": u"e",
+        u"íìîïĩ": u"i",
+        u"áàâäãæ": u"a",
+        u"óòôöõœ": u"o",
+        u"úùûüũ": u"u",
+        u"ÿ": u"y"
+    })
 
     def __init__(self, language, locale_path):
         self.language = str(language)
-        _install_language(language, locale_path)
-
-    def upper_unaccent_string(self, s):
-        s = self.E_ACCENT.sub("e", s)
-        s = self.I_ACCENT.sub("i", s)
-        s = self.A_ACCENT.sub("a", s)
-        s = self.O_ACCENT.sub("o", s)
-        s = self.U_ACCENT.sub("u", s)
-        s = self.Y_ACCENT.sub("y", s)
-        return s.upper()
+        self._translation = _get_translation(language, locale_path)
 
     def language_code(self):
         return self.language
@@ -159,23 +242,17 @@ class i18n_it_generic(i18n):
                                                                  | re.UNICODE)
 
     # for IndexPageGenerator.upper_unaccent_string
-    E_ACCENT = re.compile(ur"[éèêëẽ]", re.IGNORECASE | re.UNICODE)
-    I_ACCENT = re.compile(ur"[íìîïĩ]", re.IGNORECASE | re.UNICODE)
-    A_ACCENT = re.compile(ur"[áàâäã]", re.IGNORECASE | re.UNICODE)
-    O_ACCENT = re.compile(ur"[óòôöõ]", re.IGNORECASE | re.UNICODE)
-    U_ACCENT = re.compile(ur"[úùûüũ]", re.IGNORECASE | re.UNICODE)
+    UNACCENT_TABLE = _unaccent_table({
+        u"éèêëẽ": u"e",
+        u"íìîïĩ": u"i",
+        u"áàâäã": u"a",
+        u"óòôöõ": u"o",
+        u"úùûüũ": u"u"
+    })
 
     def __init__(self, language, locale_path):
         self.language = str(language)
-        _install_language(language, locale_path)
-
-    def upper_unaccent_string(self, s):
-        s = self.E_ACCENT.sub("e", s)
-        s = self.I_ACCENT.sub("i", s)
-        s = self.A_ACCENT.sub("a", s)
-        s = self.O_ACCENT.sub("o", s)
-        s = self.U_ACCENT.sub("u", s)
-        return s.upper()
+        self._translation = _get_translation(language, locale_path)
 
     def language_code(self):
         return self.language
@@ -205,25 +282,18 @@ class i18n_es_generic(i18n):
                                                                  | re.UNICODE)
 
     # for IndexPageGenerator.upper_unaccent_string
-    E_ACCENT = re.compile(ur"[éèêëẽ]", re.IGNORECASE | re.UNICODE)
-    I_ACCENT = re.compile(ur"[íìîïĩ]", re.IGNORECASE | re.UNICODE)
-    A_ACCENT = re.compile(ur"[áàâäã]", re.IGNORECASE | re.UNICODE)
-    O_ACCENT = re.compile(ur"[óòôöõ]", re.IGNORECASE | re.UNICODE)
-    U_ACCENT = re.compile(ur"[úùûüũ]", re.IGNORECASE | re.UNICODE)
-    N_ACCENT = re.compile(ur"[ñ]", re.IGNORECASE | re.UNICODE)
+    UNACCENT_TABLE = _unaccent_table({
+        u"éèêëẽ": u"e",
+        u"íìîïĩ": u"i",
+        u"áàâäã": u"a",
+        u"óòôöõ": u"o",
+        u"úùûüũ": u"u",
+        u"ñ": u"n"
+    })
 
     def __init__(self, language, locale_path):
         self.language = str(language)
-        _install_language(language, locale_path)
-
-    def upper_unaccent_string(self, s):
-        s = self.E_ACCENT.sub("e", s)
-        s = self.I_ACCENT.sub("i", s)
-        s = self.A_ACCENT.sub("a", s)
-        s = self.O_ACCENT.sub("o", s)
-        s = self.U_ACCENT.sub("u", s)
-        s = self.N_ACCENT.sub("n", s)
-        return s.upper()
+        self._translation = _get_translation(language, locale_path)
 
     def language_code(self):
         return self.language
@@ -329,27 +399,19 @@ class i18n_ca_generic(i18n):
                                                                  | re.UNICODE)
 
     # for IndexPageGenerator.upper_unaccent_string
-    E_ACCENT = re.compile(ur"[éèêëẽ]", re.IGNORECASE | re.UNICODE)
-    I_ACCENT = re.compile(ur"[íìîïĩ]", re.IGNORECASE | re.UNICODE)
-    A_ACCENT = re.compile(ur"[áàâäã]", re.IGNORECASE | re.UNICODE)
-    O_ACCENT = re.compile(ur"[óòôöõ]", re.IGNORECASE | re.UNICODE)
-    U_ACCENT = re.compile(ur"[úùûüũ]", re.IGNORECASE | re.UNICODE)
-    N_ACCENT = re.compile(ur"[ñ]", re.IGNORECASE | re.UNICODE)
-    C_ACCENT = re.compile(ur"[ç]", re.IGNORECASE | re.UNICODE)
+    UNACCENT_TABLE = _unaccent_table({
+        u"éèêëẽ": u"e",
+        u"íìîïĩ": u"i",
+        u"áàâäã": u"a",
+        u"óòôöõ": u"o",
+        u"úùûüũ": u"u",
+        u"ñ": u"n",
+        u"ç": u"c"
+    })
 
     def __init__(self, language, locale_path):
         self.language = str(language)
-        _install_language(language, locale_path)
-
-    def upper_unaccent_string(self, s):
-        s = self.E_ACCENT.sub("e", s)
-        s = self.I_ACCENT.sub("i", s)
-        s = self.A_ACCENT.sub("a", s)
-        s = self.O_ACCENT.sub("o", s)
-        s = self.U_ACCENT.sub("u", s)
-        s = self.N_ACCENT.sub("n", s)
-        s = self.C_ACCENT.sub("c", s)
-        return s.upper()
+        self._translation = _get_translation(language, locale_path)
 
     def language_code(self):
         return self.language
@@ -384,23 +446,17 @@ class i18n_pt_br_generic(i18n):
                                                                  | re.UNICODE)
 
     # for IndexPageGenerator.upper_unaccent_string
-    E_ACCENT = re.compile(ur"[éèêëẽ]", re.IGNORECASE | re.UNICODE)
-    I_ACCENT = re.compile(ur"[íìîïĩ]", re.IGNORECASE | re.UNICODE)
-    A_ACCENT = re.compile(ur"[áàâäã]", re.IGNORECASE | re.UNICODE)
-    O_ACCENT = re.compile(ur"[óòôöõ]", re.IGNORECASE | re.UNICODE)
-    U_ACCENT = re.compile(ur"[úùûüũ]", re.IGNORECASE | re.UNICODE)
+    UNACCENT_TABLE = _unaccent_table({
+        u"éèêëẽ": u"e",
+        u"íìîïĩ": u"i",
+        u"áàâäã": u"a",
+        u"óòôöõ": u"o",
+        u"úùûüũ": u"u"
+    })
 
     def __init__(self, language, locale_path):
         self.language = str(language)
-        _install_language(language, locale_path)
-
-    def upper_unaccent_string(self, s):
-        s = self.E_ACCENT.sub("e", s)
-        s = self.I_ACCENT.sub("i", s)
-        s = self.A_ACCENT.sub("a", s)
-        s = self.O_ACCENT.sub("o", s)
-        s = self.U_ACCENT.sub("u", s)
-        return s.upper()
+        self._translation = _get_translation(language, locale_path)
 
     def language_code(self):
         return self.language
@@ -431,15 +487,13 @@ class i18n_ar_generic(i18n):
                                                                  | re.UNICODE)
 
     # for IndexPageGenerator.upper_unaccent_string
-    A_ACCENT = re.compile(ur"[اإآ]", re.IGNORECASE | re.UNICODE)
+    UNACCENT_TABLE = _unaccent_table({
+        u"اإآ": u"أ"
+    })
 
     def __init__(self, language, locale_path):
         self.language = str(language)
-        _install_language(language, locale_path)
-
-    def upper_unaccent_string(self, s):
-        s = self.A_ACCENT.sub("أ", s)
-        return s.upper()
+        self._translation = _get_translation(language, locale_path)
 
     def language_code(self):
         return self.language
@@ -512,7 +566,7 @@ class i18n_ru_generic(i18n):
 
     def __init__(self, language, locale_path):
         self.language = str(language)
-        _install_language(language, locale_path)
+        self._translation = _get_translation(language, locale_path)
 
     def upper_unaccent_string(self, s):
         # usually, there are no accents in russian names, only "ё" sometimes, but
@@ -595,7 +649,7 @@ class i18n_be_generic(i18n):
 
     def __init__(self, language, locale_path):
         self.language = str(language)
-        _install_language(language, locale_path)
+        self._translation = _get_translation(language, locale_path)
 
     def upper_unaccent_string(self, s):
         return s.upper()
@@ -671,23 +725,17 @@ class i18n_nl_generic(i18n):
                                       re.IGNORECASE | re.UNICODE)
 
     # for IndexPageGenerator.upper_unaccent_string
-    E_ACCENT = re.compile(ur"[éèêëẽ]", re.IGNORECASE | re.UNICODE)
-    I_ACCENT = re.compile(ur"[íìîïĩ]", re.IGNORECASE | re.UNICODE)
-    A_ACCENT = re.compile(ur"[áàâäã]", re.IGNORECASE | re.UNICODE)
-    O_ACCENT = re.compile(ur"[óòôöõ]", re.IGNORECASE | re.UNICODE)
-    U_ACCENT = re.compile(ur"[úùûüũ]", re.IGNORECASE | re.UNICODE)
+    UNACCENT_TABLE = _unaccent_table({
+        u"éèêëẽ": u"e",
+        u"íìîïĩ": u"i",
+        u"áàâäã": u"a",
+        u"óòôöõ": u"o",
+        u"úùûüũ": u"u"
+    })
 
     def __init__(self, language, locale_path):
         self.language = str(language)
-        _install_language(language, locale_path)
-
-    def upper_unaccent_string(self, s):
-        s = self.E_ACCENT.sub("e", s)
-        s = self.I_ACCENT.sub("i", s)
-        s = self.A_ACCENT.sub("a", s)
-        s = self.O_ACCENT.sub("o", s)
-        s = self.U_ACCENT.sub("u", s)
-        return s.upper()
+        self._translation = _get_translation(language, locale_path)
 
     def language_code(self):
         return self.language
@@ -719,27 +767,24 @@ class i18n_nl_generic(i18n):
 
 class i18n_hr_HR(i18n):
     # for upper_unaccent_string
-    C_ACCENT = re.compile(ur"[ćč]", re.IGNORECASE | re.UNICODE)
-    D_ACCENT = re.compile(ur"đ|dž", re.IGNORECASE | re.UNICODE)
-    N_ACCENT = re.compile(ur"nj", re.IGNORECASE | re.UNICODE)
-    L_ACCENT = re.compile(ur"lj", re.IGNORECASE | re.UNICODE)
-    S_ACCENT = re.compile(ur"š", re.IGNORECASE | re.UNICODE)
-    Z_ACCENT = re.compile(ur"ž", re.IGNORECASE | re.UNICODE)
+    # the digraphs dž, nj and lj are reduced to their first letter before
+    # the remaining accented letters are translated
+    DIGRAPHS = re.compile(ur"(?<=d)ž|(?<=[nl])j", re.IGNORECASE | re.UNICODE)
+    UNACCENT_TABLE = _unaccent_table({
+        u"ćč": u"c",
+        u"đ": u"d",
+        u"š": u"s",
+        u"ž": u"z"
+    })
 
     def upper_unaccent_string(self, s):
-        s = self.C_ACCENT.sub("c", s)
-        s = self.D_ACCENT.sub("d", s)
-        s = self.N_ACCENT.sub("n", s)
-        s = self.L_ACCENT.sub("l", s)
-        s = self.S_ACCENT.sub("s", s)
-        s = self.Z_ACCENT.sub("z", s)
-        return s.upper()
+        return i18n.upper_unaccent_string(self, self.DIGRAPHS.sub(u"", s))
 
     def __init__(self, language, locale_path):
         """Install the _() function for the chosen locale other
            object initialisation"""
         self.language = str(language) # FIXME: why do we have unicode here?
-        _install_language(language, locale_path)
+        self._translation = _get_translation(language, locale_path)
 
     def language_code(self):
         """returns the language code of the specific language
@@ -778,7 +823,7 @@ class i18n_pl_generic(i18n):
 
     def __init__(self, language, locale_path):
         self.language = str(language)
-        _install_language(language, locale_path)
+        self._translation = _get_translation(language, locale_path)
 
     def language_code(self):
         return self.language
@@ -819,7 +864,7 @@ class i18n_tr_generic(i18n):
 
     def __init__(self, language, locale_path):
         self.language = str(language)
-        _install_language(language, locale_path)
+        self._translation = _get_translation(language, locale_path)
 
     def upper_unaccent_string(self, s):
         return s.upper()
@@ -872,23 +917,17 @@ class i18n_de_generic(i18n):
                                                                  | re.UNICODE)
 
     # for IndexPageGenerator.upper_unaccent_string
-    E_ACCENT = re.compile(ur"[éèêëẽ]", re.IGNORECASE | re.UNICODE)
-    I_ACCENT = re.compile(ur"[íìîïĩ]", re.IGNORECASE | re.UNICODE)
-    A_ACCENT = re.compile(ur"[áàâäã]", re.IGNORECASE | re.UNICODE)
-    O_ACCENT = re.compile(ur"[óòôöõ]", re.IGNORECASE | re.UNICODE)
-    U_ACCENT = re.compile(ur"[úùûüũ]", re.IGNORECASE | re.UNICODE)
+    UNACCENT_TABLE = _unaccent_table({
+        u"éèêëẽ": u"e",
+        u"íìîïĩ": u"i",
+        u"áàâäã": u"a",
+        u"óòôöõ": u"o",
+        u"úùûüũ": u"u"
+    })
 
     def __init__(self, language, locale_path):
         self.language = str(language)
-        _install_language(language, locale_path)
-
-    def upper_unaccent_string(self, s):
-        s = self.E_ACCENT.sub("e", s)
-        s = self.I_ACCENT.sub("i", s)
-        s = self.A_ACCENT.sub("a", s)
-        s = self.O_ACCENT.sub("o", s)
-        s = self.U_ACCENT.sub("u", s)
-        return s.upper()
+        self._translation = _get_translation(language, locale_path)
 
     def language_code(self):
         return self.language
@@ -979,29 +1018,20 @@ class i18n_ast_generic(i18n):
                                                                  | re.UNICODE)
 
     # for IndexPageGenerator.upper_unaccent_string
-    E_ACCENT = re.compile(ur"[éèêëẽ]", re.IGNORECASE | re.UNICODE)
-    I_ACCENT = re.compile(ur"[íìîïĩ]", re.IGNORECASE | re.UNICODE)
-    A_ACCENT = re.compile(ur"[áàâäã]", re.IGNORECASE | re.UNICODE)
-    O_ACCENT = re.compile(ur"[óòôöõ]", re.IGNORECASE | re.UNICODE)
-    U_ACCENT = re.compile(ur"[úùûüũ]", re.IGNORECASE | re.UNICODE)
-    N_ACCENT = re.compile(ur"[ñ]", re.IGNORECASE | re.UNICODE)
-    H_ACCENT = re.compile(ur"[ḥ]", re.IGNORECASE | re.UNICODE)
-    L_ACCENT = re.compile(ur"[ḷ]", re.IGNORECASE | re.UNICODE)
+    UNACCENT_TABLE = _unaccent_table({
+        u"éèêëẽ": u"e",
+        u"íìîïĩ": u"i",
+        u"áàâäã": u"a",
+        u"óòôöõ": u"o",
+        u"úùûüũ": u"u",
+        u"ñ": u"n",
+        u"ḥ": u"h",
+        u"ḷ": u"l"
+    })
 
     def __init__(self, language, locale_path):
         self.language = str(language)
-        _install_language(language, locale_path)
-
-    def upper_unaccent_string(self, s):
-        s = self.E_ACCENT.sub("e", s)
-        s = self.I_ACCENT.sub("i", s)
-        s = self.A_ACCENT.sub("a", s)
-        s = self.O_ACCENT.sub("o", s)
-        s = self.U_ACCENT.sub("u", s)
-        s = self.N_ACCENT.sub("n", s)
-        s = self.H_ACCENT.sub("h", s)
-        s = self.L_ACCENT.sub("l", s)
-        return s.upper()
+        self._translation = _get_translation(language, locale_path)
 
     def language_code(self):
         return self.language
@@ -1018,7 +1048,7 @@ class i18n_ast_generic(i18n):
 class i18n_generic(i18n):
     def __init__(self, language, locale_path):
         self.language = str(language)
-        _install_language(language, locale_path)
+        self._translation = _get_translation(language, locale_path)
 
     def language_code(self):
         return self.language
@@ -1115,10 +1145,23 @@ language_class_map = {
     'be_BY.UTF-8': i18n_be_generic,
 }
 
+# i18n instances, by (locale_name, locale_path)
+_i18n_instances = {}
+_i18n_instances_lock = threading.Lock()
+
 def install_translation(locale_name, locale_path):
-    """Return a new i18n class instance, depending on the specified
-    locale name (eg. "fr_FR.UTF-8"). See output of "locale -a" for a
-    list of system-supported locale names. When none matching, default
-    class is i18n_generic"""
-    language_class = language_class_map.get(locale_name, i18n_generic)
-    return language_class(locale_name, locale_path)
+    """Return the i18n class instance of the specified locale name (eg.
+    "fr_FR.UTF-8"). See output of "locale -a" for a list of
+    system-supported locale names. When none matching, default class is
+    i18n_generic. Instances are created once per process and shared by
+    all the renderings: messages are translated with their gettext()
+    method, no global _() function is installed."""
+    key = (locale_name, locale_path)
+    with _i18n_instances_lock:
+        instance = _i18n_instances.get(key)
+        if instance is None:
+            language_class = language_class_map.get(locale_name,
+                                                    i18n_generic)
+            instance = language_class(locale_name, locale_path)
+            _i18n_instances[key] = instance
+    return instance
@@ -91,5 +91,41 @@ class i18n_be_generic_test(unittest.TestCase):
         for fr, to in conversions:
             self.assertEqual(to, self.r.user_readable_street(fr))
 
+class normalize_street_names_test(unittest.TestCase):
+    def test_upper_unaccent_string(self):
+        fr = i18n.i18n_fr_generic('fr_FR.UTF-8', '')
+        self.assertEqual(u"EEOE", fr.upper_unaccent_string(u"ÉéœÈ"))
+        hr = i18n.i18n_hr_HR('hr_HR.UTF-8', '')
+        self.assertEqual(u"DNLDZ", hr.upper_unaccent_string(u"DžnjLJđž"))
+        ar = i18n.i18n_ar_generic('ar_EG.UTF-8', '')
+        self.assertEqual(u"أ", ar.upper_unaccent_string(u"إ"))
+
+    def test_normalize(self):
+        fr = i18n.i18n_fr_generic('fr_FR.UTF-8', '')
+        names = [u"Rue de l'Église", u"Allée Émile Zola", u"Rue de l'Église"]
+        result = fr.normalize_street_names(names)
+        self.assertEqual(3, len(result))
+        self.assertEqual(u"Église (Rue de l')", result[0][0])
+        self.assertEqual(u"E", result[0][1])
+        self.assertEqual(u"E", result[1][1])
+        self.assertTrue(result[0] is result[2])
+        self.assertTrue(result[0] is fr.normalize_street_names(names)[0])
+
+class install_translation_test(unittest.TestCase):
+    def test_instances_are_shared(self):
+        a = i18n.install_translation('ru_RU.UTF-8', '')
+        b = i18n.install_translation('ru_RU.UTF-8', '')
+        self.assertTrue(a is b)
+        self.assertTrue(isinstance(a, i18n.i18n_ru_generic))
+        self.assertFalse(a is i18n.install_translation('be_BY.UTF-8', ''))
+
+    def test_gettext_is_not_global(self):
+        import __builtin__
+        had_builtin = hasattr(__builtin__, '_')
+        r = i18n.install_translation('ru_RU.UTF-8', '')
+        self.assertEqual(u"Villages", r.gettext(u"Villages"))
+        self.assertTrue(isinstance(r.gettext("Villages"), unicode))
+        self.assertEqual(had_builtin, hasattr(__builtin__, '_'))
+
 if __name__ == '__main__':
     unittest.main()
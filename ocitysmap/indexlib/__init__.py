@@ -26,7 +26,7 @@ if __name__ == '__main__':
     import cairo
     import logging
     import os
-    import psycopg2
+    from ocitysmap.lazy_modules import psycopg2
     import random
     import string
 
@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+
+# ocitysmap, city map and street index generator from OpenStreetMap data
+# Copyright (C) 2012  David Mentré
+# Copyright (C) 2012  Thomas Petazzoni
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import cPickle
+import hashlib
+import logging
+import os
+import tempfile
+import zlib
+
+import commons
+
+l = logging.getLogger('ocitysmap')
+
+
+class StreetIndexCache:
+    """
+    The StreetIndexCache keeps the raw contents of the street indexes
+    (category names, item labels and endpoints) on disk, so that
+    rendering the same area again, on another paper size, with another
+    layout or another stylesheet, does not hit the database.
+
+    Entries are keyed by the polygon of interest, the language, the
+    strategy used to compute the endpoints of the items, the map scale
+    the area of interest is simplified for (see StreetIndex) and the
+    date of the last update of the OSM database: a cache without a known
+    OSM database date would never be invalidated, so it is disabled.
+    Grid locations are not stored, they are computed again by
+    StreetIndex.apply_grid() for each rendering.
+    """
+
+    # Bump this whenever the serialized format changes
+    FORMAT_VERSION = 1
+
+    def __init__(self, cache_dir, osm_date, endpoints=None):
+        """
+        Args:
+           cache_dir (str): directory holding the cache entries, created
+               if needed.
+           osm_date (datetime or None): date of the last update of the
+               OSM database (see OCitySMap.get_osm_database_last_update()).
+           endpoints (str): None or the strategy used to compute the
+               endpoints of the items (see StreetIndex).
+        """
+        self._cache_dir = cache_dir
+        self._osm_date  = osm_date
+        self._endpoints = endpoints
+
+        if self._osm_date is None:
+            l.warning('OSM database date unknown, index cache disabled.')
+            return
+
+        if not os.path.isdir(self._cache_dir):
+            try:
+                os.makedirs(self._cache_dir)
+            except OSError, ex:
+                l.warning('Cannot create index cache directory %s: %s'
+                          % (self._cache_dir, ex))
+
+    @property
+    def enabled(self):
+        return self._osm_date is not None and os.path.isdir(self._cache_dir)
+
+    def _get_path(self, polygon_wkt, language, scale):
+        key = hashlib.sha1()
+        key.update(str(StreetIndexCache.FORMAT_VERSION))
+        key.update('\0%s' % polygon_wkt)
+        key.update('\0%s' % language)
+        key.update('\0%s' % self._endpoints)
+        key.update('\0%s' % scale)
+        key.update('\0%s' % self._osm_date.isoformat())
+        return os.path.join(self._cache_dir, '%s.idx' % key.hexdigest())
+
+    def load(self, polygon_wkt, language, page_number=None, scale=None):
+        """Return the list of IndexCategory objects stored for the given
+        polygon, language and scale, or None if there is no such entry.
+
+        Args:
+           polygon_wkt (str): the WKT of the polygon of interest.
+           language (str): the language the index was built for.
+           page_number (int or None): page number given to the items
+               (multi-page renderer only).
+           scale (int or None): the scale denominator the area was
+               simplified for.
+        """
+        if not self.enabled:
+            return None
+
+        path = self._get_path(polygon_wkt, language, scale)
+        try:
+            with open(path, 'rb') as f:
+                data = cPickle.loads(zlib.decompress(f.read()))
+        except IOError:
+            return None
+        except Exception, ex:
+            l.warning('Ignoring corrupted index cache entry %s: %s'
+                      % (path, ex))
+            return None
+
+        l.debug('Using cached index %s.' % path)
+
+        store = commons.IndexStore()
+        categories = []
+        for name, is_street, items in data:
+            category = commons.IndexCategory(name, is_street=is_street)
+            for label, latlong1, latlong2 in items:
+                category.items.append(store.add(label, latlong1, latlong2,
+                                                page_number))
+            categories.append(category)
+        return categories
+
+    def store(self, polygon_wkt, language, categories, scale=None):
+        """Store the given list of IndexCategory objects in the cache.
+
+        Args:
+           polygon_wkt (str): the WKT of the polygon of interest.
+           language (str): the language the index was built for.
+           categories (list): the IndexCategory objects to store.
+           scale (int or None): the scale denominator the area was
+               simplified for.
+        """
+        if not self.enabled:
+            return
+
+        def latlong(point):
+            if point is None:
+                return None
+            return point.get_latlong()
+
+        data = [(category.name, category.is_street,
+                 [(item.label, latlong(item.endpoint1),
+                   latlong(item.endpoint2))
+                  for item in category.items])
+                for category in categories]
+
+        # Write to a temporary file first, so that concurrent renderings
+        # never see a partially written entry
+        path = self._get_path(polygon_wkt, language, scale)
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=self._cache_dir,
+                                            suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                f.write(zlib.compress(cPickle.dumps(data,
+                                                    cPickle.HIGHEST_PROTOCOL)))
+            os.rename(tmp_path, path)
+        except (IOError, OSError), ex:
+            l.warning('Cannot write index cache entry %s: %s' % (path, ex))
+            return
+
+        l.debug('Stored index in cache %s.' % path)
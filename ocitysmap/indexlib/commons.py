@@ -22,12 +22,16 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import array
 import os
-import pango
 import sys
+import threading
+
+from ocitysmap.lazy_modules import pango
 
 sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
 import draw_utils
+import coords
 
 
 class IndexEmptyError(Exception):
@@ -41,6 +45,8 @@ class IndexDoesNotFitError(Exception):
 
 NUMBER_CATEGORY_NAME = '0-9'
 
+_NAN = float('nan')
+
 class IndexCategory:
     """
     The IndexCategory represents a set of index items that belong to the same
@@ -64,8 +70,28 @@ class IndexCategory:
         return 'IndexCategory(%s, %s)' % (repr(self.name),
                                           repr(self.items))
 
+    def get_background_rectangle(self, layout, fascent, fheight,
+                                 baseline_x, baseline_y):
+        """Return the (x, y, width, height) rectangle of the background of
+        this category header (see draw() for the arguments)."""
+        return (baseline_x, baseline_y - fascent,
+                layout.get_width() / pango.SCALE, fheight)
+
+    @staticmethod
+    def draw_backgrounds(ctx, rectangles):
+        """Fill the given header background rectangles, with a single
+        path and fill."""
+        if not rectangles:
+            return
+        ctx.save()
+        ctx.set_source_rgb(0.9, 0.9, 0.9)
+        for rectangle in rectangles:
+            ctx.rectangle(*rectangle)
+        ctx.fill()
+        ctx.restore()
+
     def draw(self, rtl, ctx, pc, layout, fascent, fheight,
-             baseline_x, baseline_y):
+             baseline_x, baseline_y, draw_background=True):
         """Draw this category header.
 
         Args:
@@ -77,14 +103,15 @@ class IndexCategory:
             fheight (int): font height.
             baseline_x (int): base X axis position.
             baseline_y (int): base Y axis position.
+            draw_background (boolean): whether to draw the background of
+                the header, or only its text (see draw_index_entries()).
         """
 
-        ctx.save()
-        ctx.set_source_rgb(0.9, 0.9, 0.9)
-        ctx.rectangle(baseline_x, baseline_y - fascent,
-                      layout.get_width() / pango.SCALE, fheight)
-        ctx.fill()
+        if draw_background:
+            self.draw_backgrounds(ctx, [self.get_background_rectangle(
+                        layout, fascent, fheight, baseline_x, baseline_y)])
 
+        ctx.save()
         ctx.set_source_rgb(0.0, 0.0, 0.0)
         draw_utils.draw_text_center(ctx, pc, layout, fascent, fheight,
                                     baseline_x, baseline_y, self.name)
@@ -97,26 +124,169 @@ class IndexCategory:
         return [x.squares for x in self.items]
 
 
-class IndexItem:
+class IndexStore:
+    """
+    The IndexStore holds the fields of many index items in parallel arrays
+    (the endpoints as arrays of floats), instead of one Python object per
+    item and per endpoint. IndexItem objects are lightweight views on one
+    entry of a store: huge indexes (hundreds of thousands of items) only
+    cost a few small objects per item.
+
+    Missing endpoints are stored as NaN, missing page numbers as -1.
+    """
+
+    def __init__(self):
+        self.labels        = []
+        self.location_strs = []
+        self.latitudes1    = array.array('d')
+        self.longitudes1   = array.array('d')
+        self.latitudes2    = array.array('d')
+        self.longitudes2   = array.array('d')
+        self.page_numbers  = array.array('l')
+        self._lock         = threading.Lock()
+
+    def __len__(self):
+        return len(self.labels)
+
+    def add(self, label, latlong1, latlong2, page_number=None):
+        """Store a new item and return its IndexItem view.
+
+        Args:
+           label (str): the item label.
+           latlong1, latlong2 (tuple): None or the (lat, long) of the
+               endpoints of the item.
+           page_number (int): None or the page number of the item
+               (multi-page renderer only).
+        """
+        return IndexItem.view(self, self._append(label, latlong1, latlong2,
+                                                 page_number))
+
+    def _append(self, label, latlong1, latlong2, page_number):
+        """Store a new item and return its position in the store (see
+        add())."""
+        assert label is not None
+        lat1, long1 = latlong1 or (_NAN, _NAN)
+        lat2, long2 = latlong2 or (_NAN, _NAN)
+        with self._lock:
+            index = len(self.labels)
+            self.labels.append(label)
+            self.location_strs.append(None)
+            self.latitudes1.append(float(lat1))
+            self.longitudes1.append(float(long1))
+            self.latitudes2.append(float(lat2))
+            self.longitudes2.append(float(long2))
+            self.page_numbers.append(-1 if page_number is None
+                                     else page_number)
+        return index
+
+    def get_latlong1(self, index):
+        lat = self.latitudes1[index]
+        if lat != lat:
+            return None
+        return lat, self.longitudes1[index]
+
+    def set_latlong1(self, index, latlong):
+        lat, long = latlong or (_NAN, _NAN)
+        self.latitudes1[index]  = float(lat)
+        self.longitudes1[index] = float(long)
+
+    def get_latlong2(self, index):
+        lat = self.latitudes2[index]
+        if lat != lat:
+            return None
+        return lat, self.longitudes2[index]
+
+    def set_latlong2(self, index, latlong):
+        lat, long = latlong or (_NAN, _NAN)
+        self.latitudes2[index]  = float(lat)
+        self.longitudes2[index] = float(long)
+
+
+class IndexItem(object):
     """
     An IndexItem represents one item in the index (a street or a POI). It
     contains the item label (street name, POI name or description) and the
     humanized squares description.
+
+    The fields of the item live in an IndexStore (see IndexStore.add()),
+    the IndexItem is only a view on them. Items created directly have a
+    store of their own, freed with them.
     """
-    __slots__    = ['label', 'endpoint1', 'endpoint2', 'location_str']
-    label        = None # str
-    endpoint1    = None # coords.Point
-    endpoint2    = None # coords.Point
-    location_str = None # str or None
-    page_number  = None # integer or None. Only used by multi-page renderer.
+    __slots__ = ['_store', '_index']
 
     def __init__(self, label, endpoint1, endpoint2, page_number=None):
-        assert label is not None
-        self.label        = label
-        self.endpoint1    = endpoint1
-        self.endpoint2    = endpoint2
-        self.location_str = None
-        self.page_number  = page_number
+        """
+        Args:
+           label (str): the item label.
+           endpoint1, endpoint2 (coords.Point): None or the endpoints of
+               the item.
+           page_number (int): None or the page number of the item. Only
+               used by multi-page renderer.
+        """
+        self._store = IndexStore()
+        self._index = self._store._append(
+            label, endpoint1 and endpoint1.get_latlong(),
+            endpoint2 and endpoint2.get_latlong(), page_number)
+
+    @classmethod
+    def view(cls, store, index):
+        """Return the IndexItem viewing the given entry of an IndexStore."""
+        item = cls.__new__(cls)
+        item._store = store
+        item._index = index
+        return item
+
+    def _get_label(self):
+        return self._store.labels[self._index]
+
+    def _set_label(self, label):
+        self._store.labels[self._index] = label
+
+    label = property(_get_label, _set_label) # str
+
+    def _get_location_str(self):
+        return self._store.location_strs[self._index]
+
+    def _set_location_str(self, location_str):
+        self._store.location_strs[self._index] = location_str
+
+    location_str = property(_get_location_str,
+                            _set_location_str) # str or None
+
+    def _get_page_number(self):
+        page_number = self._store.page_numbers[self._index]
+        if page_number < 0:
+            return None
+        return page_number
+
+    def _set_page_number(self, page_number):
+        self._store.page_numbers[self._index] = \
+            -1 if page_number is None else page_number
+
+    page_number = property(_get_page_number,
+                           _set_page_number) # integer or None
+
+    def _get_endpoint1(self):
+        latlong = self._store.get_latlong1(self._index)
+        return latlong and coords.Point(*latlong)
+
+    def _set_endpoint1(self, endpoint):
+        self._store.set_latlong1(self._index,
+                                 endpoint and endpoint.get_latlong())
+
+    endpoint1 = property(_get_endpoint1,
+                         _set_endpoint1) # coords.Point or None
+
+    def _get_endpoint2(self):
+        latlong = self._store.get_latlong2(self._index)
+        return latlong and coords.Point(*latlong)
+
+    def _set_endpoint2(self, endpoint):
+        self._store.set_latlong2(self._index,
+                                 endpoint and endpoint.get_latlong())
+
+    endpoint2 = property(_get_endpoint2,
+                         _set_endpoint2) # coords.Point or None
 
     def __str__(self):
         return '%s...%s' % (self.label, self.location_str)
@@ -140,7 +310,8 @@ class IndexItem:
 
     def draw(self, rtl, ctx, pc, column_layout, fascent, fheight,
              baseline_x, baseline_y,
-             label_layout=None, label_height=0, location_width=0):
+             label_layout=None, label_height=0, location_width=0,
+             leaders=None):
         """Draw this index item to the provided Cairo context. It prints the
         label, the squares definition and the dotted line, with respect to the
         RTL setting.
@@ -161,6 +332,9 @@ class IndexItem:
                 rendering, in case the label should be wrapped
             label_height (int): height of the big label
             location_width (int): width of the 'location' part
+            leaders (list): None, or the list the dotted line is appended
+                to, as a (line_width, x, y, length) tuple, instead of being
+                drawn (see draw_utils.draw_dotted_lines())
         """
 
         # Fallbacks in case we dont't have a wrapping label
@@ -198,9 +372,12 @@ class IndexItem:
 
         # In case of empty label, we don't draw the dots
         if self.label != '':
-            draw_utils.draw_dotted_line(ctx, max(fheight/12, 1),
-                                        line_start + fheight/4, baseline_y,
-                                        line_end - line_start - fheight/2)
+            leader = (max(fheight/12, 1), line_start + fheight/4, baseline_y,
+                      line_end - line_start - fheight/2)
+            if leaders is not None:
+                leaders.append(leader)
+            else:
+                draw_utils.draw_dotted_line(ctx, *leader)
         ctx.restore()
 
     def update_location_str(self, grid):
@@ -214,12 +391,14 @@ class IndexItem:
         Returns:
            Nothing, but the location_str field will have been altered
         """
-        if self.endpoint1 is not None:
-            ep1_label = grid.get_location_str( * self.endpoint1.get_latlong())
+        latlong1 = self._store.get_latlong1(self._index)
+        latlong2 = self._store.get_latlong2(self._index)
+        if latlong1 is not None:
+            ep1_label = grid.get_location_str(*latlong1)
         else:
             ep1_label = None
-        if self.endpoint2 is not None:
-            ep2_label = grid.get_location_str( * self.endpoint2.get_latlong())
+        if latlong2 is not None:
+            ep2_label = grid.get_location_str(*latlong2)
         else:
             ep2_label = None
         if ep1_label is None:
@@ -246,6 +425,35 @@ class IndexItem:
                 self.location_str = "%d, %s" % (self.page_number,
                                                 self.location_str)
 
+
+def draw_index_entries(rtl, ctx, pc, headers, items):
+    """Draw the given category headers and index items, with a single fill
+    for all the header backgrounds and a single stroke for all the dotted
+    lines of the items, instead of one per entry.
+
+    Args:
+        rtl (boolean): whether to draw right-to-left or not.
+        ctx (cairo.Context): the Cairo context to draw to.
+        pc (pangocairo.CairoContext): the PangoCairo context.
+        headers (list): (IndexCategory, args) tuples, args being the
+            arguments of IndexCategory.draw() following pc.
+        items (list): (IndexItem, args) tuples, args being the arguments
+            of IndexItem.draw() following pc.
+    """
+    IndexCategory.draw_backgrounds(
+        ctx, [category.get_background_rectangle(*args)
+              for category, args in headers])
+    for category, args in headers:
+        category.draw(rtl, ctx, pc, *args, draw_background=False)
+
+    leaders = []
+    for item, args in items:
+        item.draw(rtl, ctx, pc, *args, leaders=leaders)
+
+    ctx.save()
+    draw_utils.draw_dotted_lines(ctx, leaders)
+    ctx.restore()
+
 if __name__ == "__main__":
     import cairo
     import pangocairo
@@ -23,48 +23,222 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
+import collections
 import csv
 import datetime
+import hashlib
 from itertools import groupby
 import locale
 import logging
 import os
-import psycopg2
+import Queue
+import re
+import sys
+import threading
+import weakref
+
+# psycopg2 returns unicode strings, see lazy_modules
+from ocitysmap.lazy_modules import psycopg2, shapely
 
-import psycopg2.extensions
-# compatibility with django: see http://code.djangoproject.com/ticket/5996
-psycopg2.extensions.register_type(psycopg2.extensions.UNICODE)
 # SQL string escaping routine
 _sql_escape_unicode = lambda s: psycopg2.extensions.adapt(s.encode('utf-8'))
 
 import commons
 import ocitysmap
+import street_table
 
 l = logging.getLogger('ocitysmap')
 
+# Size (on paper) of the details of the area of interest that can be
+# dropped before querying the database: they would not be visible on
+# the map anyway.
+AREA_SIMPLIFY_TOLERANCE_MM = 0.2
+
+# Session temporary table holding the area of interest (see
+# StreetIndex._prepare_area()), and how the queries refer to it.
+AREA_TABLE = 'ocitysmap_index_area'
+AREA_SQL   = '(select way from %s)' % AREA_TABLE
+
+# Whether the PostGIS of each database connection provides ST_ClipByBox2D()
+# (PostGIS >= 2.2), see _has_clip_by_box()
+_clip_by_box_by_db      = weakref.WeakKeyDictionary()
+_clip_by_box_by_db_lock = threading.Lock()
+
+def _has_clip_by_box(db):
+    """Return True if ST_ClipByBox2D() is available on the given database
+    connection. The PostGIS version is only queried once per connection."""
+    with _clip_by_box_by_db_lock:
+        if db in _clip_by_box_by_db:
+            return _clip_by_box_by_db[db]
+
+    cursor = db.cursor()
+    cursor.execute("select postgis_lib_version();")
+    version = cursor.fetchall()[0][0]
+    result = tuple(map(int, re.findall(r'\d+', version)[:2])) >= (2, 2)
+    if not result:
+        l.info("PostGIS %s has no ST_ClipByBox2D(), clipping the index "
+               "items with st_intersection()." % version)
+
+    with _clip_by_box_by_db_lock:
+        _clip_by_box_by_db[db] = result
+    return result
+
+# Placeholders of the geometry columns of the tables that may hold
+# invalid geometries in the index queries (see StreetIndex._execute_query())
+WAY_PLACEHOLDERS = {'line_way':    'planet_osm_line',
+                    'polygon_way': 'planet_osm_polygon'}
+
+# SQL expression repairing an invalid geometry. ST_MakeValid() keeps the
+# type of lines and polygons, unlike a buffer of 0 which turns lines into
+# empty polygons.
+REPAIRED_WAY_SQL = 'ST_MakeValid(way)'
+
+# osm_ids of the geometries found invalid so far, by table, for the last
+# INVALID_WAYS_CACHE_SIZE areas of interest (see StreetIndex._get_ways()):
+# they are repaired in all the following queries of the indexes of the
+# same area.
+INVALID_WAYS_CACHE_SIZE = 1000
+_invalid_osm_ids_by_area      = collections.OrderedDict()
+_invalid_osm_ids_by_area_lock = threading.Lock()
+
+def _get_invalid_osm_ids(area_key, table):
+    """Return the sorted osm_ids of the geometries of the given table
+    known to be invalid in the given area."""
+    with _invalid_osm_ids_by_area_lock:
+        invalid_osm_ids = _invalid_osm_ids_by_area.pop(area_key, None)
+        if invalid_osm_ids is None:
+            return []
+        # Most recently used area last
+        _invalid_osm_ids_by_area[area_key] = invalid_osm_ids
+        return sorted(invalid_osm_ids[table])
+
+def _add_invalid_osm_ids(area_key, table, osm_ids):
+    """Record the given osm_ids of geometries of the given table as
+    invalid in the given area, and return the ones not known before."""
+    with _invalid_osm_ids_by_area_lock:
+        invalid_osm_ids = _invalid_osm_ids_by_area.pop(area_key, None)
+        if invalid_osm_ids is None:
+            invalid_osm_ids = dict((t, set())
+                                   for t in WAY_PLACEHOLDERS.values())
+        _invalid_osm_ids_by_area[area_key] = invalid_osm_ids
+        while len(_invalid_osm_ids_by_area) > INVALID_WAYS_CACHE_SIZE:
+            _invalid_osm_ids_by_area.popitem(last=False)
+
+        new_osm_ids = set(osm_ids) - invalid_osm_ids[table]
+        invalid_osm_ids[table] |= new_osm_ids
+        return new_osm_ids
+
+# SQL expressions of the line between the two endpoints locating the
+# geometry %(geometry)s on the grid (see IndexItem.update_location_str()),
+# by strategy:
+#  - longest_line: the two farthest points of the geometry, comparing all
+#    of its vertices with each other (quadratic in the number of vertices);
+#  - convex_hull: the same points, only comparing the vertices of the
+#    convex hull of the geometry, where they always lie;
+#  - envelope: the diagonal of the bounding box of the geometry, the
+#    item being located on all the squares of the box (cheapest, but may
+#    span more squares than the two other strategies).
+ENDPOINTS_SQL = {
+    'longest_line': 'ST_LongestLine(%(geometry)s, %(geometry)s)',
+    'convex_hull':  'ST_LongestLine(ST_ConvexHull(%(geometry)s), '
+                                   'ST_ConvexHull(%(geometry)s))',
+    'envelope':     'ST_SetSRID(ST_MakeLine('
+                        'ST_MakePoint(ST_XMin(%(geometry)s), '
+                                     'ST_YMin(%(geometry)s)), '
+                        'ST_MakePoint(ST_XMax(%(geometry)s), '
+                                     'ST_YMax(%(geometry)s))), '
+                        'ST_SRID(%(geometry)s))',
+}
+
 
 class StreetIndex:
 
-    def __init__(self, db, polygon_wkt, i18n, page_number=None):
+    # Default strategy used to compute the endpoints of the items, see
+    # ENDPOINTS_SQL
+    DEFAULT_ENDPOINTS = 'convex_hull'
+
+    def __init__(self, db, polygon_wkt, i18n, page_number=None, cache=None,
+                 scale=None, db_pool=None, cancellation=None,
+                 endpoints=None, defer_streets=False):
         """
         Prepare the index of the streets inside the given WKT. This
-        constructor will perform all the SQL queries.
+        constructor will perform all the SQL queries, unless the index
+        is found in the given cache.
 
         Args:
            db (psycopg2 DB): The GIS database
            polygon_wkt (str): The WKT of the surrounding polygon of interest
            i18n (i18n.i18n): Internationalization configuration
+           page_number (int): page number of the items (multi-page only)
+           cache (StreetIndexCache): None or the index cache to use
+           scale (int): None or the scale denominator of the map, used
+              to simplify the area of interest
+           db_pool (psycopg2.pool.ThreadedConnectionPool): None, or a
+              pool of connections to run the queries concurrently
+           cancellation (CancellationToken): None or the token cancelling
+              the queries run on the pooled connections, checked before
+              each query
+           endpoints (str): None or the strategy used to compute the
+              endpoints of the items (see ENDPOINTS_SQL), defaults to
+              DEFAULT_ENDPOINTS
+           defer_streets (bool): only fetch the streets, their conversion
+              being left to finish() (see _convert_street_index())
 
         Note: All the arguments have to be provided !
         """
         self._i18n = i18n
         self._page_number = page_number
+        self._endpoints = endpoints or StreetIndex.DEFAULT_ENDPOINTS
+        self._area_box = None # see _prepare_area()
+        self._area_clip_by_box = False # see _prepare_area()
+        self._cancellation = cancellation
+        self._pending = None # see finish()
+
+        # Key of the area in the record of the invalid geometries (see
+        # _get_invalid_osm_ids())
+        self._area_key = hashlib.sha1(polygon_wkt).hexdigest()
+        if self._endpoints not in ENDPOINTS_SQL:
+            raise ValueError, \
+                'Invalid index endpoints strategy: %s' % self._endpoints
+
+        # Fields of all the index items (see commons.IndexStore)
+        self._store = commons.IndexStore()
+
+        if cache is not None:
+            self._categories = cache.load(polygon_wkt, i18n.language_code(),
+                                          page_number, scale)
+            if self._categories is not None:
+                return
 
         # Build the contents of the index
-        self._categories = \
-            (self._list_streets(db, polygon_wkt)
-             + self._list_amenities(db, polygon_wkt)
-             + self._list_villages(db, polygon_wkt))
+        if db_pool is None:
+            self._prepare_area(db, polygon_wkt, scale)
+            streets = self._fetch_streets(db)
+            others = self._list_amenities(db) + self._list_villages(db)
+        else:
+            streets, others = self._list_all_concurrently(
+                db_pool, polygon_wkt, scale, cancellation)
+
+        self._categories = None
+        self._pending = (streets, others, cache, polygon_wkt, scale)
+        if not defer_streets:
+            self.finish()
+
+    def finish(self):
+        """Convert the streets fetched by an index built with
+        defer_streets, and store the index in the cache. The conversion
+        changes the process-wide LC_COLLATE locale: it must run on the
+        thread of the renderer, not while other threads use the locale.
+        Does nothing when the index is already complete."""
+        if self._pending is None:
+            return
+        streets, others, cache, polygon_wkt, scale = self._pending
+        self._pending = None
+
+        self._categories = self._convert_street_index(streets) + others
+        if cache is not None:
+            cache.store(polygon_wkt, self._i18n.language_code(),
+                        self._categories, scale)
 
     @property
     def categories(self):
@@ -144,7 +318,251 @@ class StreetIndex:
 
         fd.close()
 
-    def _get_selected_amenities(self):
+    def _list_all_concurrently(self, db_pool, polygon_wkt, scale,
+                               cancellation):
+        """Run the streets, amenities and villages queries at the same
+        time, on as many pooled connections as possible. The amenities and
+        villages are converted as soon as they are received, while the
+        other queries are still running. The streets are only fetched:
+        their conversion changes the process-wide LC_COLLATE locale (see
+        finish()).
+
+        Args:
+           db_pool (psycopg2.pool.ThreadedConnectionPool): The pool of
+              connections to the GIS database
+           polygon_wkt (str): The WKT of the surrounding polygon of interest
+           scale (int): None or the scale denominator of the map
+           cancellation (CancellationToken): None or the cancellation token
+
+        Returns the list of the (street_name, linestring_wkt) tuples of the
+        streets, and the list of the commons.IndexCategory objects of the
+        amenities and villages
+        """
+        # gettext is called here, not in the worker threads
+        selected_amenities = self._get_selected_amenities(self._i18n)
+
+        tasks = Queue.Queue()
+        tasks.put((0, self._fetch_streets, ()))
+        for i, (catname, db_amenity, label) in enumerate(selected_amenities):
+            tasks.put((i + 1, self._list_amenity, (catname, db_amenity)))
+        tasks.put((len(selected_amenities) + 1, self._list_villages, ()))
+
+        results = [None] * tasks.qsize()
+        errors  = []
+
+        def worker():
+            db = db_pool.getconn()
+            if cancellation is not None:
+                cancellation.add_callback(db.cancel)
+            try:
+                self._prepare_area(db, polygon_wkt, scale)
+                while not errors:
+                    try:
+                        i, task, args = tasks.get_nowait()
+                    except Queue.Empty:
+                        break
+                    results[i] = task(db, *args)
+            except Exception:
+                errors.append(sys.exc_info())
+                db.rollback()
+            finally:
+                if cancellation is not None:
+                    cancellation.remove_callback(db.cancel)
+                db_pool.putconn(db)
+
+        workers = [threading.Thread(target=worker)
+                   for i in xrange(min(db_pool.maxconn, tasks.qsize()))]
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+
+        if errors:
+            exc_type, exc_value, exc_traceback = errors[0]
+            raise exc_type, exc_value, exc_traceback
+
+        return (results[0],
+                self._group_amenities(selected_amenities, results[1:-1])
+                + results[-1])
+
+    def _prepare_area(self, db, polygon_wkt, scale):
+        """Store the area of interest in a session temporary table, so
+        that it is sent, parsed and projected only once for all the index
+        queries. The polygon is simplified in the map projection with a
+        tolerance derived from the map scale.
+
+        When the area is a rectangle (bounding box renderings), its
+        projected bounds are also kept as an ST_MakeEnvelope() expression,
+        so that the queries filter and clip the geometries with the
+        cheaper bounding box operations instead of generic polygon ones.
+        The geometries are clipped with ST_ClipByBox2D() when the PostGIS
+        version provides it (2.2 and later).
+
+        Args:
+           db (psycopg2 DB): The GIS database
+           polygon_wkt (str): The WKT of the surrounding polygon of interest
+           scale (int): None or the scale denominator of the map
+        """
+        if scale is None:
+            tolerance_m = 0
+        else:
+            tolerance_m = scale * AREA_SIMPLIFY_TOLERANCE_MM / 1000.
+
+        polygon = shapely.wkt.loads(polygon_wkt)
+        wkb = polygon.wkb
+
+        cursor = db.cursor()
+        cursor.execute("drop table if exists pg_temp.%s;" % AREA_TABLE)
+        cursor.execute("""
+create temporary table %s as
+  select st_simplifypreservetopology(
+           st_transform(st_geomfromwkb(%%s, 4002), 900913),
+           %%s) as way;""" % AREA_TABLE,
+                       (psycopg2.Binary(wkb), tolerance_m))
+
+        if polygon.equals(polygon.envelope):
+            cursor.execute("""select st_xmin(way), st_ymin(way),
+                                     st_xmax(way), st_ymax(way)
+                              from %s;""" % AREA_TABLE)
+            self._area_box = ('ST_MakeEnvelope(%r, %r, %r, %r, 900913)'
+                              % cursor.fetchone())
+            self._area_clip_by_box = _has_clip_by_box(db)
+        else:
+            self._area_box = None
+            self._area_clip_by_box = False
+
+        # Commit, so that the table survives the rollbacks done when a
+        # query has to be run again on cleaned geometries
+        db.commit()
+
+        l.debug("Area of interest: %d bytes of WKB, simplified to %.1fm."
+                % (len(wkb), tolerance_m))
+
+    def _get_ways(self, repair_all=False):
+        """Return the SQL expressions replacing the WAY_PLACEHOLDERS in the
+        index queries: the geometry column itself, with the geometries
+        known to be invalid in the area of interest repaired (see
+        REPAIRED_WAY_SQL).
+
+        Args:
+           repair_all (bool): repair all the geometries, whether they are
+               known to be invalid or not.
+        """
+        ways = {}
+        for placeholder, table in WAY_PLACEHOLDERS.iteritems():
+            osm_ids = _get_invalid_osm_ids(self._area_key, table)
+            if repair_all:
+                ways[placeholder] = REPAIRED_WAY_SQL
+            elif osm_ids:
+                ways[placeholder] = ('(case when osm_id in (%s) '
+                                     'then %s else way end)'
+                                     % (','.join(map(str, osm_ids)),
+                                        REPAIRED_WAY_SQL))
+            else:
+                ways[placeholder] = 'way'
+        return ways
+
+    def _find_invalid_ways(self, db):
+        """Look for the invalid geometries of the area of interest and add
+        them to the geometries repaired by the later queries of the index.
+        Only the bounding boxes of the geometries are compared with the
+        area: intersecting the invalid geometries themselves could fail
+        like the index queries.
+
+        Returns the number of invalid geometries found.
+        """
+        cursor = db.cursor()
+        count = 0
+        for table in WAY_PLACEHOLDERS.values():
+            cursor.execute("""select osm_id from %s
+                              where way && %s
+                                    and not st_isvalid(way);"""
+                           % (table, AREA_SQL))
+            osm_ids = _add_invalid_osm_ids(
+                self._area_key, table,
+                [osm_id for osm_id, in cursor.fetchall()])
+            if osm_ids:
+                l.warning("Found %d invalid geometries in %s, repaired in "
+                          "the index queries: %s"
+                          % (len(osm_ids), table,
+                             ', '.join(map(str, sorted(osm_ids)))))
+            count += len(osm_ids)
+        return count
+
+    def _execute_query(self, db, query):
+        """Execute the given index query and return all its rows.
+
+        The geometry columns of the query are given as WAY_PLACEHOLDERS,
+        replaced by the geometries with the known invalid ones repaired
+        (see _get_ways()). They are only used in the clip and endpoints
+        expressions: the conditions filtering the geometries use the raw
+        way column, so that its spatial index applies. If the query still
+        fails, generaly because of inappropriate ways, the invalid
+        geometries of the area are looked for and the query is run again
+        with them repaired. The whole query is only run with all its
+        geometries repaired as a last resort.
+
+        Args:
+           db (psycopg2 DB): The GIS database
+           query (str): the SQL query
+        """
+        if self._cancellation is not None:
+            self._cancellation.check()
+
+        cursor = db.cursor()
+        try:
+            cursor.execute(query % self._get_ways())
+            return cursor.fetchall()
+        except psycopg2.InternalError:
+            db.rollback()
+
+        repair_all = (self._find_invalid_ways(db) == 0)
+        if repair_all:
+            l.warning("Index query failed without invalid geometries to "
+                      "repair, repairing all of them.")
+        cursor.execute(query % self._get_ways(repair_all))
+        return cursor.fetchall()
+
+    @staticmethod
+    def estimate_size(db, bounding_box):
+        """Return a quick estimate of the number of items of the index of
+        the given bounding box. Only the spatial indexes of the tables are
+        used: no geometry is intersected with the area of interest.
+
+        Args:
+           db (psycopg2 DB): The GIS database
+           bounding_box (coords.BoundingBox): the area of interest
+        """
+        (lat1, long1), (lat2, long2) = (bounding_box.get_top_left(),
+                                        bounding_box.get_bottom_right())
+        amenities = tuple(set(db_amenity for catname, db_amenity, label
+                              in StreetIndex._get_selected_amenities()))
+
+        cursor = db.cursor()
+        cursor.execute("""
+select
+  (select count(distinct name) from planet_osm_line
+   where trim(name) != '' and highway is not null
+         and way && %(envelope)s)
+  + (select count(*) from planet_osm_point
+     where trim(name) != '' and amenity in %%(amenities)s
+           and way && %(envelope)s)
+  + (select count(*) from planet_osm_polygon
+     where trim(name) != '' and amenity in %%(amenities)s
+           and way && %(envelope)s)
+  + (select count(*) from planet_osm_point
+     where trim(name) != ''
+           and place in ('locality', 'hamlet', 'isolated_dwelling')
+           and way && %(envelope)s);
+""" % {'envelope': "st_transform(st_makeenvelope(%(long1)s, %(lat2)s, "
+                   "%(long2)s, %(lat1)s, 4002), 900913)"},
+                       {'lat1': lat1, 'long1': long1,
+                        'lat2': lat2, 'long2': long2,
+                        'amenities': amenities})
+        return int(cursor.fetchall()[0][0])
+
+    @staticmethod
+    def _get_selected_amenities(i18n=None):
         """
         Return the kinds of amenities to retrieve from DB as a list of
         string tuples:
@@ -152,29 +570,28 @@ class StreetIndex:
           2. db_amenity, description string stored in the DB
           3. Label, text to display in the index for this amenity
 
-        Note: This has to be a function because gettext() has to be
-        called, which takes i18n into account... It cannot be
-        statically defined as a class attribute for example.
+        Args:
+           i18n (i18n): the language of the categories and labels, or
+              None to leave them untranslated.
         """
-
-        # Make sure gettext is available...
-        try:
-            selected_amenities = [
-                (_(u"Places of worship"), "place_of_worship",
-                 _(u"Place of worship")),
-                (_(u"Education"), "kindergarten", _(u"Kindergarten")),
-                (_(u"Education"), "school", _(u"School")),
-                (_(u"Education"), "college", _(u"College")),
-                (_(u"Education"), "university", _(u"University")),
-                (_(u"Education"), "library", _(u"Library")),
-                (_(u"Public buildings"), "townhall", _(u"Town hall")),
-                (_(u"Public buildings"), "post_office", _(u"Post office")),
-                (_(u"Public buildings"), "public_building",
-                 _(u"Public building")),
-                (_(u"Public buildings"), "police", _(u"Police"))]
-        except NameError:
-            l.exception("i18n has to be initialized beforehand")
-            return []
+        if i18n is not None:
+            _ = i18n.gettext
+        else:
+            _ = lambda message: message
+
+        selected_amenities = [
+            (_(u"Places of worship"), "place_of_worship",
+             _(u"Place of worship")),
+            (_(u"Education"), "kindergarten", _(u"Kindergarten")),
+            (_(u"Education"), "school", _(u"School")),
+            (_(u"Education"), "college", _(u"College")),
+            (_(u"Education"), "university", _(u"University")),
+            (_(u"Education"), "library", _(u"Library")),
+            (_(u"Public buildings"), "townhall", _(u"Town hall")),
+            (_(u"Public buildings"), "post_office", _(u"Post office")),
+            (_(u"Public buildings"), "public_building",
+             _(u"Public building")),
+            (_(u"Public buildings"), "police", _(u"Police"))]
 
         return selected_amenities
 
@@ -200,17 +617,19 @@ class StreetIndex:
         prev_locale = locale.getlocale(locale.LC_COLLATE)
         locale.setlocale(locale.LC_COLLATE, self._i18n.language_code())
         try:
-            sorted_sl = sorted([(self._i18n.user_readable_street(name),
-                                 linestring) for name,linestring in sl],
-                               lambda x,y: locale.strcoll(x[0].lower(),
-                                                          y[0].lower()))
+            normalized = self._i18n.normalize_street_names(
+                [name for name, linestring in sl])
         finally:
             locale.setlocale(locale.LC_COLLATE, prev_locale)
+        sorted_sl = sorted(zip(normalized, [linestring
+                                            for name, linestring in sl]),
+                           key=lambda x: x[0][2])
 
         result = []
         current_category = None
         NUMBER_LIST = [str(i) for i in xrange(10)]
-        for street_name, linestring in sorted_sl:
+        for (street_name, category_key, collation_key), linestring \
+                in sorted_sl:
             # Create new category if needed
             if (not current_category
                or (not self._i18n.first_letter_equal(street_name[0],
@@ -220,7 +639,7 @@ class StreetIndex:
                 if street_name[0] in NUMBER_LIST:
                     cat_name = commons.NUMBER_CATEGORY_NAME
                 else:
-                    cat_name = self._i18n.upper_unaccent_string(street_name[0])
+                    cat_name = category_key
                 current_category = commons.IndexCategory(cat_name)
                 result.append(current_category)
 
@@ -232,87 +651,171 @@ class StreetIndex:
                 l.exception("Error parsing %s for %s" % (repr(linestring),
                                                          repr(street_name)))
                 raise
-            endpoint1 = ocitysmap.coords.Point(s_endpoint1[1], s_endpoint1[0])
-            endpoint2 = ocitysmap.coords.Point(s_endpoint2[1], s_endpoint2[0])
-            current_category.items.append(commons.IndexItem(street_name,
-                                                            endpoint1,
-                                                            endpoint2,
-                                                            self._page_number))
+            current_category.items.append(
+                self._store.add(street_name,
+                                (s_endpoint1[1], s_endpoint1[0]),
+                                (s_endpoint2[1], s_endpoint2[0]),
+                                self._page_number))
 
         return result
 
-    def _list_streets(self, db, polygon_wkt):
-        """Get the list of streets inside the given polygon. Don't
-        try to map them onto the grid of squares (there location_str
-        field remains undefined).
+    def _get_area_filter_sql(self, geometry):
+        """Return the SQL condition selecting the given geometry when it
+        intersects the area of interest. Only the bounding boxes are
+        compared when the area is a rectangle: the geometries outside of
+        the area are then clipped to empty ones (see _get_area_clip_sql())
+        and filtered out of the results."""
+        if self._area_box is None:
+            return 'st_intersects(%s, %s)' % (geometry, AREA_SQL)
+        return '%s && %s' % (geometry, self._area_box)
+
+    def _get_area_clip_sql(self, geometry):
+        """Return the SQL expression of the given geometry clipped to the
+        area of interest.
+
+        Note that ST_ClipByBox2D(), used for the rectangular areas, does
+        not check the validity of its results: clipped polygons may be
+        invalid. They are only used to compute the endpoints of the items
+        (see ENDPOINTS_SQL), which only depend on their vertices."""
+        if self._area_box is None:
+            return 'st_intersection(%s, %s)' % (AREA_SQL, geometry)
+        if not self._area_clip_by_box:
+            return 'st_intersection(%s, %s)' % (self._area_box, geometry)
+        return 'ST_ClipByBox2D(%s, %s)' % (geometry, self._area_box)
+
+    def _get_area_covers_sql(self, geometry):
+        """Return the SQL condition true when the given geometry lies
+        inside the area of interest."""
+        if self._area_box is None:
+            return 'st_coveredby(%s, %s)' % (geometry, AREA_SQL)
+        return '%s @ %s' % (geometry, self._area_box)
+
+    def _get_endpoints_sql(self, geometry):
+        """Return the SQL expression of the line between the endpoints of
+        the given geometry, using the strategy of this index."""
+        return ENDPOINTS_SQL[self._endpoints] % {'geometry': geometry}
+
+    def _list_streets(self, db):
+        """Get the list of streets inside the area of interest (see
+        _prepare_area()). Don't try to map them onto the grid of squares
+        (there location_str field remains undefined).
 
         Args:
            db (psycopg2 DB): The GIS database
-           polygon_wkt (str): The WKT of the surrounding polygon of interest
 
         Returns a list of commons.IndexCategory objects, with their IndexItems
         having no specific grid square location
         """
+        return self._convert_street_index(self._fetch_streets(db))
+
+    def _fetch_streets(self, db):
+        """Run the query of the streets inside the area of interest (see
+        _prepare_area()).
+
+        Args:
+           db (psycopg2 DB): The GIS database
+
+        Returns the list of (street_name, linestring_wkt) tuples expected
+        by _convert_street_index()
+        """
 
-        cursor = db.cursor()
         l.info("Getting streets...")
 
+        if street_table.exists(db):
+            query = self._get_precomputed_streets_query()
+        else:
+            query = self._get_streets_query()
+
+        # l.debug("Street query (nogrid): %s" % query)
+
+        sl = self._execute_query(db, query)
+
+        l.debug("Got %d streets." % len(sl))
+
+        return sl
+
+    def _get_streets_query(self):
+        """Return the query merging the named highways of the area of
+        interest, from the planet_osm_line table."""
         # PostGIS >= 1.5.0 for this to work:
         query = """
 select name,
        --- street_kind, -- only when group by is: group by name, street_kind
-       st_astext(st_transform(ST_LongestLine(street_path, street_path),
+       st_astext(st_transform(%(endpoints)s,
                               4002)) as longest_linestring
 from
   (select name,
           -- highway as street_kind, -- only when group by name, street_kind
-          st_intersection(%(wkb_limits)s,
-                          st_linemerge(st_collect(%%(way)s))) as street_path
+          %(street_path)s as street_path
    from planet_osm_line
           where trim(name) != '' and highway is not null
-                and st_intersects(%%(way)s, %(wkb_limits)s)
+                and %(line_way_in_area)s
    group by name ---, street_kind -- (optional)
-   order by name) as foo;
-""" % dict(wkb_limits = ("st_transform(ST_GeomFromText('%s', 4002), 900913)"
-                         % (polygon_wkt,)))
-
-        # l.debug("Street query (nogrid): %s" % query)
-
-        try:
-            cursor.execute(query % {'way':'way'})
-        except psycopg2.InternalError:
-            # This exception generaly occurs when inappropriate ways have
-            # to be cleaned. Using a buffer of 0 generaly helps to clean
-            # them. This operation is not applied by default for
-            # performance.
-            db.rollback()
-            cursor.execute(query % {'way':'st_buffer(way, 0)'})
-        sl = cursor.fetchall()
-
-        l.debug("Got %d streets." % len(sl))
-
-        return self._convert_street_index(sl)
-
-
-    def _list_amenities(self, db, polygon_wkt):
-        """Get the list of amenities inside the given polygon. Don't
-        try to map them onto the grid of squares (there location_str
-        field remains undefined).
+   order by name) as foo
+where not st_isempty(street_path);
+""" % dict(street_path = self._get_area_clip_sql(
+               'st_linemerge(st_collect(%(line_way)s))'),
+           line_way_in_area = self._get_area_filter_sql('way'),
+           endpoints = self._get_endpoints_sql('street_path'))
+        return query
+
+    def _get_precomputed_streets_query(self):
+        """Return the query getting the streets of the area of interest
+        from the precomputed table of streets (see street_table). The
+        stored endpoints of the street clusters lying inside the area are
+        used as is, the others are clipped to the area."""
+        return """
+select name,
+       st_astext(st_transform(%(endpoints)s,
+                              4002)) as longest_linestring
+from
+  (select name,
+          st_collect(case when %(way_covered)s
+                          then endpoints
+                          else %(clipped_way)s
+                          end) as street_path
+   from %(table)s
+   where %(way_in_area)s
+   group by name
+   order by name) as foo
+where not st_isempty(street_path);
+""" % dict(way_covered = self._get_area_covers_sql('way'),
+           clipped_way = self._get_area_clip_sql('way'),
+           way_in_area = self._get_area_filter_sql('way'),
+           table = street_table.STREET_TABLE,
+           endpoints = self._get_endpoints_sql('street_path'))
+
+
+    def _list_amenities(self, db):
+        """Get the list of amenities inside the area of interest (see
+        _prepare_area()). Don't try to map them onto the grid of squares
+        (there location_str field remains undefined).
 
         Args:
            db (psycopg2 DB): The GIS database
-           polygon_wkt (str): The WKT of the surrounding polygon of interest
 
         Returns a list of commons.IndexCategory objects, with their IndexItems
         having no specific grid square location
         """
+        selected_amenities = self._get_selected_amenities(self._i18n)
+        return self._group_amenities(
+            selected_amenities,
+            [self._list_amenity(db, catname, db_amenity)
+             for catname, db_amenity, label in selected_amenities])
 
-        cursor = db.cursor()
+    def _group_amenities(self, selected_amenities, amenity_items):
+        """Group the lists of amenities in IndexCategory objects.
 
-        result = []
-        for catname, db_amenity, label in self._get_selected_amenities():
-            l.info("Getting amenities for %s/%s..." % (catname, db_amenity))
+        Args:
+           selected_amenities (list): see _get_selected_amenities()
+           amenity_items (list): one list of IndexItem objects for each
+              of the selected amenities (see _list_amenity())
 
+        Returns a list of commons.IndexCategory objects
+        """
+        result = []
+        for (catname, db_amenity, label), items in zip(selected_amenities,
+                                                       amenity_items):
             # Get the current IndexCategory object, or create one if
             # different than previous
             if (not result or result[-1].name != catname):
@@ -321,73 +824,84 @@ from
                 result.append(current_category)
             else:
                 current_category = result[-1]
+            current_category.items.extend(items)
 
-            query = """
+        return [category for category in result if category.items]
+
+    def _list_amenity(self, db, catname, db_amenity):
+        """Get the list of amenities of the given kind inside the area of
+        interest.
+
+        Args:
+           db (psycopg2 DB): The GIS database
+           catname (str): Category of the amenity (only used for logging)
+           db_amenity (str): Description string of the amenity in the DB
+
+        Returns a list of commons.IndexItem objects having no specific
+        grid square location
+        """
+        l.info("Getting amenities for %s/%s..." % (catname, db_amenity))
+
+        items = []
+
+        query = """
 select amenity_name,
-       st_astext(st_transform(ST_LongestLine(amenity_contour, amenity_contour),
+       st_astext(st_transform(%(endpoints)s,
                               4002)) as longest_linestring
 from (
        select name as amenity_name,
-              st_intersection(%(wkb_limits)s, %%(way)s) as amenity_contour
+              %(point_contour)s as amenity_contour
        from planet_osm_point
        where trim(name) != ''
-             and amenity = %(amenity)s and ST_intersects(%%(way)s, %(wkb_limits)s)
+             and amenity = %(amenity)s and %(point_in_area)s
       union
        select name as amenity_name,
-              st_intersection(%(wkb_limits)s , %%(way)s) as amenity_contour
+              %(polygon_contour)s as amenity_contour
        from planet_osm_polygon
        where trim(name) != '' and amenity = %(amenity)s
-             and ST_intersects(%%(way)s, %(wkb_limits)s)
+             and %(polygon_in_area)s
      ) as foo
+where not st_isempty(amenity_contour)
 order by amenity_name""" \
-                % {'amenity': _sql_escape_unicode(db_amenity),
-                   'wkb_limits': ("st_transform(ST_GeomFromText('%s' , 4002), 900913)"
-                                  % (polygon_wkt,))}
+            % {'amenity': _sql_escape_unicode(db_amenity),
+               'point_contour': self._get_area_clip_sql('way'),
+               'point_in_area': self._get_area_filter_sql('way'),
+               'polygon_contour': self._get_area_clip_sql('%(polygon_way)s'),
+               'polygon_in_area': self._get_area_filter_sql('way'),
+               'endpoints': self._get_endpoints_sql('amenity_contour')}
 
 
-            # l.debug("Amenity query for for %s/%s (nogrid): %s" \
-            #             % (catname, db_amenity, query))
+        # l.debug("Amenity query for for %s/%s (nogrid): %s" \
+        #             % (catname, db_amenity, query))
+        for amenity_name, linestring in self._execute_query(db, query):
+            # Parse the WKT from the largest linestring in shape
             try:
-                cursor.execute(query % {'way':'way'})
-            except psycopg2.InternalError:
-                # This exception generaly occurs when inappropriate ways have
-                # to be cleaned. Using a buffer of 0 generaly helps to clean
-                # them. This operation is not applied by default for
-                # performance.
-                db.rollback()
-                cursor.execute(query % {'way':'st_buffer(way, 0)'})
-
-            for amenity_name, linestring in cursor.fetchall():
-                # Parse the WKT from the largest linestring in shape
-                try:
-                    s_endpoint1, s_endpoint2 = map(lambda s: s.split(),
-                                                   linestring[11:-1].split(','))
-                except (ValueError, TypeError):
-                    l.exception("Error parsing %s for %s/%s/%s"
-                                % (repr(linestring), catname, db_amenity,
-                                   repr(amenity_name)))
-                    continue
-                    ## raise
-                endpoint1 = ocitysmap.coords.Point(s_endpoint1[1], s_endpoint1[0])
-                endpoint2 = ocitysmap.coords.Point(s_endpoint2[1], s_endpoint2[0])
-                current_category.items.append(commons.IndexItem(amenity_name,
-                                                                endpoint1,
-                                                                endpoint2,
-                                                                self._page_number))
-
-            l.debug("Got %d amenities for %s/%s."
-                    % (len(current_category.items), catname, db_amenity))
+                s_endpoint1, s_endpoint2 = map(lambda s: s.split(),
+                                               linestring[11:-1].split(','))
+            except (ValueError, TypeError):
+                l.exception("Error parsing %s for %s/%s/%s"
+                            % (repr(linestring), catname, db_amenity,
+                               repr(amenity_name)))
+                continue
+                ## raise
+            items.append(
+                self._store.add(amenity_name,
+                                (s_endpoint1[1], s_endpoint1[0]),
+                                (s_endpoint2[1], s_endpoint2[0]),
+                                self._page_number))
 
-        return [category for category in result if category.items]
+        l.debug("Got %d amenities for %s/%s."
+                % (len(items), catname, db_amenity))
 
-    def _list_villages(self, db, polygon_wkt):
-        """Get the list of villages inside the given polygon. Don't
-        try to map them onto the grid of squares (there location_str
-        field remains undefined).
+        return items
+
+    def _list_villages(self, db):
+        """Get the list of villages inside the area of interest (see
+        _prepare_area()). Don't try to map them onto the grid of squares
+        (there location_str field remains undefined).
 
         Args:
            db (psycopg2 DB): The GIS database
-           polygon_wkt (str): The WKT of the surrounding polygon of interest
 
         Returns a list of commons.IndexCategory objects, with their IndexItems
         having no specific grid square location
@@ -396,41 +910,36 @@ order by amenity_name""" \
         cursor = db.cursor()
 
         result = []
+        _ = self._i18n.gettext
         current_category = commons.IndexCategory(_(u"Villages"),
                                                  is_street=False)
         result.append(current_category)
 
         query = """
 select village_name,
-       st_astext(st_transform(ST_LongestLine(village_contour, village_contour),
+       st_astext(st_transform(%(endpoints)s,
                               4002)) as longest_linestring
 from (
        select name as village_name,
-              st_intersection(%(wkb_limits)s, %%(way)s) as village_contour
+              %(contour)s as village_contour
        from planet_osm_point
        where trim(name) != ''
              and (place = 'locality'
                   or place = 'hamlet'
                   or place = 'isolated_dwelling')
-             and ST_intersects(%%(way)s, %(wkb_limits)s)
+             and %(in_area)s
      ) as foo
+where not st_isempty(village_contour)
 order by village_name""" \
-            % {'wkb_limits': ("st_transform(ST_GeomFromText('%s', 4002), 900913)"
-                              % (polygon_wkt,))}
+            % {'contour': self._get_area_clip_sql('way'),
+               'in_area': self._get_area_filter_sql('way'),
+               'endpoints': self._get_endpoints_sql('village_contour')}
 
 
         # l.debug("Villages query for %s (nogrid): %s" \
         #             % ('Villages', query))
 
-        try:
-            cursor.execute(query % {'way':'way'})
-        except psycopg2.InternalError:
-            # This exception generaly occurs when inappropriate ways have
-            # to be cleaned. Using a buffer of 0 generaly helps to clean
-            # them. This operation is not applied by default for
-            # performance.
-            db.rollback()
-            cursor.execute(query % {'way':'st_buffer(way, 0)'})
+        cursor.execute(query)
 
         for village_name, linestring in cursor.fetchall():
             # Parse the WKT from the largest linestring in shape
@@ -443,12 +952,11 @@ order by village_name""" \
                                repr(village_name)))
                 continue
                 ## raise
-            endpoint1 = ocitysmap.coords.Point(s_endpoint1[1], s_endpoint1[0])
-            endpoint2 = ocitysmap.coords.Point(s_endpoint2[1], s_endpoint2[0])
-            current_category.items.append(commons.IndexItem(village_name,
-                                                            endpoint1,
-                                                            endpoint2,
-                                                            self._page_number))
+            current_category.items.append(
+                self._store.add(village_name,
+                                (s_endpoint1[1], s_endpoint1[0]),
+                                (s_endpoint2[1], s_endpoint2[0]),
+                                self._page_number))
 
         l.debug("Got %d villages for %s."
                 % (len(current_category.items), 'Villages'))
@@ -479,8 +987,33 @@ if __name__ == "__main__":
     # Paris bbox
     # limits_wkt = """POLYGON((2.22405964791711 48.8155243047565,2.22405964791711 48.9021584078545,2.46979772401737 48.9021584078545,2.46979772401737 48.8155243047565,2.22405964791711 48.8155243047565))"""
 
-    street_index = StreetIndex(db, limits_wkt, i18n)
-
-    print "=> Got %d categories, total %d items" \
-        % (len(street_index.categories),
-           reduce(lambda r,cat: r+len(cat.items), street_index.categories, 0))
+    # Compare the duration and the results of the endpoints strategies
+    # with the reference longest_line one
+    import time
+
+    def item_endpoints(street_index):
+        return [(category.name, item.label,
+                 item.endpoint1 and item.endpoint1.get_latlong(),
+                 item.endpoint2 and item.endpoint2.get_latlong())
+                for category in street_index.categories
+                for item in category.items]
+
+    reference = None
+    for endpoints in ['longest_line'] + sorted(set(ENDPOINTS_SQL)
+                                               - set(['longest_line'])):
+        start = time.time()
+        street_index = StreetIndex(db, limits_wkt, i18n, endpoints=endpoints)
+        duration = time.time() - start
+
+        print "=> %s: got %d categories, total %d items in %.2fs" \
+            % (endpoints, len(street_index.categories),
+               reduce(lambda r,cat: r+len(cat.items),
+                      street_index.categories, 0),
+               duration)
+
+        items = item_endpoints(street_index)
+        if reference is None:
+            reference = items
+        else:
+            print "   %d items with endpoints different from longest_line" \
+                % len(set(items) - set(reference))
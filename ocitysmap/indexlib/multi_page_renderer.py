@@ -17,11 +17,11 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import cairo
 import math
-import pango
-import pangocairo
 
+from ocitysmap.lazy_modules import cairo, pango, pangocairo
+
+import commons
 import draw_utils
 import ocitysmap.layoutlib.commons as UTILS
 from ocitysmap.layoutlib.abstract_renderer import Renderer
@@ -162,6 +162,11 @@ class MultiPageStreetIndexRenderer:
         # page number of first page
         self._draw_page_number()
 
+        # The entries of each page are laid out first, then drawn with one
+        # path for all the header backgrounds and one for all the dotted
+        # lines (see _draw_entries())
+        headers, items = [], []
+
         for category in self.index_categories:
             if ( offset_y + header_fheight + label_fheight
                  + margin/2. > max_drawing_height ):
@@ -170,20 +175,24 @@ class MultiPageStreetIndexRenderer:
                 actual_n_cols += 1
 
                 if actual_n_cols == columns_count:
+                    self._draw_entries(pc, headers, items)
+                    headers, items = [], []
                     self._new_page()
                     actual_n_cols = 0
                     offset_y = margin / 2.
                     offset_x = orig_offset_x
                     delta_x  = orig_delta_x
 
-            category.draw(self._i18n.isrtl(), self.ctx, pc, header_layout,
-                          UTILS.convert_pt_to_dots(header_fascent, dpi),
-                          UTILS.convert_pt_to_dots(header_fheight, dpi),
-                          UTILS.convert_pt_to_dots(self.rendering_area_x
-                                                   + offset_x, dpi),
-                          UTILS.convert_pt_to_dots(self.rendering_area_y
-                                                   + offset_y
-                                                   + header_fascent, dpi))
+            headers.append((category,
+                            (header_layout,
+                             UTILS.convert_pt_to_dots(header_fascent, dpi),
+                             UTILS.convert_pt_to_dots(header_fheight, dpi),
+                             UTILS.convert_pt_to_dots(self.rendering_area_x
+                                                      + offset_x, dpi),
+                             UTILS.convert_pt_to_dots(self.rendering_area_y
+                                                      + offset_y
+                                                      + header_fascent,
+                                                      dpi))))
 
             offset_y += header_fheight
 
@@ -196,36 +205,46 @@ class MultiPageStreetIndexRenderer:
                     actual_n_cols += 1
 
                     if actual_n_cols == columns_count:
+                        self._draw_entries(pc, headers, items)
+                        headers, items = [], []
                         self._new_page()
                         actual_n_cols = 0
                         offset_y = margin / 2.
                         offset_x = orig_offset_x
                         delta_x  = orig_delta_x
 
-                street.draw(self._i18n.isrtl(), self.ctx, pc, column_layout,
-                            UTILS.convert_pt_to_dots(label_fascent, dpi),
-                            UTILS.convert_pt_to_dots(label_fheight, dpi),
-                            UTILS.convert_pt_to_dots(self.rendering_area_x
-                                                     + offset_x, dpi),
-                            UTILS.convert_pt_to_dots(self.rendering_area_y
-                                                     + offset_y
-                                                     + label_fascent, dpi),
-                            label_layout,
-                            UTILS.convert_pt_to_dots(label_height, dpi),
-                            UTILS.convert_pt_to_dots(max_location_drawing_width,
-                                                     dpi))
+                items.append((street,
+                              (column_layout,
+                               UTILS.convert_pt_to_dots(label_fascent, dpi),
+                               UTILS.convert_pt_to_dots(label_fheight, dpi),
+                               UTILS.convert_pt_to_dots(self.rendering_area_x
+                                                        + offset_x, dpi),
+                               UTILS.convert_pt_to_dots(self.rendering_area_y
+                                                        + offset_y
+                                                        + label_fascent,
+                                                        dpi),
+                               label_layout,
+                               UTILS.convert_pt_to_dots(label_height, dpi),
+                               UTILS.convert_pt_to_dots(
+                                   max_location_drawing_width, dpi))))
 
                 offset_y += label_height
 
+        self._draw_entries(pc, headers, items)
 
         self.ctx.restore()
 
+    def _draw_entries(self, pc, headers, items):
+        """Draw the index entries laid out on the current page (see
+        commons.draw_index_entries())."""
+        commons.draw_index_entries(self._i18n.isrtl(), self.ctx, pc,
+                                   headers, items)
+
 
 if __name__ == '__main__':
     import random
     import string
 
-    import commons
     import coords
 
     width = 72*21./2.54
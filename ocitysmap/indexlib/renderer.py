@@ -22,11 +22,10 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import cairo
 import logging
 import math
-import pango
-import pangocairo
+
+from ocitysmap.lazy_modules import cairo, pango, pangocairo
 
 import commons
 import ocitysmap.layoutlib.commons as UTILS
@@ -290,6 +289,9 @@ class StreetIndexRenderer:
             offset_x = rendering_area.w - column_width + margin/2.
             delta_x  = - column_width
 
+        # The entries are laid out first, then drawn with one path for all
+        # the header backgrounds and one for all the dotted lines
+        headers, items = [], []
         actual_n_cols = 1
         offset_y = margin/2.
         for category in self._index_categories:
@@ -299,14 +301,16 @@ class StreetIndexRenderer:
                 offset_x      += delta_x
                 actual_n_cols += 1
 
-            category.draw(self._i18n.isrtl(), ctx, pc, header_layout,
-                          UTILS.convert_pt_to_dots(header_fascent, dpi),
-                          UTILS.convert_pt_to_dots(header_fheight, dpi),
-                          UTILS.convert_pt_to_dots(rendering_area.x
-                                                   + offset_x, dpi),
-                          UTILS.convert_pt_to_dots(rendering_area.y
-                                                   + offset_y
-                                                   + header_fascent, dpi))
+            headers.append((category,
+                            (header_layout,
+                             UTILS.convert_pt_to_dots(header_fascent, dpi),
+                             UTILS.convert_pt_to_dots(header_fheight, dpi),
+                             UTILS.convert_pt_to_dots(rendering_area.x
+                                                      + offset_x, dpi),
+                             UTILS.convert_pt_to_dots(rendering_area.y
+                                                      + offset_y
+                                                      + header_fascent,
+                                                      dpi))))
 
             offset_y += header_fheight
 
@@ -317,17 +321,22 @@ class StreetIndexRenderer:
                     offset_x      += delta_x
                     actual_n_cols += 1
 
-                street.draw(self._i18n.isrtl(), ctx, pc, label_layout,
-                            UTILS.convert_pt_to_dots(label_fascent, dpi),
-                            UTILS.convert_pt_to_dots(label_fheight, dpi),
-                            UTILS.convert_pt_to_dots(rendering_area.x
-                                                     + offset_x, dpi),
-                            UTILS.convert_pt_to_dots(rendering_area.y
-                                                     + offset_y
-                                                     + label_fascent, dpi))
+                items.append((street,
+                              (label_layout,
+                               UTILS.convert_pt_to_dots(label_fascent, dpi),
+                               UTILS.convert_pt_to_dots(label_fheight, dpi),
+                               UTILS.convert_pt_to_dots(rendering_area.x
+                                                        + offset_x, dpi),
+                               UTILS.convert_pt_to_dots(rendering_area.y
+                                                        + offset_y
+                                                        + label_fascent,
+                                                        dpi))))
 
                 offset_y += label_fheight
 
+        commons.draw_index_entries(self._i18n.isrtl(), ctx, pc,
+                                   headers, items)
+
         # Restore original context
         ctx.restore()
 
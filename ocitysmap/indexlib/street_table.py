@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+
+# ocitysmap, city map and street index generator from OpenStreetMap data
+# Copyright (C) 2010  David Decotigny
+# Copyright (C) 2010  Frédéric Lehobey
+# Copyright (C) 2010  Pierre Mauduit
+# Copyright (C) 2010  David Mentré
+# Copyright (C) 2010  Maxime Petazzoni
+# Copyright (C) 2010  Thomas Petazzoni
+# Copyright (C) 2010  Gaël Utard
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Maintenance of the precomputed table of streets.
+
+Building the street index merges, for every request, all the fragments of
+the named highways of the area. This module maintains an optional table
+holding the result of this merge, computed once for the whole database:
+one row per street name and connected cluster of highways, with the
+merged geometry and the line between its two farthest points. StreetIndex
+uses this table when it exists.
+
+It is built with:
+
+    street_table.py -c /path/to/ocitysmap.conf create
+
+and refreshed after each import of OSM changes (see
+support/planet-update.sh) with the list of the modified ways:
+
+    street_table.py -c /path/to/ocitysmap.conf refresh way_ids.txt
+
+Only the geometries of the ways listed in the changes are refreshed: a way
+moved by a change of its nodes only is updated at the next full build.
+Refreshing does nothing until the table is built.
+
+Building the table needs PostGIS 2.3 or later (st_clusterdbscan).
+"""
+
+import ConfigParser
+import logging
+import optparse
+import os
+import sys
+import threading
+import weakref
+
+l = logging.getLogger('ocitysmap')
+
+STREET_TABLE = 'ocitysmap_streets'
+
+# Result of exists() by database connection, so that the catalog is only
+# queried once per connection
+_exists_by_db      = weakref.WeakKeyDictionary()
+_exists_by_db_lock = threading.Lock()
+
+# Merge the named highways of planet_osm_line matching the given filter,
+# one row per name and connected cluster of ways.
+_INSERT_STREETS_QUERY = """
+insert into %(table)s (name, osm_ids, way, endpoints)
+select name, osm_ids, way,
+       ST_LongestLine(ST_ConvexHull(way), ST_ConvexHull(way))
+from
+  (select name, array_agg(distinct osm_id) as osm_ids,
+          st_linemerge(st_collect(way)) as way
+   from
+     (select name, osm_id, way,
+             st_clusterdbscan(way, 0, 1) over (partition by name) as cluster
+      from planet_osm_line
+      where trim(name) != '' and highway is not null
+            and %(filter)s) as ways
+   group by name, cluster) as streets;
+"""
+
+
+def exists(db):
+    """Return True if the precomputed table of streets exists in the
+    database. The result is cached for each connection: a table created
+    afterwards is only used by the new connections."""
+    with _exists_by_db_lock:
+        if db in _exists_by_db:
+            return _exists_by_db[db]
+
+    cursor = db.cursor()
+    cursor.execute("""select count(*) from pg_catalog.pg_class
+                      where relname = %s and relkind = 'r'
+                            and pg_catalog.pg_table_is_visible(oid);""",
+                   (STREET_TABLE,))
+    result = cursor.fetchall()[0][0] > 0
+
+    with _exists_by_db_lock:
+        _exists_by_db[db] = result
+    return result
+
+
+def create(db):
+    """(Re)build the precomputed table of streets from scratch."""
+    cursor = db.cursor()
+
+    l.info("Building table %s..." % STREET_TABLE)
+    cursor.execute("drop table if exists %s;" % STREET_TABLE)
+    cursor.execute("""
+create table %(table)s (name      text       not null,
+                        osm_ids   bigint[]   not null,
+                        way       geometry   not null,
+                        endpoints geometry   not null);""" %
+                   {'table': STREET_TABLE})
+    cursor.execute(_INSERT_STREETS_QUERY % {'table': STREET_TABLE,
+                                            'filter': 'true'})
+
+    l.info("Indexing table %s..." % STREET_TABLE)
+    cursor.execute("create index %(table)s_way_idx on %(table)s "
+                   "using gist (way);" % {'table': STREET_TABLE})
+    cursor.execute("create index %(table)s_name_idx on %(table)s (name);"
+                   % {'table': STREET_TABLE})
+    cursor.execute("create index %(table)s_osm_ids_idx on %(table)s "
+                   "using gin (osm_ids);" % {'table': STREET_TABLE})
+    cursor.execute("grant select on %s to public;" % STREET_TABLE)
+    db.commit()
+
+    cursor.execute("analyze %s;" % STREET_TABLE)
+    db.commit()
+
+
+def refresh(db, osm_ids):
+    """Rebuild the streets of the precomputed table affected by changes of
+    the given ways: their current names, and the names they had before
+    the changes (renamed or deleted ways).
+
+    Args:
+       db (psycopg2 DB): The GIS database
+       osm_ids (list of int): the OSM ids of the modified ways
+    """
+    if not osm_ids:
+        return
+    if not exists(db):
+        l.info("Table %s does not exist, nothing to refresh." % STREET_TABLE)
+        return
+
+    cursor = db.cursor()
+    cursor.execute("""
+create temporary table ocitysmap_street_names on commit drop as
+  select name from planet_osm_line
+  where osm_id = any(%%(osm_ids)s) and trim(name) != ''
+        and highway is not null
+ union
+  select name from %(table)s where osm_ids && %%(osm_ids)s::bigint[];
+""" % {'table': STREET_TABLE}, {'osm_ids': list(osm_ids)})
+
+    cursor.execute("delete from %s where name in "
+                   "(select name from ocitysmap_street_names);"
+                   % STREET_TABLE)
+    cursor.execute(_INSERT_STREETS_QUERY %
+                   {'table': STREET_TABLE,
+                    'filter': 'name in (select name '
+                              'from ocitysmap_street_names)'})
+    l.info("Refreshed %d streets of table %s." % (cursor.rowcount,
+                                                   STREET_TABLE))
+    db.commit()
+
+
+def main():
+    usage = '%prog [options] create|refresh [way_ids_file]'
+    parser = optparse.OptionParser(usage=usage)
+    parser.add_option('-c', '--config', dest='config', metavar='FILE',
+                      default='/etc/ocitysmap.conf',
+                      help='OCitySMap configuration file (for the '
+                           '[datasource] section).')
+    options, args = parser.parse_args()
+
+    if not args or args[0] not in ('create', 'refresh'):
+        parser.error('Invalid command.')
+    if args[0] == 'refresh' and len(args) != 2:
+        parser.error('The refresh command needs a file of way ids.')
+
+    logging.basicConfig(level=logging.INFO)
+
+    import psycopg2
+
+    config = ConfigParser.RawConfigParser()
+    if not config.read(os.path.expanduser(options.config)):
+        parser.error('Cannot read configuration file %s.' % options.config)
+    datasource = dict(config.items('datasource'))
+
+    db = psycopg2.connect(user=datasource['user'],
+                          password=datasource['password'],
+                          host=datasource['host'],
+                          database=datasource['dbname'],
+                          port=datasource.get('port', 5432))
+
+    if args[0] == 'create':
+        create(db)
+    else:
+        with open(args[1]) as f:
+            osm_ids = [int(line) for line in f if line.strip()]
+        refresh(db, osm_ids)
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -23,20 +23,19 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import cairo
 import logging
-import mapnik
-assert mapnik.mapnik_version >= 200100, \
-    "Mapnik module version %s is too old, see ocitysmap's INSTALL " \
-    "for more details." % mapnik.mapnik_version_string()
 import math
-import pango
 import os
 import re
-import shapely.wkt
 import sys
+import threading
 
+from ocitysmap.lazy_modules import mapnik, pango, shapely
+
+import assets
 import commons
+from ocitysmap.cancellation import CancellationToken
+from ocitysmap.indexlib.indexer import StreetIndex
 from ocitysmap.maplib.map_canvas import MapCanvas
 from ocitysmap.maplib.grid import Grid
 from ocitysmap import draw_utils, maplib
@@ -44,6 +43,35 @@ from ocitysmap import draw_utils, maplib
 LOG = logging.getLogger('ocitysmap')
 
 
+class StreetIndexJob:
+    """
+    A street index built in the background, see
+    Renderer._start_street_indexes().
+    """
+
+    def __init__(self):
+        self._done     = threading.Event()
+        self._index    = None
+        self._exc_info = None
+
+    def _set_result(self, index, exc_info=None):
+        self._index    = index
+        self._exc_info = exc_info
+        self._done.set()
+
+    def result(self):
+        """Wait for the index to be built and return the StreetIndex
+        object, or raise the exception that interrupted it. The streets of
+        the index are converted by the calling thread (see
+        StreetIndex.finish())."""
+        self._done.wait()
+        if self._exc_info is not None:
+            exc_type, exc_value, exc_traceback = self._exc_info
+            raise exc_type, exc_value, exc_traceback
+        self._index.finish()
+        return self._index
+
+
 class Renderer:
     """
     The job of an OCitySMap layout renderer is to lay out the resulting map and
@@ -64,6 +92,11 @@ class Renderer:
     # see entities.xml.inc file from osm style sheet
     DEFAULT_SCALE = 12000
 
+    # The smallest mapnik scale of the maps of the previews: 50000 ensures
+    # that the zoom level will be 13 or lower, without the house numbers
+    # and most of the labels and points of interest
+    PREVIEW_MIN_SCALE = 50000
+
     def __init__(self, db, rc, tmpdir, dpi):
         """
         Create the renderer.
@@ -79,6 +112,11 @@ class Renderer:
         self.tmpdir       = tmpdir
         self.grid         = None # The implementation is in charge of it
 
+        # Background thread building the street indexes, and the token
+        # cancelling its queries (see _start_street_indexes())
+        self._street_index_thread       = None
+        self._street_index_cancellation = CancellationToken()
+
         self.paper_width_pt = \
                 commons.convert_mm_to_pt(self.rc.paper_width_mm)
         self.paper_height_pt = \
@@ -87,40 +125,17 @@ class Renderer:
     @staticmethod
     def _get_osm_logo(ctx, height):
         """
-        Read the OSM logo file and rescale it to fit within height.
+        Return the OSM logo rescaled to fit within height, read and
+        decoded only once per process (see assets.get_image()).
 
         Args:
            ctx (cairo.Context): The cairo context to use to draw.
            height (number): final height of the logo (cairo units).
 
-        Return a tuple (cairo group object for the logo, logo width in
+        Return a tuple (cairo pattern object for the logo, logo width in
                         cairo units).
         """
-        # TODO: read vector logo
-        logo_path = os.path.abspath(os.path.join(
-            os.path.dirname(__file__), '..', '..', 'images', 'osm-logo.png'))
-        if not os.path.exists(logo_path):
-            logo_path = os.path.join(
-                sys.exec_prefix, 'share', 'images', 'ocitysmap',
-                'osm-logo.png')
-
-        try:
-            with open(logo_path, 'rb') as f:
-                png = cairo.ImageSurface.create_from_png(f)
-                LOG.debug('Using copyright logo: %s.' % logo_path)
-        except IOError:
-            LOG.warning('Cannot open logo from %s.' % logo_path)
-            return None, None
-
-        ctx.push_group()
-        ctx.save()
-        ctx.move_to(0, 0)
-        factor = height / png.get_height()
-        ctx.scale(factor, factor)
-        ctx.set_source_surface(png)
-        ctx.paint()
-        ctx.restore()
-        return ctx.pop_group(), png.get_width()*factor
+        return assets.get_image('osm-logo', height)
 
     @staticmethod
     def _draw_labels(ctx, map_grid,
@@ -206,9 +221,15 @@ class Renderer:
         """
 
         # Prepare the map canvas
+        if self.rc.preview:
+            min_scale_denominator = Renderer.PREVIEW_MIN_SCALE
+        else:
+            min_scale_denominator = None
         canvas = MapCanvas(self.rc.stylesheet,
                            self.rc.bounding_box,
-                           width, height, dpi)
+                           width, height, dpi,
+                           base_map_cache=self.rc.base_map_cache,
+                           min_scale_denominator=min_scale_denominator)
 
         if draw_contour_shade:
             # Area to keep visible
@@ -237,6 +258,113 @@ class Renderer:
 
         return canvas
 
+    def _check_cancelled(self):
+        """Raise RenderingCancelledError if the rendering was cancelled
+        (see OCitySMap.render()). To be called between rendering stages."""
+        if self.rc.cancellation is not None:
+            self.rc.cancellation.check()
+
+    def _create_street_index(self, polygon_wkt, page_number=None,
+                             cancellation=None, defer_streets=False):
+        """
+        Create a new StreetIndex object for the given area, using the
+        index cache of the rendering configuration if any.
+
+        Args:
+           polygon_wkt (str): WKT of the area to index.
+           page_number (int): None or page number of the indexed items.
+           cancellation (CancellationToken): None or the token cancelling
+              the queries, defaults to the one of the rendering.
+           defer_streets (bool): leave the conversion of the streets to
+              StreetIndex.finish().
+
+        Return a new StreetIndex object.
+        """
+        # The map is never rendered with more details than at
+        # DEFAULT_SCALE, which bounds the simplification of the area
+        return StreetIndex(self.db, polygon_wkt, self.rc.i18n,
+                           page_number=page_number,
+                           cache=self.rc.index_cache,
+                           scale=Renderer.DEFAULT_SCALE,
+                           db_pool=self.rc.index_db_pool,
+                           cancellation=(cancellation
+                                         or self.rc.cancellation),
+                           endpoints=self.rc.index_endpoints,
+                           defer_streets=defer_streets)
+
+    def _start_street_indexes(self, areas):
+        """
+        Start building the street indexes of the given areas, one after
+        the other, in a background thread: the database queries then run
+        while the renderer prepares its map canvases.
+
+        The streets of each index are only fetched by the background
+        thread, and converted when the renderer gets the index (see
+        StreetIndexJob.result()), as the conversion changes the locale of
+        the process.
+
+        The renderer must not use its database connection until the
+        indexes are built. If it fails before waiting for them, it must
+        call _stop_street_indexes().
+
+        Args:
+           areas (list): list of (polygon_wkt, page_number) tuples, see
+              _create_street_index().
+
+        Return the list of the StreetIndexJob objects of the areas.
+        """
+        jobs = [StreetIndexJob() for area in areas]
+
+        # The queries are cancelled with the rendering, or by
+        # _stop_street_indexes()
+        cancellation = self._street_index_cancellation
+        cancellation.add_callback(self.db.cancel)
+        if self.rc.cancellation is not None:
+            self.rc.cancellation.add_callback(cancellation.cancel)
+
+        def worker():
+            try:
+                for job, (polygon_wkt, page_number) in zip(jobs, areas):
+                    try:
+                        cancellation.check()
+                        self._check_cancelled()
+                        job._set_result(self._create_street_index(
+                            polygon_wkt, page_number, cancellation,
+                            defer_streets=True))
+                    except Exception:
+                        job._set_result(None, sys.exc_info())
+            finally:
+                if self.rc.cancellation is not None:
+                    self.rc.cancellation.remove_callback(cancellation.cancel)
+
+        thread = threading.Thread(target=worker, name='street-index')
+        thread.daemon = True
+        self._street_index_thread = thread
+        thread.start()
+        return jobs
+
+    def _stop_street_indexes(self):
+        """
+        Stop building the street indexes started by
+        _start_street_indexes(), when the renderer fails before waiting
+        for them. The running queries are interrupted, on the database
+        connection of the renderer as on the pooled ones, the next ones
+        are not started, and the background thread is waited for, so that
+        the database connection can be used again by the next renderings.
+        """
+        thread = self._street_index_thread
+        if thread is None or not thread.is_alive():
+            return
+
+        LOG.debug('Stopping the street index thread...')
+        self._street_index_cancellation.cancel()
+        thread.join()
+
+        try:
+            self.db.rollback()
+        except Exception:
+            LOG.exception('Could not rollback the database transaction')
+
     def _create_grid(self, canvas):
         """
         Create a new Grid object for the given MapCanvas.
@@ -274,6 +402,19 @@ class Renderer:
     def get_compatible_output_formats():
         return [ "png", "svgz", "pdf", "csv" ]
 
+    @staticmethod
+    def get_estimated_page_count(bounding_box, paper_width_mm,
+                                 paper_height_mm, index_size=0):
+        """Returns an upper bound of the number of pages of the document,
+        without rendering anything.
+
+        Args:
+            bounding_box (coords.BoundingBox): the map geographic bounding box.
+            paper_width_mm, paper_height_mm (numbers): the paper size.
+            index_size (int): expected number of items in the index.
+        """
+        return 1
+
     @staticmethod
     def get_compatible_paper_sizes(bounding_box, scale):
         """Returns a list of the compatible paper sizes for the given bounding
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+
+# ocitysmap, city map and street index generator from OpenStreetMap data
+# Copyright (C) 2010  David Decotigny
+# Copyright (C) 2010  Frédéric Lehobey
+# Copyright (C) 2010  Pierre Mauduit
+# Copyright (C) 2010  David Mentré
+# Copyright (C) 2010  Maxime Petazzoni
+# Copyright (C) 2010  Thomas Petazzoni
+# Copyright (C) 2010  Gaël Utard
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Process-wide cache of the static artwork (logos) drawn on the maps: each
+image is read and decoded once, then scaled patterns are kept by height so
+that the renderers only have to paint them.
+
+The SVG version of an image is preferred when the rsvg module and cairo
+recording surfaces are available, keeping it as vector data in the PDF and
+SVG outputs. Otherwise its PNG version is used.
+"""
+
+import logging
+import os
+import sys
+import threading
+
+from ocitysmap.lazy_modules import cairo, LazyModule
+
+rsvg = LazyModule(['rsvg'])
+
+LOG = logging.getLogger('ocitysmap')
+
+# Maximum number of scaled patterns kept in memory
+MAX_PATTERNS = 64
+
+_images = {}   # decoded surfaces and their size, by image name
+_patterns = {} # (pattern, width), by (image name, height)
+_lock = threading.Lock()
+
+def _find_image(name):
+    """Return the path of the given image of the images directory, looking
+    in the source tree first and then in the installation prefix."""
+    path = os.path.abspath(os.path.join(
+        os.path.dirname(__file__), '..', '..', 'images', name))
+    if not os.path.exists(path):
+        path = os.path.join(sys.exec_prefix, 'share', 'images', 'ocitysmap',
+                            name)
+    return path
+
+def _has_rsvg():
+    try:
+        rsvg.Handle
+    except ImportError:
+        return False
+    return True
+
+def _load_svg(path):
+    handle = rsvg.Handle(file=path)
+    width, height = handle.get_dimension_data()[:2]
+    surface = cairo.RecordingSurface(cairo.CONTENT_COLOR_ALPHA,
+                                     (0, 0, width, height))
+    handle.render_cairo(cairo.Context(surface))
+    return surface, width, height
+
+def _load_png(path):
+    with open(path, 'rb') as f:
+        surface = cairo.ImageSurface.create_from_png(f)
+    return surface, surface.get_width(), surface.get_height()
+
+def _load_image(basename):
+    """Return the decoded surface of the given image (without extension)
+    and its size, or None if it cannot be read."""
+    if _has_rsvg() and hasattr(cairo, 'RecordingSurface'):
+        candidates = [(basename + '.svg', _load_svg),
+                      (basename + '.png', _load_png)]
+    else:
+        candidates = [(basename + '.png', _load_png)]
+
+    for name, load in candidates:
+        path = _find_image(name)
+        try:
+            image = load(path)
+        except Exception, ex:
+            LOG.warning('Cannot open image from %s: %s' % (path, ex))
+            continue
+        LOG.debug('Using image: %s.' % path)
+        return image
+    return None
+
+def get_image(basename, height):
+    """
+    Return the given image of the images directory scaled to the given
+    height, loading it only the first time.
+
+    Args:
+       basename (str): file name of the image, without extension.
+       height (number): final height of the image (cairo units).
+
+    Return a tuple (cairo pattern of the image, image width in cairo units)
+    or (None, None) if the image cannot be read.
+    """
+    with _lock:
+        result = _patterns.get((basename, height))
+        if result is not None:
+            return result
+
+        if basename not in _images:
+            _images[basename] = _load_image(basename)
+        image = _images[basename]
+        if image is None:
+            return None, None
+
+        surface, image_width, image_height = image
+        factor = float(height) / image_height
+        pattern = cairo.SurfacePattern(surface)
+        pattern.set_matrix(cairo.Matrix(xx=1/factor, yy=1/factor))
+        result = (pattern, image_width*factor)
+
+        if len(_patterns) >= MAX_PATTERNS:
+            _patterns.clear()
+        _patterns[(basename, height)] = result
+        return result
@@ -19,29 +19,23 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import cairo
 import datetime
 from itertools import groupby
 import locale
 import logging
-import mapnik
-assert mapnik.mapnik_version >= 200100, \
-    "Mapnik module version %s is too old, see ocitysmap's INSTALL " \
-    "for more details." % mapnik.mapnik_version_string()
 import math
 import os
-import pangocairo
-import pango
-import shapely.wkt
 import sys
 import tempfile
 
+from ocitysmap.lazy_modules import cairo, mapnik, pango, pangocairo, \
+    shapely
+
 import ocitysmap
 import coords
 import commons
 from abstract_renderer import Renderer
 from indexlib.commons import IndexCategory
-from indexlib.indexer import StreetIndex
 from indexlib.multi_page_renderer import MultiPageStreetIndexRenderer
 from ocitysmap import draw_utils, maplib
 from ocitysmap.maplib.map_canvas import MapCanvas
@@ -61,9 +55,41 @@ class MultiPageRenderer(Renderer):
     description = 'A multi-page layout.'
     multipages = True
 
+    # the mapnik scale depends on the latitude. However we are
+    # always using Mapnik conversion functions (lat,lon <->
+    # mercator_meters) so we don't need to take into account
+    # latitude in following computations
+
+    # by convention, mapnik uses 90 ppi whereas cairo uses 72 ppi
+    SCALE_DENOM = Renderer.DEFAULT_SCALE * float(72) / 90
+
+    GRAYED_MARGIN_MM  = 10
+    OVERLAP_MARGIN_MM = 20
+
+    # Rough height of an index line, and width of an index column. Only
+    # used to estimate the number of index pages, and the index area of
+    # the previews of the single-page layouts.
+    INDEX_LINE_HEIGHT_PT    = 10
+    INDEX_COLUMN_WIDTH_PT   = 150
+
+    # Largest map (in dots, in each direction) rendered in one pass when
+    # the map pages are sliced from a single rendering of the whole area
+    # (see RenderingConfiguration.multi_page_single_render).
+    SINGLE_RENDER_MAX_DOTS  = 16384
+
     def __init__(self, db, rc, tmpdir, dpi, file_prefix):
         Renderer.__init__(self, db, rc, tmpdir, dpi)
 
+        try:
+            self._prepare_pages(dpi)
+        except Exception:
+            exc_type, exc_value, exc_traceback = sys.exc_info()
+            self._stop_street_indexes()
+            raise exc_type, exc_value, exc_traceback
+
+    def _prepare_pages(self, dpi):
+        """Prepare the maps and the indexes of all the pages (see
+        __init__())."""
         self._grid_legend_margin_pt = \
             min(Renderer.GRID_LEGEND_MARGIN_RATIO * self.paper_width_pt,
                 Renderer.GRID_LEGEND_MARGIN_RATIO * self.paper_height_pt)
@@ -74,24 +100,14 @@ class MultiPageRenderer(Renderer):
         self._usable_area_height_pt = (self.paper_height_pt -
                                        (2 * Renderer.PRINT_SAFE_MARGIN_PT))
 
-        scale_denom = Renderer.DEFAULT_SCALE
-
-        # the mapnik scale depends on the latitude. However we are
-        # always using Mapnik conversion functions (lat,lon <->
-        # mercator_meters) so we don't need to take into account
-        # latitude in following computations
-
-        # by convention, mapnik uses 90 ppi whereas cairo uses 72 ppi
-        scale_denom *= float(72) / 90
-
-        GRAYED_MARGIN_MM  = 10
-        OVERLAP_MARGIN_MM = 20
+        scale_denom = MultiPageRenderer.SCALE_DENOM
+        GRAYED_MARGIN_MM  = MultiPageRenderer.GRAYED_MARGIN_MM
+        OVERLAP_MARGIN_MM = MultiPageRenderer.OVERLAP_MARGIN_MM
 
         # Debug: show original bounding box as JS code
         # print self.rc.bounding_box.as_javascript("original", "#00ff00")
 
         # Convert the original Bounding box into Mercator meters
-        self._proj = mapnik.Projection(coords._MAPNIK_PROJECTION)
         orig_envelope = self._project_envelope(self.rc.bounding_box)
 
         # Extend the bounding box to take into account the lost outter
@@ -109,24 +125,10 @@ class MultiPageRenderer(Renderer):
         overlap_margin_pt = commons.convert_mm_to_pt(OVERLAP_MARGIN_MM)
 
         # Calculate the number of pages needed in both directions
-        if total_width_pt < self._usable_area_width_pt:
-            nb_pages_width = 1
-        else:
-            nb_pages_width = \
-                (float(total_width_pt - self._usable_area_width_pt) / \
-                     (self._usable_area_width_pt - overlap_margin_pt)) + 1
-
-        if total_height_pt < self._usable_area_height_pt:
-            nb_pages_height = 1
-        else:
-            nb_pages_height = \
-                (float(total_height_pt - self._usable_area_height_pt) / \
-                     (self._usable_area_height_pt - overlap_margin_pt)) + 1
-
-        # Round up the number of pages needed so that we have integer
-        # number of pages
-        self.nb_pages_width = int(math.ceil(nb_pages_width))
-        self.nb_pages_height = int(math.ceil(nb_pages_height))
+        self.nb_pages_width = self._get_page_count(
+            total_width_pt, self._usable_area_width_pt, overlap_margin_pt)
+        self.nb_pages_height = self._get_page_count(
+            total_height_pt, self._usable_area_height_pt, overlap_margin_pt)
 
         # Calculate the entire paper area available
         total_width_pt_after_extension = self._usable_area_width_pt + \
@@ -154,6 +156,19 @@ class MultiPageRenderer(Renderer):
         envelope = mapnik.Box2d(off_x, off_y, off_x + width, off_y + height)
         self._geo_bbox = self._inverse_envelope(envelope)
 
+        # Render the whole map once, and slice it into the pages, instead
+        # of rendering each page with its overlapping margins?
+        self._whole_map_canvas = None
+        self._whole_map = None
+        if self._use_single_render(total_width_pt_after_extension,
+                                   total_height_pt_after_extension, dpi):
+            self._whole_map_canvas = MapCanvas(
+                self.rc.stylesheet, self._geo_bbox,
+                total_width_pt_after_extension,
+                total_height_pt_after_extension, dpi,
+                extend_bbox_to_ratio=False,
+                base_map_cache=self.rc.base_map_cache)
+
         # Debug: show transformed bounding box as JS code
         # print self._geo_bbox.as_javascript("extended", "#0f0f0f")
 
@@ -164,47 +179,98 @@ class MultiPageRenderer(Renderer):
         grayed_margin_merc_m      = (GRAYED_MARGIN_MM * scale_denom) / 1000
         overlap_margin_merc_m     = (OVERLAP_MARGIN_MM * scale_denom) / 1000
 
+        # The area of interest is parsed only once. It is first clipped
+        # to each row of pages, and each page then only deals with the
+        # part of the area in its row: selecting the pages and computing
+        # their shades does not depend on the complexity of the whole
+        # area anymore.
+        self._area_polygon = shapely.wkt.loads(self.rc.polygon_wkt)
+        prepared_area = shapely.prepared.prep(self._area_polygon)
+
         # Calculate all the bounding boxes that correspond to the
         # geographical area that will be rendered on each sheet of
-        # paper.
-        area_polygon = shapely.wkt.loads(self.rc.polygon_wkt)
+        # paper, along with the part of the area visible on it.
+        # The longitudes of the page edges only depend on their column,
+        # and their latitudes on their row: they are all converted at once.
+        page_xs = [off_x + i * (usable_area_merc_m_width - overlap_margin_merc_m)
+                   for i in range(0, self.nb_pages_width)]
+        page_ys = [off_y + j * (usable_area_merc_m_height - overlap_margin_merc_m)
+                   for j in range(0, self.nb_pages_height)]
+        lefts = coords.mercator_to_longitudes(page_xs)
+        rights = coords.mercator_to_longitudes(
+            [x + usable_area_merc_m_width for x in page_xs])
+        inner_lefts = coords.mercator_to_longitudes(
+            [x + grayed_margin_merc_m for x in page_xs])
+        inner_rights = coords.mercator_to_longitudes(
+            [x + usable_area_merc_m_width - grayed_margin_merc_m
+             for x in page_xs])
+        bottoms = coords.mercator_to_latitudes(page_ys)
+        tops = coords.mercator_to_latitudes(
+            [y + usable_area_merc_m_height for y in page_ys])
+        inner_bottoms = coords.mercator_to_latitudes(
+            [y + grayed_margin_merc_m for y in page_ys])
+        inner_tops = coords.mercator_to_latitudes(
+            [y + usable_area_merc_m_height - grayed_margin_merc_m
+             for y in page_ys])
+        area_left, area_right = \
+            coords.mercator_to_longitudes([off_x, off_x + width])
+
         bboxes = []
+        page_offsets = []
         self.page_disposition, map_number = {}, 0
         for j in reversed(range(0, self.nb_pages_height)):
             col = self.nb_pages_height - j - 1
             self.page_disposition[col] = []
+
+            row_bb = coords.BoundingBox(inner_tops[j], area_left,
+                                        inner_bottoms[j], area_right)
+            row_box = self._bbox_to_shapely(row_bb)
+            if prepared_area.intersects(row_box):
+                row_area = self._area_polygon.intersection(row_box)
+                prepared_row_area = shapely.prepared.prep(row_area)
+            else:
+                row_area = None
+
             for i in range(0, self.nb_pages_width):
-                cur_x = off_x + i * (usable_area_merc_m_width - overlap_margin_merc_m)
-                cur_y = off_y + j * (usable_area_merc_m_height - overlap_margin_merc_m)
-                envelope = mapnik.Box2d(cur_x, cur_y,
-                                        cur_x+usable_area_merc_m_width,
-                                        cur_y+usable_area_merc_m_height)
-
-                envelope_inner = mapnik.Box2d(cur_x + grayed_margin_merc_m,
-                                              cur_y + grayed_margin_merc_m,
-                                              cur_x + usable_area_merc_m_width  - grayed_margin_merc_m,
-                                              cur_y + usable_area_merc_m_height - grayed_margin_merc_m)
-                inner_bb = self._inverse_envelope(envelope_inner)
-                if not area_polygon.disjoint(shapely.wkt.loads(
-                                                inner_bb.as_wkt())):
+                inner_bb = coords.BoundingBox(inner_tops[j], inner_lefts[i],
+                                              inner_bottoms[j], inner_rights[i])
+                inner_box = self._bbox_to_shapely(inner_bb)
+                if (row_area is not None
+                    and prepared_row_area.intersects(inner_box)):
                     self.page_disposition[col].append(map_number)
                     map_number += 1
-                    bboxes.append((self._inverse_envelope(envelope),
-                                   inner_bb))
+                    bboxes.append((coords.BoundingBox(tops[j], lefts[i],
+                                                      bottoms[j], rights[i]),
+                                   inner_bb, inner_box,
+                                   row_area.intersection(inner_box)))
+                    # Position of the page on the whole map (in points)
+                    page_offsets.append(
+                        (i * (self._usable_area_width_pt - overlap_margin_pt),
+                         col * (self._usable_area_height_pt
+                                - overlap_margin_pt)))
                 else:
                     self.page_disposition[col].append(None)
         # Debug: show per-page bounding boxes as JS code
-        # for i, (bb, bb_inner) in enumerate(bboxes):
+        # for i, (bb, bb_inner, _, _) in enumerate(bboxes):
         #    print bb.as_javascript(name="p%d" % i)
 
         self.pages = []
+        self._page_offsets = page_offsets
+
+        # Build the indexes of the pages in the background while their
+        # canvases are prepared
+        index_jobs = self._start_street_indexes(
+            [(inside_contour.wkt, i + 4)
+             for i, (bb, bb_inner, interior, inside_contour)
+             in enumerate(bboxes)])
 
         # Create an overview map
 
         overview_bb = self._geo_bbox.create_expanded(0.001, 0.001)
         # Create the overview grid
         self.overview_grid = OverviewGrid(overview_bb,
-                     [bb_inner for bb, bb_inner in bboxes], self.rc.i18n.isrtl())
+                     [bb_inner for bb, bb_inner, _, _ in bboxes],
+                     self.rc.i18n.isrtl())
 
         grid_shape = self.overview_grid.generate_shape_file(
                     os.path.join(self.tmpdir, 'grid_overview.shp'))
@@ -213,13 +279,13 @@ class MultiPageRenderer(Renderer):
         self.overview_canvas = MapCanvas(self.rc.stylesheet,
                                overview_bb, self._usable_area_width_pt,
                                self._usable_area_height_pt, dpi,
-                               extend_bbox_to_ratio=True)
+                               extend_bbox_to_ratio=True,
+                               base_map_cache=self.rc.base_map_cache)
 
         # Create the gray shape around the overview map
-        exterior = shapely.wkt.loads(self.overview_canvas.get_actual_bounding_box()\
-                                                                .as_wkt())
-        interior = shapely.wkt.loads(self.rc.polygon_wkt)
-        shade_wkt = exterior.difference(interior).wkt
+        exterior = self._bbox_to_shapely(
+            self.overview_canvas.get_actual_bounding_box())
+        shade_wkt = exterior.difference(self._area_polygon).wkt
         shade = maplib.shapes.PolyShapeFile(self.rc.bounding_box,
                 os.path.join(self.tmpdir, 'shape_overview.shp'),
                              'shade-overview')
@@ -234,11 +300,11 @@ class MultiPageRenderer(Renderer):
 
         # Create the map canvas for each page
         indexes = []
-        for i, (bb, bb_inner) in enumerate(bboxes):
+        for i, (bb, bb_inner, interior, inside_contour) in enumerate(bboxes):
+            self._check_cancelled()
 
             # Create the gray shape around the map
-            exterior = shapely.wkt.loads(bb.as_wkt())
-            interior = shapely.wkt.loads(bb_inner.as_wkt())
+            exterior = self._bbox_to_shapely(bb)
             shade_wkt = exterior.difference(interior).wkt
             shade = maplib.shapes.PolyShapeFile(
                 bb, os.path.join(self.tmpdir, 'shade%d.shp' % i),
@@ -248,10 +314,8 @@ class MultiPageRenderer(Renderer):
 
             # Create the contour shade
 
-            # Area to keep visible
-            interior_contour = shapely.wkt.loads(self.rc.polygon_wkt)
-            # Determine the shade WKT
-            shade_contour_wkt = interior.difference(interior_contour).wkt
+            # Determine the shade WKT from the area to keep visible
+            shade_contour_wkt = interior.difference(inside_contour).wkt
             # Prepare the shade SHP
             shade_contour = maplib.shapes.PolyShapeFile(bb,
                 os.path.join(self.tmpdir, 'shade_contour%d.shp' % i),
@@ -259,11 +323,15 @@ class MultiPageRenderer(Renderer):
             shade_contour.add_shade_from_wkt(shade_contour_wkt)
 
 
-            # Create one canvas for the current page
+            # Create one canvas for the current page. When the whole map
+            # is rendered at once, it only holds the overlays of the page.
             map_canvas = MapCanvas(self.rc.stylesheet,
                                    bb, self._usable_area_width_pt,
                                    self._usable_area_height_pt, dpi,
-                                   extend_bbox_to_ratio=False)
+                                   extend_bbox_to_ratio=False,
+                                   load_stylesheet=(
+                                       self._whole_map_canvas is None),
+                                   base_map_cache=self.rc.base_map_cache)
 
             # Create the grid
             map_grid = Grid(bb_inner, map_canvas.get_actual_scale(), self.rc.i18n.isrtl())
@@ -282,12 +350,9 @@ class MultiPageRenderer(Renderer):
             map_canvas.render()
             self.pages.append((map_canvas, map_grid))
 
-            # Create the index for the current page
-            inside_contour_wkt = interior_contour.intersection(interior).wkt
-            index = StreetIndex(self.db,
-                                inside_contour_wkt,
-                                self.rc.i18n, page_number=(i + 4))
-
+        # Wait for the index of each page
+        for index_job, (map_canvas, map_grid) in zip(index_jobs, self.pages):
+            index = index_job.result()
             index.apply_grid(map_grid)
             indexes.append(index)
 
@@ -374,22 +439,131 @@ class MultiPageRenderer(Renderer):
             else:
                 prev_label = item.label
 
+    def _use_single_render(self, total_width_pt, total_height_pt, dpi):
+        """Tell whether the map pages are sliced from a single rendering of
+        the whole map of total_width_pt x total_height_pt points."""
+        if not self.rc.multi_page_single_render:
+            return False
+
+        if not hasattr(cairo, 'RecordingSurface'):
+            LOG.warning('Cairo recording surfaces not available, '
+                        'rendering each map page separately.')
+            return False
+
+        max_dots = MultiPageRenderer.SINGLE_RENDER_MAX_DOTS
+        if (commons.convert_pt_to_dots(total_width_pt, dpi) > max_dots
+            or commons.convert_pt_to_dots(total_height_pt, dpi) > max_dots):
+            LOG.info('Map too large to be rendered at once, '
+                     'rendering each map page separately.')
+            return False
+
+        return True
+
+    def _record_whole_map(self):
+        """Render the whole map once into a recording surface, from which
+        the map pages are then painted."""
+        rendered_map = self._whole_map_canvas.get_rendered_map()
+        LOG.info('Rendering the whole map on %dx%d dots...'
+                 % (rendered_map.width, rendered_map.height))
+        self._whole_map = cairo.RecordingSurface(
+            cairo.CONTENT_COLOR_ALPHA,
+            (0, 0, rendered_map.width, rendered_map.height))
+        self._whole_map_canvas.draw(cairo.Context(self._whole_map))
+
+    def _render_map_page(self, ctx, map_number, canvas, dpi):
+        """Render the map of the given page at the current position: either
+        its own Mapnik map, or its slice of the whole map followed by its
+        overlays."""
+        rendered_map = canvas.get_rendered_map()
+        LOG.debug('Mapnik scale: 1/%f' % rendered_map.scale_denominator())
+        LOG.debug('Actual scale: 1/%f' % canvas.get_actual_scale())
+
+        if self._whole_map is not None:
+            offset_x, offset_y = self._page_offsets[map_number]
+            ctx.save()
+            ctx.rectangle(0, 0,
+                  commons.convert_pt_to_dots(self._usable_area_width_pt, dpi),
+                  commons.convert_pt_to_dots(self._usable_area_height_pt, dpi))
+            ctx.clip()
+            ctx.set_source_surface(self._whole_map,
+                  -commons.convert_pt_to_dots(offset_x, dpi),
+                  -commons.convert_pt_to_dots(offset_y, dpi))
+            ctx.paint()
+            ctx.restore()
+
+        canvas.draw(ctx)
+
+    @staticmethod
+    def _get_page_count(total_pt, usable_area_pt, overlap_margin_pt):
+        """Return the number of pages needed in one direction to cover
+        total_pt of paper, given the usable size of one page and the
+        overlap between consecutive pages (all in points)."""
+        if total_pt < usable_area_pt:
+            return 1
+
+        # Round up the number of pages needed so that we have integer
+        # number of pages
+        return int(math.ceil(float(total_pt - usable_area_pt)
+                             / (usable_area_pt - overlap_margin_pt) + 1))
+
+    @staticmethod
+    def get_estimated_page_count(bounding_box, paper_width_mm,
+                                 paper_height_mm, index_size=0):
+        """Returns an upper bound of the number of pages of the document,
+        without rendering anything.
+
+        Args:
+            bounding_box (coords.BoundingBox): the map geographic bounding box.
+            paper_width_mm, paper_height_mm (numbers): the paper size.
+            index_size (int): expected number of items in the index.
+        """
+        usable_area_width_pt = (commons.convert_mm_to_pt(paper_width_mm)
+                                - 2 * Renderer.PRINT_SAFE_MARGIN_PT)
+        usable_area_height_pt = (commons.convert_mm_to_pt(paper_height_mm)
+                                 - 2 * Renderer.PRINT_SAFE_MARGIN_PT)
+        overlap_margin_pt = \
+            commons.convert_mm_to_pt(MultiPageRenderer.OVERLAP_MARGIN_MM)
+
+        minx, miny, maxx, maxy = bounding_box.to_mercator_envelope()
+        grayed_margins_mm = 2 * MultiPageRenderer.GRAYED_MARGIN_MM
+        total_width_pt = commons.convert_mm_to_pt(
+            (maxx - minx) * 1000
+            / MultiPageRenderer.SCALE_DENOM + grayed_margins_mm)
+        total_height_pt = commons.convert_mm_to_pt(
+            (maxy - miny) * 1000
+            / MultiPageRenderer.SCALE_DENOM + grayed_margins_mm)
+
+        map_pages = (MultiPageRenderer._get_page_count(
+                total_width_pt, usable_area_width_pt, overlap_margin_pt)
+                     * MultiPageRenderer._get_page_count(
+                total_height_pt, usable_area_height_pt, overlap_margin_pt))
+
+        index_items_per_page = \
+            (max(1, int(usable_area_width_pt
+                        / MultiPageRenderer.INDEX_COLUMN_WIDTH_PT))
+             * int(usable_area_height_pt
+                   / MultiPageRenderer.INDEX_LINE_HEIGHT_PT))
+        index_pages = int(math.ceil(float(index_size) / index_items_per_page))
+
+        # Front page, blank page and overview page come first
+        return 3 + map_pages + index_pages
+
+    @staticmethod
+    def _bbox_to_shapely(bbox):
+        """Return the given bounding box as a shapely Polygon."""
+        lat1, long1 = bbox.get_top_left()
+        lat2, long2 = bbox.get_bottom_right()
+        return shapely.geometry.box(long1, lat2, long2, lat1)
+
     def _project_envelope(self, bbox):
         """Project the given bounding box into the rendering projection."""
-        envelope = mapnik.Box2d(bbox.get_top_left()[1],
-                                bbox.get_top_left()[0],
-                                bbox.get_bottom_right()[1],
-                                bbox.get_bottom_right()[0])
-        c0 = self._proj.forward(mapnik.Coord(envelope.minx, envelope.miny))
-        c1 = self._proj.forward(mapnik.Coord(envelope.maxx, envelope.maxy))
-        return mapnik.Box2d(c0.x, c0.y, c1.x, c1.y)
+        return mapnik.Box2d(*bbox.to_mercator_envelope())
 
     def _inverse_envelope(self, envelope):
         """Inverse the given cartesian envelope (in 900913) back to a 4002
         bounding box."""
-        c0 = self._proj.inverse(mapnik.Coord(envelope.minx, envelope.miny))
-        c1 = self._proj.inverse(mapnik.Coord(envelope.maxx, envelope.maxy))
-        return coords.BoundingBox(c0.y, c0.x, c1.y, c1.x)
+        return coords.BoundingBox.from_mercator_envelope(
+            envelope.minx, envelope.miny, envelope.maxx, envelope.maxy)
 
     def _prepare_front_page_map(self, dpi):
         front_page_map_w = \
@@ -404,13 +578,14 @@ class MultiPageRenderer(Renderer):
                       front_page_map_w,
                       front_page_map_h,
                       dpi,
-                      extend_bbox_to_ratio=True)
+                      extend_bbox_to_ratio=True,
+                      base_map_cache=self.rc.base_map_cache)
 
         # Add the shape that greys out everything that is outside of
         # the administrative boundary.
-        exterior = shapely.wkt.loads(front_page_map.get_actual_bounding_box().as_wkt())
-        interior = shapely.wkt.loads(self.rc.polygon_wkt)
-        shade_wkt = exterior.difference(interior).wkt
+        exterior = self._bbox_to_shapely(
+            front_page_map.get_actual_bounding_box())
+        shade_wkt = exterior.difference(self._area_polygon).wkt
         shade = maplib.shapes.PolyShapeFile(self.rc.bounding_box,
                 os.path.join(self.tmpdir, 'shape_overview_cover.shp'),
                              'shade-overview-cover')
@@ -436,7 +611,7 @@ class MultiPageRenderer(Renderer):
         ctx.translate(0, 0.3 * h + Renderer.PRINT_SAFE_MARGIN_PT)
 
         # Render the map !
-        mapnik.render(self._front_page_map.get_rendered_map(), ctx)
+        self._front_page_map.draw(ctx)
         ctx.restore()
 
     def _render_front_page_footer(self, ctx, w, h, osm_date):
@@ -465,6 +640,7 @@ class MultiPageRenderer(Renderer):
             ctx.restore()
 
         # Prepare the text for the left of the footer
+        _ = self.rc.i18n.gettext
         today = datetime.date.today()
         notice = \
             _(u'Copyright © %(year)d MapOSMatic/OCitySMap developers.\n'
@@ -534,6 +710,7 @@ class MultiPageRenderer(Renderer):
                 commons.convert_pt_to_dots(Renderer.PRINT_SAFE_MARGIN_PT))
 
         # footer notice
+        _ = self.rc.i18n.gettext
         w = self._usable_area_width_pt
         h = self._usable_area_height_pt
         ctx.set_source_rgb(.6,.6,.6)
@@ -548,8 +725,7 @@ class MultiPageRenderer(Renderer):
         ctx.restore()
 
     def _render_overview_page(self, ctx, cairo_surface, dpi):
-        rendered_map = self.overview_canvas.get_rendered_map()
-        mapnik.render(rendered_map, ctx)
+        self.overview_canvas.draw(ctx)
 
         # draw pages numbers
         self._draw_overview_labels(ctx, self.overview_canvas, self.overview_grid,
@@ -673,12 +849,14 @@ class MultiPageRenderer(Renderer):
 
         self._render_overview_page(ctx, cairo_surface, dpi)
 
+        if self._whole_map_canvas is not None and self._whole_map is None:
+            self._check_cancelled()
+            self._record_whole_map()
+
         for map_number, (canvas, grid) in enumerate(self.pages):
+            self._check_cancelled()
 
-            rendered_map = canvas.get_rendered_map()
-            LOG.debug('Mapnik scale: 1/%f' % rendered_map.scale_denominator())
-            LOG.debug('Actual scale: 1/%f' % canvas.get_actual_scale())
-            mapnik.render(rendered_map, ctx)
+            self._render_map_page(ctx, map_number, canvas, dpi)
 
             # Place the vertical and horizontal square labels
             ctx.save()
@@ -755,16 +933,14 @@ class MultiPageRenderer(Renderer):
         ctx.set_font_size(14)
 
         bbox = map_canvas.get_actual_bounding_box()
-        bottom_right, bottom_left, top_left, top_right = bbox.to_mercator()
-        bottom, left = bottom_right.y, top_left.x
-        coord_delta_y = top_left.y - bottom_right.y
-        coord_delta_x = bottom_right.x - top_left.x
+        left, bottom, right, top = bbox.to_mercator_envelope()
+        coord_delta_y = top - bottom
+        coord_delta_x = right - left
         w, h = None, None
-        for idx, page_bb in enumerate(overview_grid._pages_bbox):
-            p_bottom_right, p_bottom_left, p_top_left, p_top_right = \
-                                                        page_bb.to_mercator()
-            center_x = p_top_left.x+(p_top_right.x-p_top_left.x)/2
-            center_y = p_bottom_left.y+(p_top_right.y-p_bottom_right.y)/2
+        page_envelopes = coords.bboxes_to_mercator(overview_grid._pages_bbox)
+        for idx, (p_minx, p_miny, p_maxx, p_maxy) in enumerate(page_envelopes):
+            center_x = p_minx+(p_maxx-p_minx)/2
+            center_y = p_miny+(p_maxy-p_miny)/2
             y_percent = 100 - 100.0*(center_y - bottom)/coord_delta_y
             y = int(area_height_dots*y_percent/100)
 
@@ -772,10 +948,8 @@ class MultiPageRenderer(Renderer):
             x = int(area_width_dots*x_percent/100)
 
             if not w or not h:
-                w = area_width_dots*(p_bottom_right.x - p_bottom_left.x
-                                                         )/coord_delta_x
-                h = area_height_dots*(p_top_right.y - p_bottom_right.y
-                                                         )/coord_delta_y
+                w = area_width_dots*(p_maxx - p_minx)/coord_delta_x
+                h = area_height_dots*(p_maxy - p_miny)/coord_delta_y
             draw_utils.draw_text_adjusted(ctx, unicode(idx+4), x, y, w, h,
                  max_char_number=len(unicode(len(overview_grid._pages_bbox)+3)),
                  text_color=(0, 0, 0, 0.6))
@@ -22,23 +22,21 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import cairo
 import datetime
 import locale
 import logging
-import mapnik
-assert mapnik.mapnik_version >= 200100, \
-    "Mapnik module version %s is too old, see ocitysmap's INSTALL " \
-    "for more details." % mapnik.mapnik_version_string()
 import math
-import pango
-import pangocairo
+import sys
+
+from ocitysmap.lazy_modules import cairo, mapnik, pango, pangocairo
 
 import commons
 import ocitysmap
 from abstract_renderer import Renderer
-from ocitysmap.indexlib.renderer import StreetIndexRenderer
-from indexlib.indexer import StreetIndex
+from multi_page_renderer import MultiPageRenderer
+from ocitysmap.indexlib.indexer import StreetIndex
+from ocitysmap.indexlib.renderer import StreetIndexRenderer, \
+    StreetIndexRenderingArea
 from indexlib.commons import IndexDoesNotFitError, IndexEmptyError
 import draw_utils
 
@@ -70,13 +68,31 @@ class SinglePageRenderer(Renderer):
         """
         Renderer.__init__(self, db, rc, tmpdir, dpi)
 
-        # Prepare the index
-        self.street_index = StreetIndex(db,
-                                        rc.polygon_wkt,
-                                        rc.i18n)
-        if not self.street_index.categories:
-            LOG.warning("Designated area leads to an empty index")
-            self.street_index = None
+        try:
+            self._prepare_page(db, rc, dpi, file_prefix, index_position)
+        except Exception:
+            exc_type, exc_value, exc_traceback = sys.exc_info()
+            self._stop_street_indexes()
+            raise exc_type, exc_value, exc_traceback
+
+    def _prepare_page(self, db, rc, dpi, file_prefix, index_position):
+        """Prepare the index, the layout and the map of the page (see
+        __init__())."""
+        # Prepare the index. Previews only estimate its size. The index
+        # is built in the background, and only waited for here when the
+        # layout of the page depends on it.
+        self.street_index = None
+        index_job = None
+        if rc.preview:
+            if index_position:
+                preview_index_size = StreetIndex.estimate_size(
+                    db, rc.bounding_box)
+        else:
+            index_job, = self._start_street_indexes([(rc.polygon_wkt, None)])
+            if index_position:
+                self.street_index = self._wait_for_street_index(index_job)
+                index_job = None
+        self._check_cancelled()
 
         self._grid_legend_margin_pt = \
             min(Renderer.GRID_LEGEND_MARGIN_RATIO * self.paper_width_pt,
@@ -92,8 +108,12 @@ class SinglePageRenderer(Renderer):
                                         self._copyright_margin_pt))
 
         # Prepare the Index (may raise a IndexDoesNotFitError)
-        if ( index_position and self.street_index
-             and self.street_index.categories ):
+        if index_position and rc.preview:
+            self._index_renderer = None
+            self._index_area = self._estimate_index_area(
+                index_position == "side", preview_index_size)
+        elif ( index_position and self.street_index
+               and self.street_index.categories ):
             self._index_renderer, self._index_area \
                 = self._create_index_rendering(index_position == "side")
         else:
@@ -137,15 +157,22 @@ class SinglePageRenderer(Renderer):
             raise AssertionError("Invalid index position %s"
                                  % repr(index_position))
 
+        self._check_cancelled()
+
         # Prepare the map
         self._map_canvas = self._create_map_canvas(
             float(self._map_coords[2]),  # W
             float(self._map_coords[3]),  # H
             dpi )
+        self._check_cancelled()
 
         # Prepare the grid
         self.grid = self._create_grid(self._map_canvas)
 
+        # Wait for the index, when the layout did not need it
+        if index_job is not None:
+            self.street_index = self._wait_for_street_index(index_job)
+
         # Update the street_index to reflect the grid's actual position
         if self.grid and self.street_index:
             self.street_index.apply_grid(self.grid)
@@ -158,6 +185,16 @@ class SinglePageRenderer(Renderer):
         self._map_canvas.render()
 
 
+    @staticmethod
+    def _wait_for_street_index(index_job):
+        """Return the StreetIndex built by the given StreetIndexJob, or
+        None if it is empty."""
+        street_index = index_job.result()
+        if not street_index.categories:
+            LOG.warning("Designated area leads to an empty index")
+            return None
+        return street_index
+
     def _create_index_rendering(self, on_the_side):
         """
         Prepare to render the Street index.
@@ -219,6 +256,52 @@ class SinglePageRenderer(Renderer):
         return index_renderer, index_area
 
 
+    def _estimate_index_area(self, on_the_side, index_size):
+        """
+        Estimate the area of an index of index_size items, without
+        laying it out, for the previews.
+
+        Args:
+           on_the_side (bool): True=index on the side, False=at bottom.
+           index_size (int): estimated number of items of the index.
+
+        Return a StreetIndexRenderingArea without rendering style, or None
+        if the index is empty.
+        """
+        if not index_size:
+            return None
+
+        line_height_pt = MultiPageRenderer.INDEX_LINE_HEIGHT_PT
+        column_width_pt = MultiPageRenderer.INDEX_COLUMN_WIDTH_PT
+
+        if on_the_side:
+            index_max_width_pt \
+                = self.MAX_INDEX_OCCUPATION_RATIO * self._usable_area_width_pt
+            lines_per_column = max(1, int(self._usable_area_height_pt
+                                          / line_height_pt))
+            n_cols = int(math.ceil(float(index_size) / lines_per_column))
+            w = min(index_max_width_pt, n_cols * column_width_pt)
+            h = self._usable_area_height_pt
+            y = Renderer.PRINT_SAFE_MARGIN_PT + self._title_margin_pt
+            if not self.rc.i18n.isrtl():
+                x = (self.paper_width_pt - Renderer.PRINT_SAFE_MARGIN_PT
+                     - w)
+            else:
+                x = Renderer.PRINT_SAFE_MARGIN_PT
+        else:
+            index_max_height_pt \
+                = self.MAX_INDEX_OCCUPATION_RATIO * self._usable_area_height_pt
+            n_cols = max(1, int(self._usable_area_width_pt
+                                / column_width_pt))
+            n_lines = int(math.ceil(float(index_size) / n_cols))
+            w = self._usable_area_width_pt
+            h = min(index_max_height_pt, n_lines * line_height_pt)
+            x = Renderer.PRINT_SAFE_MARGIN_PT
+            y = (self.paper_height_pt - Renderer.PRINT_SAFE_MARGIN_PT
+                 - self._copyright_margin_pt - h)
+
+        return StreetIndexRenderingArea(None, x, y, w, h, n_cols)
+
     def _draw_title(self, ctx, w_dots, h_dots, font_face):
         """
         Draw the title at the current position inside a
@@ -285,6 +368,7 @@ class SinglePageRenderer(Renderer):
            notice (str): Optional notice to replace the default.
         """
 
+        _ = self.rc.i18n.gettext
         today = datetime.date.today()
         notice = notice or \
             _(u'Copyright © %(year)d MapOSMatic/OCitySMap developers. '
@@ -381,6 +465,18 @@ class SinglePageRenderer(Renderer):
 
             ctx.restore()
 
+        elif self._index_area:
+            # Preview: only show where the index would be
+            ctx.save()
+            ctx.set_source_rgb(0.9, 0.9, 0.9)
+            ctx.rectangle(commons.convert_pt_to_dots(self._index_area.x, dpi),
+                          commons.convert_pt_to_dots(self._index_area.y, dpi),
+                          commons.convert_pt_to_dots(self._index_area.w, dpi),
+                          commons.convert_pt_to_dots(self._index_area.h, dpi))
+            ctx.fill()
+            ctx.restore()
+
+        if self._index_area:
             # Also draw a rectangle
             ctx.save()
             ctx.rectangle(commons.convert_pt_to_dots(self._index_area.x, dpi),
@@ -391,6 +487,8 @@ class SinglePageRenderer(Renderer):
             ctx.restore()
 
 
+        self._check_cancelled()
+
         ##
         ## Draw the map, scaled to fit the designated area
         ##
@@ -404,7 +502,7 @@ class SinglePageRenderer(Renderer):
         rendered_map = self._map_canvas.get_rendered_map()
         LOG.debug('Mapnik scale: 1/%f' % rendered_map.scale_denominator())
         LOG.debug('Actual scale: 1/%f' % self._map_canvas.get_actual_scale())
-        mapnik.render(rendered_map, ctx)
+        self._map_canvas.draw(ctx)
         ctx.restore()
 
         # Draw a rectangle around the map
@@ -638,12 +736,6 @@ if __name__ == '__main__':
     import coords
     from ocitysmap import i18n
 
-    # Hack to fake gettext
-    try:
-        _(u"Test gettext")
-    except NameError:
-        __builtins__.__dict__["_"] = lambda x: x
-
     logging.basicConfig(level=logging.DEBUG)
 
     bbox = coords.BoundingBox(48.8162, 2.3417, 48.8063, 2.3699)
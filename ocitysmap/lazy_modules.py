@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+
+# ocitysmap, city map and street index generator from OpenStreetMap data
+# Copyright (C) 2010  David Decotigny
+# Copyright (C) 2010  Frédéric Lehobey
+# Copyright (C) 2010  Pierre Mauduit
+# Copyright (C) 2010  David Mentré
+# Copyright (C) 2010  Maxime Petazzoni
+# Copyright (C) 2010  Thomas Petazzoni
+# Copyright (C) 2010  Gaël Utard
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Lazily imported rendering dependencies.
+
+Importing cairo, Mapnik, Pango, psycopg2, shapely and GDAL is slow and
+memory hungry, and only needed to render maps. The modules of OCitySMap
+use the proxies of this module instead of importing them directly: each
+dependency is only imported on the first access to one of its attributes.
+The metadata API of OCitySMap (renderers, paper sizes, stylesheets) is
+then usable by importing ocitysmap alone, even without Mapnik installed.
+"""
+
+import importlib
+import threading
+
+
+class LazyModule:
+    """
+    A LazyModule stands for a module imported on the first access to one
+    of its attributes.
+    """
+
+    def __init__(self, names, submodules=(), on_import=None):
+        """
+        Args:
+           names (list of str): names of the module, the first one that
+               can be imported is used.
+           submodules (list of str): submodules imported along with the
+               module (e.g. 'wkt' for shapely.wkt).
+           on_import (function): None or a function called with the module
+               once imported.
+        """
+        self._names      = names
+        self._submodules = submodules
+        self._on_import  = on_import
+        self._module     = None
+        self._lock       = threading.RLock()
+
+    def _load(self):
+        with self._lock:
+            if self._module is None:
+                for name in self._names:
+                    try:
+                        module = importlib.import_module(name)
+                        break
+                    except ImportError:
+                        if name == self._names[-1]:
+                            raise
+                for submodule in self._submodules:
+                    importlib.import_module('%s.%s' % (module.__name__,
+                                                       submodule))
+                if self._on_import is not None:
+                    self._on_import(module)
+                self._module = module
+        return self._module
+
+    def __getattr__(self, name):
+        return getattr(self._load(), name)
+
+    def __repr__(self):
+        return '<lazy module %s>' % self._names[0]
+
+
+def _check_mapnik_version(mapnik):
+    # Importing mapnik2 raises a DeprecationWarning as of mapnik
+    # commit 14700dba. As mapnik 2.1 (or git version with support for
+    # placement-type="simple") is required for OCitySMap (see INSTALL),
+    # instead of importing mapnik2, we import mapnik and assert it isn't
+    # an old version.
+    assert mapnik.mapnik_version >= 200100, \
+        "Mapnik module version %s is too old, see ocitysmap's INSTALL " \
+        "for more details." % mapnik.mapnik_version_string()
+
+def _register_psycopg2_types(psycopg2):
+    # compatibility with django: see http://code.djangoproject.com/ticket/5996
+    psycopg2.extensions.register_type(psycopg2.extensions.UNICODE)
+
+
+cairo      = LazyModule(['cairo'])
+mapnik     = LazyModule(['mapnik'], on_import=_check_mapnik_version)
+pango      = LazyModule(['pango'])
+pangocairo = LazyModule(['pangocairo'])
+psycopg2   = LazyModule(['psycopg2'], ['extensions', 'pool'],
+                        _register_psycopg2_types)
+shapely    = LazyModule(['shapely'], ['geometry', 'prepared', 'wkt'])
+
+# The ogr module is now known as osgeo.ogr in recent versions of the
+# module, but we want to keep compatibility with older versions
+ogr        = LazyModule(['osgeo.ogr', 'ogr'])
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+
+# ocitysmap, city map and street index generator from OpenStreetMap data
+# Copyright (C) 2010  David Decotigny
+# Copyright (C) 2010  Frédéric Lehobey
+# Copyright (C) 2010  Pierre Mauduit
+# Copyright (C) 2010  David Mentré
+# Copyright (C) 2010  Maxime Petazzoni
+# Copyright (C) 2010  Thomas Petazzoni
+# Copyright (C) 2010  Gaël Utard
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import collections
+import logging
+import os
+import threading
+
+from ocitysmap.lazy_modules import cairo, mapnik
+
+l = logging.getLogger('ocitysmap')
+
+
+class BaseMapCache:
+    """
+    The BaseMapCache keeps, in memory, the Mapnik renderings of the
+    stylesheets alone (without the grid and shade overlays of the
+    MapCanvas objects) as cairo recording surfaces. Rendering the same
+    area again with another language, layout option or grid only replays
+    the recording instead of running Mapnik and its database queries.
+
+    Entries are keyed by the stylesheet (path and modification time), the
+    projected envelope and the pixel size of the map, and the whole cache
+    is dropped when the OSM data is updated (see set_data_version()). The
+    least recently used entries are evicted first.
+    """
+
+    def __init__(self, max_entries):
+        """
+        Args:
+           max_entries (int): maximum number of base maps kept in memory.
+        """
+        self._max_entries  = max_entries
+        self._entries      = collections.OrderedDict()
+        self._data_version = None
+        self._lock         = threading.Lock()
+
+    @staticmethod
+    def is_available():
+        """Return True if the cairo bindings support recording surfaces."""
+        return hasattr(cairo, 'RecordingSurface')
+
+    def set_data_version(self, data_version):
+        """Set the version (e.g. the last update date) of the OSM data the
+        maps are rendered from, dropping all the entries if it changed."""
+        with self._lock:
+            if data_version != self._data_version:
+                if self._entries:
+                    l.info('OSM data updated, dropping %d cached base maps.'
+                           % len(self._entries))
+                self._entries.clear()
+                self._data_version = data_version
+
+    def get(self, stylesheet, envelope, width, height, projection):
+        """Return a cairo recording surface of width x height dots holding
+        the base map of the given envelope, rendering it if needed.
+
+        Args:
+           stylesheet (Stylesheet): map stylesheet.
+           envelope (mapnik.Box2d): projected area of the map.
+           width, height (int): size of the map (dots).
+           projection (str): the projection of the envelope.
+        """
+        key = (stylesheet.path, os.path.getmtime(stylesheet.path),
+               envelope.minx, envelope.miny, envelope.maxx, envelope.maxy,
+               width, height, projection)
+
+        with self._lock:
+            surface = self._entries.pop(key, None)
+            if surface is not None:
+                self._entries[key] = surface
+                l.debug('Using cached base map of %s.' % stylesheet.path)
+                return surface
+
+        surface = self._render(stylesheet, envelope, width, height,
+                               projection)
+
+        with self._lock:
+            self._entries[key] = surface
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+        return surface
+
+    @staticmethod
+    def _render(stylesheet, envelope, width, height, projection):
+        l.info('Rendering base map on %dx%d dots...' % (width, height))
+        base_map = mapnik.Map(width, height, projection)
+        stylesheet.load_map(base_map)
+        base_map.zoom_to_box(envelope)
+
+        surface = cairo.RecordingSurface(cairo.CONTENT_COLOR_ALPHA,
+                                         (0, 0, width, height))
+        mapnik.render(base_map, cairo.Context(surface))
+        return surface
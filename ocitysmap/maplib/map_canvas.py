@@ -23,20 +23,11 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import logging
-
-# Importing mapnik2 raises a DeprecationWarning as of mapnik
-# commit 14700dba. As mapnik 2.1 (or git version with support for
-# placement-type="simple") is required for OCitySMap (see INSTALL),
-# instead of importing mapnik2, we import mapnik and assert it isn't
-# an old version.
-import mapnik
-assert mapnik.mapnik_version >= 200100, \
-    "Mapnik module version %s is too old, see ocitysmap's INSTALL " \
-    "for more details." % mapnik.mapnik_version_string()
-
 import math
 import os
 
+from ocitysmap.lazy_modules import mapnik
+
 import ocitysmap
 from layoutlib.commons import convert_pt_to_dots
 import shapes
@@ -56,7 +47,8 @@ class MapCanvas:
     """
 
     def __init__(self, stylesheet, bounding_box, _width, _height, dpi,
-                 extend_bbox_to_ratio=True):
+                 extend_bbox_to_ratio=True, load_stylesheet=True,
+                 base_map_cache=None, min_scale_denominator=None):
         """Initialize the map canvas for rendering.
 
         Args:
@@ -66,10 +58,17 @@ class MapCanvas:
             extend_bbox_to_ratio (boolean): allow MapCanvas to extend
             the bounding box to make it match the ratio of the
             provided rendering area. Needed by SinglePageRenderer.
+            load_stylesheet (boolean): load the layers of the stylesheet.
+            Without them, only the added shapes are rendered, on a
+            transparent background.
+            base_map_cache (BaseMapCache): None or the cache the map
+            of the stylesheet is taken from (see draw()).
+            min_scale_denominator (float): None or the smallest Mapnik
+            scale denominator the map is rendered at. Larger scales are
+            rendered on fewer pixels, scaled up when drawn, so that the
+            stylesheet renders them with less details.
         """
 
-        self._proj = mapnik.Projection(_MAPNIK_PROJECTION)
-
         # This is where the magic of the map canvas happens. Given an original
         # bounding box and a graphical ratio for the output, the bounding box
         # is adjusted (extended) to fill the destination zone. See
@@ -97,9 +96,30 @@ class MapCanvas:
         # Create the Mapnik map with the corrected width and height and zoom to
         # the corrected bounding box ('envelope' in the Mapnik jargon)
         self._map = mapnik.Map(g_width, g_height, _MAPNIK_PROJECTION)
-        mapnik.load_map(self._map, stylesheet.path)
+        if load_stylesheet and base_map_cache is None:
+            stylesheet.load_map(self._map)
         self._map.zoom_to_box(envelope)
 
+        # Zoom factor applied when drawing the map, see
+        # min_scale_denominator
+        self._zoom = 1.
+        if (min_scale_denominator is not None
+            and self._map.scale_denominator() < min_scale_denominator):
+            self._zoom = min_scale_denominator / self._map.scale_denominator()
+            g_width  = max(1, int(g_width / self._zoom))
+            g_height = max(1, int(g_height / self._zoom))
+            self._map.resize(g_width, g_height)
+            self._map.zoom_to_box(envelope)
+
+        # With a base map cache, the Mapnik map only holds the shapes,
+        # drawn on top of the cached map of the stylesheet
+        if load_stylesheet and base_map_cache is not None:
+            self._base_map_cache = base_map_cache
+        else:
+            self._base_map_cache = None
+        self._stylesheet = stylesheet
+        self._envelope   = envelope
+
         # Added shapes to render
         self._shapes = []
 
@@ -153,14 +173,34 @@ class MapCanvas:
     def get_rendered_map(self):
         return self._map
 
+    def draw(self, ctx):
+        """Draw the map and its shapes at the current position of the given
+        cairo context. The map of the stylesheet is taken from the base
+        map cache, if any."""
+        ctx.save()
+        ctx.scale(self._zoom, self._zoom)
+        if self._base_map_cache is not None:
+            base_map = self._base_map_cache.get(self._stylesheet,
+                                                self._envelope,
+                                                self._map.width,
+                                                self._map.height,
+                                                _MAPNIK_PROJECTION)
+            ctx.save()
+            ctx.set_source_surface(base_map, 0, 0)
+            ctx.paint()
+            ctx.restore()
+
+        mapnik.render(self._map, ctx)
+        ctx.restore()
+
     def get_actual_bounding_box(self):
         """Returns the actual geographic bounding box that will be rendered by
         Mapnik."""
         return self._geo_bbox
 
     def get_actual_scale(self):
-        # get the scale denominator computed by mapnik
-        scale = self._map.scale_denominator()
+        # get the scale denominator computed by mapnik, on the drawn map
+        scale = self._map.scale_denominator() / self._zoom
         # the actual scale depends on the latitude
         lat = self._geo_bbox.get_top_left()[0]
         scale *= math.cos(math.radians(lat))
@@ -174,7 +214,8 @@ class MapCanvas:
         shpid = os.path.basename(shape_file.get_filepath())
         s,r = mapnik.Style(), mapnik.Rule()
         r.symbols.append(mapnik.PolygonSymbolizer(color))
-        r.symbols.append(mapnik.LineSymbolizer(color, line_width))
+        r.symbols.append(mapnik.LineSymbolizer(color,
+                                               line_width / self._zoom))
         s.rules.append(r)
 
         self._map.append_style('style_%s' % shpid, s)
@@ -186,20 +227,13 @@ class MapCanvas:
 
     def _project_envelope(self, bbox):
         """Project the given bounding box into the rendering projection."""
-        envelope = mapnik.Box2d(bbox.get_top_left()[1],
-                                bbox.get_top_left()[0],
-                                bbox.get_bottom_right()[1],
-                                bbox.get_bottom_right()[0])
-        c0 = self._proj.forward(mapnik.Coord(envelope.minx, envelope.miny))
-        c1 = self._proj.forward(mapnik.Coord(envelope.maxx, envelope.maxy))
-        return mapnik.Box2d(c0.x, c0.y, c1.x, c1.y)
+        return mapnik.Box2d(*bbox.to_mercator_envelope())
 
     def _inverse_envelope(self, envelope):
         """Inverse the given cartesian envelope (in 900913) back to a 4002
         bounding box."""
-        c0 = self._proj.inverse(mapnik.Coord(envelope.minx, envelope.miny))
-        c1 = self._proj.inverse(mapnik.Coord(envelope.maxx, envelope.maxy))
-        return ocitysmap.coords.BoundingBox(c0.y, c0.x, c1.y, c1.x)
+        return ocitysmap.coords.BoundingBox.from_mercator_envelope(
+            envelope.minx, envelope.miny, envelope.maxx, envelope.maxy)
 
 if __name__ == '__main__':
     logging.basicConfig(level=logging.DEBUG)
@@ -26,12 +26,7 @@ import locale
 import logging
 import os
 
-# The ogr module is now known as osgeo.ogr in recent versions of the
-# module, but we want to keep compatibility with older versions
-try:
-    from osgeo import ogr
-except ImportError:
-    import ogr
+from ocitysmap.lazy_modules import ogr
 
 l = logging.getLogger('ocitysmap')
 
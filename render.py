@@ -98,6 +98,10 @@ def main():
                       help='set the output paper orientation. Either '
                             '"portrait" or "landscape". Defaults to portrait.',
                       default='portrait')
+    parser.add_option('--preview', dest='preview', action='store_true',
+                      default=False,
+                      help='only render a quick, low-resolution PNG '
+                           'preview of the page layout.')
 
     (options, args) = parser.parse_args()
     if len(args):
@@ -235,7 +239,7 @@ def main():
 
     # Go !...
     mapper.render(rc, cls_renderer.name, options.output_formats,
-                  options.output_prefix)
+                  options.output_prefix, preview=options.preview)
 
     return 0
 
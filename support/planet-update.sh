@@ -21,6 +21,15 @@ OSMOSIS_STATE=${OSMOSIS_WD}/state.txt
 OSMOSIS_CONFIG=${OSMOSIS_WD}/configuration.txt
 
 CURRENT_OSC=${OSMOSIS_WD}/changes.$$.osc.gz
+CURRENT_WAYS=${OSMOSIS_WD}/ways.$$.txt
+
+# Maintenance script of the precomputed table of streets used by the
+# street index, and the OCitySMap configuration file it gets the database
+# parameters from. STREET_TABLE is empty when the table is not used: set it
+# once the table is built (see "street_table.py create"), e.g. to
+# ${BASE_PATH}/ocitysmap/ocitysmap/indexlib/street_table.py
+STREET_TABLE=
+OCITYSMAP_CONFIG=${HOME}/.ocitysmap.conf
 
 log()
 {
@@ -32,7 +41,7 @@ error()
   log "ERROR: $1"
 
   log "Resetting state..."
-  rm -f ${PID_FILE} ${CURRENT_OSC}
+  rm -f ${PID_FILE} ${CURRENT_OSC} ${CURRENT_WAYS}
   cp -f ${OSMOSIS_WD}/last.state.txt ${OSMOSIS_STATE}
 
   echo "ERROR: $1"
@@ -104,12 +113,23 @@ rep=`cat ${OSMOSIS_STATE} |\
 	xargs -I{} date --utc --date "{}" +"%Y-%m-%d %H:%M:%S"`
 log "Update complete, database is now at ${rep} UTC."
 
+# Refresh the streets of the precomputed table affected by the modified
+# ways. A failure here does not invalidate the update: the table is only
+# slightly out of date until the next refresh or full build.
+if [ -n "${STREET_TABLE}" ] ; then
+  log "Refreshing street table..."
+  zgrep -o '<way id="[0-9]*"' ${CURRENT_OSC} | cut -d'"' -f2 | sort -u > ${CURRENT_WAYS}
+  if ! python ${STREET_TABLE} -c ${OCITYSMAP_CONFIG} refresh ${CURRENT_WAYS} >> "${LOG_FILE}" 2>&1 ; then
+    log "WARNING: street table refresh failed."
+  fi
+fi
+
 # Update the maposmatic_admin table with the last update timestamp of
 # the OSM data
 log "Updating last_update time to ${rep} in information table..."
 echo "UPDATE maposmatic_admin SET last_update='${rep}';" | psql -h localhost -U maposmatic -d ${DB_NAME} >> "${LOG_FILE}"
 
-rm -f ${PID_FILE} ${CURRENT_OSC}
+rm -f ${PID_FILE} ${CURRENT_OSC} ${CURRENT_WAYS}
 
 exit 0
 